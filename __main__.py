@@ -0,0 +1,5 @@
+import sys
+
+from simulation import cli
+
+sys.exit(cli.main())
@@ -0,0 +1,285 @@
+"""
+Single archive packaging of simulation directories.
+
+A packed simulation directory holds one zip archive (ARCHIVE_FILE) with config.toml, simulation.dill and all input
+files instead of a few dozen small files, which is what network filesystems and backups choke on. Run files
+(run_status.json, dart.log, output) are still written next to it.
+
+Files of a packed simulation are read directly from the archive, its zip index is cached per archive version:
+
+    archive.read('/sims/sim_0001/input/phase.xml')      # works whether sim_0001 is packed or not
+
+The inputs are only extracted right before DART runs (materialized) and removed again afterwards.
+"""
+import functools
+import logging
+import os
+import shutil
+import zipfile
+from contextlib import contextmanager
+
+import utils.general
+import utils.timing
+
+ARCHIVE_FILE = 'simulation.zip'
+
+# written by runs next to the archive, never packed
+UNPACKED = ['output', 'run_status.json', 'run_status.json.tmp', 'dart.log', ARCHIVE_FILE, ARCHIVE_FILE + '.part']
+
+# how many directories above a file its simulation directory may be, e.g. input/triangles/<file>
+MAX_DEPTH = 4
+
+
+def archive_path(path):
+    return utils.general.create_path(path, ARCHIVE_FILE)
+
+
+def is_packed(path):
+    """
+    :param path: simulation directory
+    :return: whether the simulation is packed
+    """
+    return os.path.exists(archive_path(path))
+
+
+def pack(path, source=None, compression=zipfile.ZIP_DEFLATED):
+    """
+    Pack a simulation directory into its archive. The packed files are removed from path, members of an existing
+    archive are kept unless replaced.
+
+    :param path: simulation directory
+    :param source: further directory whose files are packed as well (and not removed), e.g. components written to
+                   local scratch space
+    :param compression: zipfile compression
+    :return: path of the archive
+    """
+    files, own = {}, []
+    for directory in [path] + ([source] if source is not None else []):
+        for dirpath, dirnames, filenames in os.walk(directory):
+            rel_dir = os.path.relpath(dirpath, directory)
+            if rel_dir == '.':
+                dirnames[:] = [d for d in dirnames if d not in UNPACKED]
+                filenames = [f for f in filenames if f not in UNPACKED]
+            for name in filenames:
+                rel = name if rel_dir == '.' else utils.general.create_path(rel_dir, name)
+                files[rel] = os.path.join(dirpath, name)
+                if directory == path:
+                    own.append(files[rel])
+
+    target = archive_path(path)
+    with utils.timing.span('archive.pack', path=path), zipfile.ZipFile(target + '.part', 'w', compression) as zf:
+        if os.path.exists(target):
+            with zipfile.ZipFile(target) as existing:
+                for info in existing.infolist():
+                    if info.filename not in files:
+                        zf.writestr(info, existing.read(info))
+        for rel, file_path in sorted(files.items()):
+            zf.write(file_path, rel)
+    os.replace(target + '.part', target)
+
+    # remove what was packed from the simulation directory, bottom up to drop emptied directories
+    for file_path in own:
+        os.remove(file_path)
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        if dirpath != path and not os.listdir(dirpath) and \
+                os.path.relpath(dirpath, path).split(os.sep)[0] not in UNPACKED:
+            os.rmdir(dirpath)
+    logging.info('Packed ' + str(len(files)) + ' files into ' + target)
+    return target
+
+
+def members(path):
+    """
+    :param path: simulation directory
+    :return: frozenset of member names of its archive, empty if it is not packed
+    """
+    target = archive_path(path)
+    try:
+        stat = os.stat(target)
+    except OSError:
+        return frozenset()
+    return _index(target, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=256)
+def _index(target, mtime_ns, size):
+    with zipfile.ZipFile(target) as zf:
+        return frozenset(zf.namelist())
+
+
+def locate(file_path):
+    """
+    Find a file (or directory) of a packed simulation.
+
+    :param file_path: path of the file as if the simulation was not packed
+    :return: (simulation directory, member name or directory prefix) or None if it is not in an archive
+    """
+    file_path = utils.general.create_path(os.path.abspath(file_path))
+    directory = file_path
+    for _ in range(MAX_DEPTH):
+        directory = os.path.dirname(directory)
+        names = members(directory)
+        if names:
+            rel = os.path.relpath(file_path, directory).replace(os.sep, '/')
+            if rel in names:
+                return directory, rel
+            if any(n.startswith(rel + '/') for n in names):
+                return directory, rel + '/'
+            return None
+    return None
+
+
+def exists(file_path):
+    return os.path.exists(file_path) or locate(file_path) is not None
+
+
+def open_file(file_path):
+    """
+    Open a file of a simulation for binary reading, whether the simulation is packed or not.
+
+    :param file_path:
+    :return: binary file object
+    """
+    if os.path.exists(file_path):
+        return open(file_path, 'rb')
+    located = locate(file_path)
+    if located is None or located[1].endswith('/'):
+        raise IOError('No such file: ' + file_path)
+    zf = zipfile.ZipFile(archive_path(located[0]))
+    try:
+        return _MemberFile(zf, zf.open(located[1]))
+    except Exception:
+        zf.close()
+        raise
+
+
+def read(file_path):
+    """
+    :param file_path: see open_file
+    :return: file content as bytes
+    """
+    with open_file(file_path) as f:
+        return f.read()
+
+
+def read_text(file_path, encoding='utf-8'):
+    return read(file_path).decode(encoding)
+
+
+def copy(src, dst, link=False):
+    """
+    Copy a file of a simulation, extracting it if the simulation is packed.
+
+    :param src:
+    :param dst:
+    :param link: hard link instead of copy files that are not packed, falls back to copying
+    :return:
+    """
+    if os.path.exists(src):
+        if link:
+            if os.path.exists(dst):
+                os.remove(dst)
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass
+        shutil.copyfile(src, dst)
+        return
+    with open_file(src) as f, open(dst, 'wb') as out:
+        shutil.copyfileobj(f, out)
+
+
+def copytree(src, dst, link=False):
+    """
+    Copy a directory of a simulation, extracting it if the simulation is packed.
+    """
+    if os.path.exists(src):
+        shutil.copytree(src, dst, copy_function=functools.partial(copy, link=link))
+        return
+    located = locate(src)
+    if located is None:
+        raise IOError('No such directory: ' + src)
+    directory, prefix = located
+    with zipfile.ZipFile(archive_path(directory)) as zf:
+        for name in zf.namelist():
+            if name.startswith(prefix) and not name.endswith('/'):
+                target = utils.general.create_path(dst, name[len(prefix):])
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with zf.open(name) as f, open(target, 'wb') as out:
+                    shutil.copyfileobj(f, out)
+
+
+def materialize(path, target=None):
+    """
+    Extract the archive of a packed simulation.
+
+    :param path: simulation directory
+    :param target: directory to extract to, defaults to path
+    :return: list of extracted member names, files already present in target are not overwritten
+    """
+    if target is None:
+        target = path
+    extracted = []
+    with utils.timing.span('archive.materialize', path=path), zipfile.ZipFile(archive_path(path)) as zf:
+        for name in zf.namelist():
+            file_path = utils.general.create_path(target, name)
+            if name.endswith('/') or os.path.exists(file_path):
+                continue
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with zf.open(name) as f, open(file_path, 'wb') as out:
+                shutil.copyfileobj(f, out)
+            extracted.append(name)
+    return extracted
+
+
+@contextmanager
+def materialized(path):
+    """
+    Extract a packed simulation for the duration of the block (e.g. a DART run) and remove the extracted files again
+    afterwards. Not packed simulations are left as they are.
+
+    :param path: simulation directory
+    :return:
+    """
+    extracted = materialize(path) if is_packed(path) else []
+    try:
+        yield path
+    finally:
+        directories = set()
+        for name in extracted:
+            file_path = utils.general.create_path(path, name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            directories.add(os.path.dirname(file_path))
+        for directory in sorted(directories, key=len, reverse=True):
+            while directory != utils.general.create_path(path) and os.path.isdir(directory) and \
+                    not os.listdir(directory):
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
+
+
+class _MemberFile(object):
+    """
+    Zip member file object that closes its archive with it.
+    """
+
+    def __init__(self, zf, f):
+        self._zf = zf
+        self._f = f
+
+    def __getattr__(self, attr):
+        return getattr(self._f, attr)
+
+    def __iter__(self):
+        return iter(self._f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._f.close()
+        self._zf.close()
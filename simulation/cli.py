@@ -0,0 +1,282 @@
+"""
+dartpy command line interface.
+
+    python -m simulation.cli validate sweep.toml                # report all config errors of all variants
+    python -m simulation.cli validate sweep.toml --database-dir /opt/DART/database   # and missing optical models
+    python -m simulation.cli create sweep.toml --jobs 8
+    python -m simulation.cli run sweep.toml --jobs 4 --resume
+    python -m simulation.cli status sweep.toml
+    python -m simulation.cli postprocess sweep.toml             # apply the [postprocessing] retention policy
+    python -m simulation.cli resample sweep.toml --response S2A.csv --name S2A   # resample outputs to sensor bands
+
+    python -m simulation.cli serve sweep.toml --port 7305       # on the coordinator node
+    python -m simulation.cli worker coordinator:7305 --jobs 4   # on every worker node
+
+    python -m simulation.cli daemon --socket /tmp/dartpy.sock   # serve create and run requests with warm caches
+
+See simulation/sweep.py for the sweep file format.
+"""
+import argparse
+import collections
+import logging
+import sys
+
+from . import cost
+from . import ledger
+from . import postprocessing
+from . import run
+from . import staging
+from . import sweep as swp
+
+
+def validate(args):
+    sweep = swp.Sweep(args.sweep)
+    databases = None
+    if args.database_dir:
+        from . import database
+        databases = database.for_directories(args.database_dir)
+    errors = sweep.validate(databases=databases)
+    for error in errors:
+        print(error)
+    print(str(len(errors)) + ' errors in ' + str(len(sweep)) + ' variants')
+    return 1 if errors else 0
+
+
+def create(args):
+    sweep = swp.Sweep(args.sweep)
+    variants = sweep.create(jobs=args.jobs, resume=not args.force, dry_run=args.dry_run, staging=_staging(args))
+
+    for variant in variants:
+        print(('would create ' if args.dry_run else 'created ') + variant.name + ' ' +
+              ' '.join(k + '=' + str(v) for k, v in variant.parameters.items()))
+    print(str(len(variants)) + ' of ' + str(len(sweep)) + ' variants ' +
+          ('to create' if args.dry_run else 'created'))
+    return 0
+
+
+def run_sweep(args):
+    sweep = swp.Sweep(args.sweep)
+    if args.dry_run:
+        return _dry_run(sweep, args)
+    sweep.create(jobs=args.jobs, staging=_staging(args))
+
+    runner = run.SimulationRunner(jobs=args.jobs, dart_path=args.dart_path, ledger=sweep.ledger, sweep=sweep.name,
+                                  max_attempts=args.max_attempts, staging=_staging(args),
+                                  postprocess_jobs=args.postprocess_jobs, sequence_path=args.sequence_path)
+    if args.tune:
+        # calibrate on evenly spaced variants, the cheapest half keeps the calibration short
+        jobs = sorted(sweep.ledger.jobs(sweep=sweep.name), key=lambda job: job['priority'])
+        jobs = jobs[:max(len(jobs) // 2, 1)]
+        step = max(len(jobs) // args.tune, 1)
+        tuned = runner.tune([job['path'] for job in jobs[::step][:args.tune]], cores=args.cores)
+        print('tuned to ' + str(tuned.jobs) + ' jobs x ' + str(tuned.threads) + ' threads')
+    results = runner.run(resume=args.resume)
+
+    # refine the cost model with the recorded durations for the next sweeps
+    cost.CostModel.load(sweep.simulation_location).refine(sweep.ledger).save(sweep.simulation_location)
+
+    failed = [r for r in results if r['state'] != run.DONE]
+    print(str(len(results) - len(failed)) + ' of ' + str(len(results)) + ' runs succeeded')
+    return 1 if failed else 0
+
+
+def _dry_run(sweep, args):
+    # nothing is written, not even the simulation_location or the job ledger
+    missing = sweep.create(dry_run=True)
+    print(str(len(missing)) + ' variants to create')
+
+    paths, priorities = [], {}
+    if sweep.has_ledger():
+        job_ledger = sweep.ledger
+        runner = run.SimulationRunner(jobs=args.jobs, ledger=job_ledger, sweep=sweep.name,
+                                      max_attempts=args.max_attempts, postprocess_jobs=0)
+        paths = runner.run(resume=args.resume, dry_run=True)
+        priorities = dict((job['path'], job['priority']) for job in job_ledger.jobs(sweep=sweep.name))
+    for path in sorted(paths, key=lambda p: priorities.get(p, 0.), reverse=True):
+        print('would run ' + path + ' predicted cost ' + '{:.3g}'.format(priorities.get(path, 0.)))
+    _, makespan = cost.lpt_schedule(dict((p, priorities.get(p, 0.)) for p in paths), args.jobs)
+    print('predicted makespan ' + '{:.3g}'.format(makespan) + ' on ' + str(args.jobs) + ' slots')
+    return 0
+
+
+def status(args):
+    sweep = swp.Sweep(args.sweep)
+    jobs = sweep.ledger.jobs(sweep=sweep.name)
+
+    if args.verbose:
+        for job in jobs:
+            print('{name} {state} attempts={attempts} exit_code={exit_code} duration={duration} {path}'.format(**job))
+
+    counts = collections.Counter(job['state'] for job in jobs)
+    counts['missing'] = (0 if jobs else 1) if sweep.sequence else len(sweep) - len(jobs)
+    print(' '.join(state + '=' + str(counts[state]) for state in ['missing'] + ledger.STATES))
+    return 0
+
+
+def postprocess(args):
+    sweep = swp.Sweep(args.sweep)
+    postprocessor = postprocessing.Postprocessor(args.jobs)
+    for job in sweep.ledger.jobs(sweep=sweep.name, state=ledger.DONE):
+        postprocessor.submit(job['path'])
+    before, after = postprocessor.wait()
+    postprocessor.shutdown()
+    print('outputs reduced from ' + str(before) + ' to ' + str(after) + ' bytes')
+    return 0
+
+
+def resample(args):
+    from . import sensor
+    sweep = swp.Sweep(args.sweep)
+    resampling = None
+    if args.response is not None:
+        resampling = sensor.Resampling(sensor.load_response(args.response), name=args.name,
+                                       images=args.image or ['BRF/*/IMAGES_DART/*.mp#'], tables=args.table,
+                                       chunk_size=args.chunk_size)
+    else:
+        resampling = sensor.Resampling.from_config(sweep.base_config())
+        if resampling is None:
+            print('no sensor_response in [postprocessing], pass --response')
+            return 1
+        resampling.chunk_size = args.chunk_size
+    paths = [job['path'] for job in sweep.ledger.jobs(sweep=sweep.name, state=ledger.DONE)]
+    results = sensor.resample(paths, resampling, jobs=args.jobs)
+    print(str(len(results)) + ' of ' + str(len(paths)) + ' simulations resampled to sensor ' + resampling.name)
+    return 0 if len(results) == len(paths) else 1
+
+
+def serve(args):
+    sweep = swp.Sweep(args.sweep)
+    runner = run.SimulationRunner(ledger=sweep.ledger, sweep=sweep.name, max_attempts=args.max_attempts)
+    runner.serve(host=args.host, port=args.port, heartbeat_timeout=args.heartbeat_timeout)
+    return 0
+
+
+def worker(args):
+    host, _, port = args.coordinator.partition(':')
+    runner = run.SimulationRunner(jobs=args.jobs, dart_path=args.dart_path, staging=_staging(args),
+                                  postprocess_jobs=args.postprocess_jobs)
+    results = runner.work(host, port=int(port) if port else None, heartbeat_interval=args.heartbeat_interval)
+    print(str(len(results)) + ' runs finished')
+    return 0
+
+
+def daemon(args):
+    from . import daemon as dmn
+    dmn.Daemon(socket_path=args.socket, port=args.port, versions=args.version or ['5.7.5'], dart_path=args.dart_path,
+               staging=_staging(args), roots=args.root).serve()
+    return 0
+
+
+def _staging(args):
+    if args.scratch is None:
+        return None
+    return staging.Staging(args.scratch, min_free_bytes=int(args.min_free * (1 << 30)), publish=args.publish,
+                           archive=args.archive)
+
+
+def _add_staging_arguments(p):
+    p.add_argument('--scratch', default=None, help='build and run simulations on this local scratch directory')
+    p.add_argument('--min-free', type=float, default=1., help='GiB to keep free on scratch')
+    p.add_argument('--publish', action='append', default=None, metavar='GLOB',
+                   help='publish only matching paths after a run (repeatable), default all new files')
+    p.add_argument('--archive', choices=['tar', 'gz'], default=None, help='publish run outputs as one tar archive')
+
+
+def parser():
+    p = argparse.ArgumentParser(prog='dartpy', description='Create, patch and run batches of DART simulations.')
+    p.add_argument('-v', '--verbose', action='store_true')
+    sub = p.add_subparsers(dest='command')
+    sub.required = True
+
+    p_validate = sub.add_parser('validate', help='validate the configs of all variants of a sweep')
+    p_validate.add_argument('sweep', help='sweep toml file')
+    p_validate.add_argument('--database-dir', action='append', default=None, metavar='DIR',
+                            help='also check that the coeff_diff models exist in the DART databases of DIR '
+                                 '(repeatable, searched in order)')
+    p_validate.set_defaults(func=validate)
+
+    p_create = sub.add_parser('create', help='create and write all variants of a sweep')
+    p_create.add_argument('sweep', help='sweep toml file')
+    p_create.add_argument('-j', '--jobs', type=int, default=1)
+    p_create.add_argument('--dry-run', action='store_true')
+    p_create.add_argument('--force', action='store_true', help='recreate variants already written')
+    _add_staging_arguments(p_create)
+    p_create.set_defaults(func=create)
+
+    p_run = sub.add_parser('run', help='create missing variants and run DART on all of them')
+    p_run.add_argument('sweep', help='sweep toml file')
+    p_run.add_argument('-j', '--jobs', type=int, default=1)
+    p_run.add_argument('--dry-run', action='store_true')
+    p_run.add_argument('--resume', action='store_true', help='skip variants that already ran successfully')
+    p_run.add_argument('--dart-path', default=None, help='override the dart_path of the simulation configs')
+    p_run.add_argument('--sequence-path', default=None, help='DART sequence launcher for sequence sweeps')
+    p_run.add_argument('--max-attempts', type=int, default=3, help='retry failed runs up to this many attempts')
+    p_run.add_argument('--tune', type=int, default=0, metavar='N',
+                       help='calibrate jobs and DART threads on N representative variants before running')
+    p_run.add_argument('--cores', type=int, default=None, help='cores to distribute when tuning, defaults to all')
+    p_run.add_argument('--postprocess-jobs', type=int, default=2,
+                       help='threads applying the retention policy after each run, 0 keeps all outputs')
+    _add_staging_arguments(p_run)
+    p_run.set_defaults(func=run_sweep)
+
+    p_post = sub.add_parser('postprocess', help='apply the retention policy to all finished variants of a sweep')
+    p_post.add_argument('sweep', help='sweep toml file')
+    p_post.add_argument('-j', '--jobs', type=int, default=2)
+    p_post.set_defaults(func=postprocess)
+
+    p_resample = sub.add_parser('resample', help='resample the band outputs of all finished variants to sensor bands')
+    p_resample.add_argument('sweep', help='sweep toml file')
+    p_resample.add_argument('-j', '--jobs', type=int, default=2)
+    p_resample.add_argument('--response', default=None,
+                            help='spectral response table, defaults to sensor_response of [postprocessing]')
+    p_resample.add_argument('--name', default='sensor', help='sensor name of the --response table')
+    p_resample.add_argument('--image', action='append', default=None, metavar='GLOB',
+                            help='binary images to resample, relative to output/BAND<i> (repeatable)')
+    p_resample.add_argument('--table', action='append', default=None, metavar='GLOB',
+                            help='text tables to resample, relative to output/BAND<i> (repeatable)')
+    p_resample.add_argument('--chunk-size', type=int, default=1 << 16, help='pixels read per band at once')
+    p_resample.set_defaults(func=resample)
+
+    p_serve = sub.add_parser('serve', help='coordinate remote workers running the emitted variants of a sweep')
+    p_serve.add_argument('sweep', help='sweep toml file')
+    p_serve.add_argument('--host', default='0.0.0.0')
+    p_serve.add_argument('--port', type=int, default=None)
+    p_serve.add_argument('--heartbeat-timeout', type=float, default=30.)
+    p_serve.add_argument('--max-attempts', type=int, default=3)
+    p_serve.set_defaults(func=serve)
+
+    p_worker = sub.add_parser('worker', help='run jobs handed out by a coordinator')
+    p_worker.add_argument('coordinator', help='host[:port] of the coordinator')
+    p_worker.add_argument('-j', '--jobs', type=int, default=1)
+    p_worker.add_argument('--dart-path', default=None)
+    p_worker.add_argument('--heartbeat-interval', type=float, default=5.)
+    p_worker.add_argument('--postprocess-jobs', type=int, default=2)
+    _add_staging_arguments(p_worker)
+    p_worker.set_defaults(func=worker)
+
+    p_daemon = sub.add_parser('daemon', help='serve simulation requests over a local socket with warm caches')
+    p_daemon.add_argument('--socket', default='/tmp/dartpy.sock', help='Unix domain socket to listen on')
+    p_daemon.add_argument('--port', type=int, default=None, help='listen on this localhost port instead')
+    p_daemon.add_argument('--version', action='append', default=None,
+                          help='DART version to load the default config and schema of on start (repeatable)')
+    p_daemon.add_argument('--dart-path', default=None, help='DART launcher of all run requests, no runs without it')
+    p_daemon.add_argument('--root', action='append', default=None,
+                          help='directory simulations may be created in and run from (repeatable), defaults to the '
+                               'working directory')
+    _add_staging_arguments(p_daemon)
+    p_daemon.set_defaults(func=daemon)
+
+    p_status = sub.add_parser('status', help='report the state of all variants of a sweep')
+    p_status.add_argument('sweep', help='sweep toml file')
+    p_status.set_defaults(func=status)
+    return p
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
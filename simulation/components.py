@@ -1,15 +1,28 @@
 import utils.general
+import utils.timing
 
-from lxml import etree as et
 import os
 import logging
-from pkg_resources import parse_version
-from shutil import copyfile, copytree
+from utils.general import parse_version
 
+import functools
 from functools import reduce
+import collections
+import copy
+import hashlib
+import itertools
 import operator
+import re
+import threading
 
+import utils.obj_utils
 import utils.xml_utils
+from . import archive
+from . import optical
+from . import schema
+
+et = utils.general.lazy_import('lxml.etree')
+np = utils.general.lazy_import('numpy')
 
 ROOT_TAG = 'DartFile'
 
@@ -20,6 +33,7 @@ class Component(object):
     """
     COMPONENT_FILE_NAME = None
     COMPONENT_NAME = None
+    CONFIG_KEY = None
     IMPLEMENTED_WRITE_VERSION = []
 
     def __init__(self, simulation_dir, params, version, xml_patch_path=None, *args, **kwargs):
@@ -55,6 +69,8 @@ class Component(object):
         self._is_to_file = False
         self._is_patched_to_xml = False
         self._written_params = None
+        self._write_kwargs = kwargs
+        self.link_assets = False
 
     @classmethod
     def is_implemented(cls):
@@ -65,7 +81,7 @@ class Component(object):
         return version in cls.IMPLEMENTED_WRITE_VERSION
 
     @classmethod
-    def from_simulation(cls, simulation_dir, base_path, version, force=False):
+    def from_simulation(cls, simulation_dir, base_path, version, force=False, link_assets=False):
         """
         Create a component from valid component files in an existing simulation (denoted as base simulation). This
         instantiation checks for version consistency and copies all relevant files without changing.
@@ -74,6 +90,8 @@ class Component(object):
         :param base_path:
         :param version:
         :param force:
+        :param link_assets: hard link instead of copy the files next to the xml (triangle files, lut.properties),
+                            DART only reads them
         :return:
         """
         xml_path = utils.general.create_path(base_path, 'input', cls.COMPONENT_FILE_NAME)
@@ -91,59 +109,102 @@ class Component(object):
                 raise Exception(
                     'Cannot load ' + xml_path + ' since file it is not a valid dart ' + cls.COMPONENT_NAME + ' file.')
         else:
-            return cls(simulation_dir, (xml_root, xml_path), version)
+            component = cls(simulation_dir, (xml_root, xml_path), version)
+            component.link_assets = link_assets
+            return component
 
     def patch_to_xml(self, xml_path):
-        self.xml_root = utils.xml_utils.merge_xmls(self._read(xml_path), self.xml_root, remove_empty_paths=True)
+        with utils.timing.span('component.patch_to_xml', component=self.COMPONENT_NAME, path=xml_path):
+            self.xml_root = utils.xml_utils.merge_xmls(_read_patch(xml_path), self.xml_root, remove_empty_paths=True)
         self._is_patched_to_xml = True
 
-    def to_file(self):
+    def to_file(self, simulation_dir=None):
         """
-        Write out the component to file.
+        Write out the component to file. The xml is built by a private copy of the component (see _writer), so the
+        same component can be written concurrently and repeatedly.
+
+        :param simulation_dir: defaults to self.simulation_dir
         :return:
         """
-        inp_path = utils.general.create_path(self.simulation_dir, 'input')
+        if simulation_dir is None:
+            simulation_dir = self.simulation_dir
+        inp_path = utils.general.create_path(simulation_dir, 'input')
         xml_path = utils.general.create_path(inp_path, self.COMPONENT_FILE_NAME)
 
-        if not os.path.exists(inp_path):
-            os.makedirs(inp_path)
+        os.makedirs(inp_path, exist_ok=True)
 
         if not self._xml_only:
-            self._write(**self.params)
-            tree = et.ElementTree(self.xml_root)
+            writer = self._writer(simulation_dir)
+            writer._write(writer.params, **writer._write_kwargs)
+            tree = et.ElementTree(writer.xml_root)
 
-            if not os.path.exists(inp_path):
-                os.mkdir(inp_path)
-            tree.write(xml_path, pretty_print=True)
+            with utils.timing.span('file.write', component=self.COMPONENT_NAME, path=xml_path):
+                writer._write_tree(tree, xml_path)
         else:
-            self._copy_from_simulation(self.original_path, xml_path)
+            with utils.timing.span('file.copy', component=self.COMPONENT_NAME, path=xml_path):
+                self._copy_from_simulation(self.original_path, xml_path, link=self.link_assets)
 
         self._is_to_file = True
 
+    def _writer(self, simulation_dir):
+        """
+        Shallow copy of the component with a fresh xml root. The writers keep their state (_written_params, the xml
+        built so far, ...) on the copy, params and write kwargs are only read.
+
+        :param simulation_dir: directory the xml is written to, may be scratch space standing in for
+                               self.simulation_dir (see Simulation.to_file), which is kept as writer.target_dir
+        :return: Component
+        """
+        writer = copy.copy(self)
+        writer.target_dir = self.simulation_dir
+        writer.simulation_dir = simulation_dir
+        writer.xml_root = et.Element(ROOT_TAG)
+        writer.xml_root.set('version', self.version)
+        writer._written_params = None
+        return writer
+
     @classmethod
     def _read(cls, path):
-        tree = et.parse(path)
+        # read directly from the archive of packed simulations
+        with archive.open_file(path) as f:
+            tree = et.parse(f)
         return tree.getroot()
 
-    def _write(self, params, *args, **kwargs):
-        assert self._check_params(params)
+    def _write(self, params, *args, check=True, **kwargs):
+        if check:
+            self._check_params(params)
 
-        if parse_version(self.version) >= parse_version('5.7.5'):
-            self._write575(params, *args, **kwargs)
-        elif parse_version(self.version) >= parse_version('5.6.0'):
-            self._write560(params, *args, **kwargs)
+        with utils.timing.span('component.write', component=self.COMPONENT_NAME):
+            if parse_version(self.version) >= parse_version('5.7.5'):
+                self._write575(params, *args, **kwargs)
+            elif parse_version(self.version) >= parse_version('5.6.0'):
+                self._write560(params, *args, **kwargs)
 
         if self.xml_patch_path is not None:
             self.patch_to_xml(self.xml_patch_path)
 
+    def _write_tree(self, tree, xml_path):
+        tree.write(xml_path, pretty_print=True)
+
     @classmethod
-    def _copy_from_simulation(cls, copy_xml_path, new_xml_path):
-        copyfile(copy_xml_path, new_xml_path)
+    def _copy_from_simulation(cls, copy_xml_path, new_xml_path, link=False):
+        archive.copy(copy_xml_path, new_xml_path)
 
     def _set_path(self, el, key, params_path, check=None):
         val = self._get(params_path)
         self._set(el, key, val, check)
 
+    def _set_fct_phase(self, el, ident_path, index_path, kind, library):
+        """
+        Set the indexFctPhase of an optical property link, 'auto' is resolved from its ident by the library.
+        """
+        index = self._get(index_path)
+        if library is not None:
+            index = library.resolve(self._get(ident_path), index, kind)
+        elif str(index) == optical.AUTO:
+            raise Exception(index_path + " = 'auto' needs the optical property library of the simulation.")
+        self._set(el, 'indexFctPhase', index)
+
     def _set(self, el, key, val, check=None):
         self._check_and_set(el, key, self._str_none(val), check=check)
 
@@ -182,7 +243,19 @@ class Component(object):
         return None
 
     def _check_params(self, params):
-        raise NotImplementedError
+        """
+        Validate params against the schema of the default config of self.version, see simulation.schema. Missing
+        parameters are allowed if the component is patched with an xml file.
+
+        :param params:
+        :return: True, raises an Exception listing all errors otherwise
+        """
+        version_schema = schema.for_version(self.version)
+        if version_schema is not None and self.CONFIG_KEY is not None:
+            schema.check(version_schema.validate_component(self.CONFIG_KEY, params,
+                                                           partial=self.xml_patch_path is not None),
+                         self.COMPONENT_NAME + ' component')
+        return True
 
     def _write575(self, params, *args, **kwargs):
         raise NotImplementedError
@@ -191,12 +264,32 @@ class Component(object):
         raise NotImplementedError
 
     def __getstate__(self):
-        return self.__dict__
+        # lxml elements cannot be pickled, they are shipped serialized (e.g. to the processes of bulk_to_file)
+        state = self.__dict__.copy()
+        state['xml_root'] = et.tostring(self.xml_root)
+        state['params'] = utils.general.builtin_dict(self.params)
+        return state
 
     def __setstate__(self, state):
+        state['xml_root'] = et.fromstring(state['xml_root'])
         self.__dict__ = state
 
 
+@functools.lru_cache(maxsize=64)
+def _parse_patch(path, mtime_ns, size):
+    return Component._read(path)
+
+
+def _read_patch(path):
+    """
+    Parsed xml patch file, parsed once as long as the file does not change. merge_xmls only reads it, so the element is
+    shared by all components patched with the file.
+    """
+    located = None if os.path.exists(path) else archive.locate(path)
+    stat = os.stat(path if located is None else archive.archive_path(located[0]))
+    return _parse_patch(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
 class Inversion(Component):
     COMPONENT_NAME = 'DartInversion'
     COMPONENT_FILE_NAME = 'inversion.xml'
@@ -205,17 +298,17 @@ class Inversion(Component):
         return True
 
     @classmethod
-    def _copy_from_simulation(cls, copy_xml_path, new_xml_path):
+    def _copy_from_simulation(cls, copy_xml_path, new_xml_path, link=False):
         Component._copy_from_simulation(copy_xml_path, new_xml_path)
 
         directory, fil = os.path.split(copy_xml_path)
         lut_properties_path = utils.general.create_path(directory, 'lut.properties')
-        if not os.path.exists(lut_properties_path):
+        if not archive.exists(lut_properties_path):
             raise Exception('lut.properties does not exist')
 
         directory, fil = os.path.split(new_xml_path)
         new_lut_properties_path = utils.general.create_path(directory, 'lut.properties')
-        copyfile(lut_properties_path, new_lut_properties_path)
+        archive.copy(lut_properties_path, new_lut_properties_path, link=link)
 
 
 class Trees(Component):
@@ -234,26 +327,26 @@ class TriangleFile(Component):
         return True
 
     @classmethod
-    def _copy_from_simulation(cls, copy_xml_path, new_xml_path):
+    def _copy_from_simulation(cls, copy_xml_path, new_xml_path, link=False):
         Component._copy_from_simulation(copy_xml_path, new_xml_path)
 
         directory, fil = os.path.split(copy_xml_path)
         bin_path = utils.general.create_path(directory, 'triangleFile.bin')
-        if not os.path.exists(bin_path):
+        if not archive.exists(bin_path):
             raise Exception('triangleFile.bin does not exist')
 
         directory, fil = os.path.split(new_xml_path)
         new_bin_path = utils.general.create_path(directory, 'triangleFile.bin')
-        copyfile(bin_path, new_bin_path)
+        archive.copy(bin_path, new_bin_path, link=link)
 
         directory, fil = os.path.split(copy_xml_path)
         triangles_path = utils.general.create_path(directory, 'triangles')
-        if not os.path.exists(triangles_path):
+        if not archive.exists(triangles_path):
             raise Exception('triangles directory does not exist')
 
         directory, fil = os.path.split(new_xml_path)
         new_triangles_path = utils.general.create_path(directory, 'triangles')
-        copytree(triangles_path, new_triangles_path)
+        archive.copytree(triangles_path, new_triangles_path, link=link)
 
 
 class Urban(Component):
@@ -275,11 +368,9 @@ class Water(Component):
 class Phase(Component):
     COMPONENT_NAME = 'Phase'
     COMPONENT_FILE_NAME = 'phase.xml'
+    CONFIG_KEY = 'phase'
     IMPLEMENTED_WRITE_VERSION = ['5.7.5']
 
-    def _check_params(self, params):
-        return True
-
     def _write575(self, params, *args, **kwargs):
         self._written_params = params
 
@@ -624,11 +715,9 @@ class Phase(Component):
 class Directions(Component):
     COMPONENT_NAME = 'Directions'
     COMPONENT_FILE_NAME = 'directions.xml'
+    CONFIG_KEY = 'directions'
     IMPLEMENTED_WRITE_VERSION = ['5.7.5']
 
-    def _check_params(self, params):
-        return True
-
     def _write575(self, params, *args, **kwargs):
         self._written_params = params
 
@@ -667,12 +756,10 @@ class Directions(Component):
 class Plots(Component):
     COMPONENT_NAME = 'Plots'
     COMPONENT_FILE_NAME = 'plots.xml'
+    CONFIG_KEY = 'plots'
     IMPLEMENTED_WRITE_VERSION = ['5.7.5']
 
-    def _check_params(self, params):
-        return True
-
-    def _write575(self, params, land_cover, *args, **kwargs):
+    def _write575(self, params, land_cover, *args, library=None, **kwargs):
         self._written_params = params
 
         plots = et.SubElement(self.xml_root, self.COMPONENT_NAME)
@@ -737,8 +824,8 @@ class Plots(Component):
                                                                          'VegetationOpticalPropertyLink')
                         self._set_path(vegetation_optical_property_link, 'ident',
                                        'vegetation.ident.' + str(vegetation_id))
-                        self._set_path(vegetation_optical_property_link, 'indexFctPhase',
-                                       'vegetation.indexFctPhase.' + str(vegetation_id))
+                        self._set_fct_phase(vegetation_optical_property_link, 'vegetation.ident.' + str(vegetation_id),
+                                            'vegetation.indexFctPhase.' + str(vegetation_id), 'lop3d', library)
 
                         ground_thermal_property_link = et.SubElement(plot_vegetation_properties,
                                                                      'GroundThermalPropertyLink')
@@ -751,8 +838,9 @@ class Plots(Component):
 
                         ground_optical_property_link = et.SubElement(plot, 'GroundOpticalPropertyLink')
                         self._set_path(ground_optical_property_link, 'ident', 'ground.ident.' + str(litter_id))
-                        self._set_path(ground_optical_property_link, 'indexFctPhase',
-                                       'ground.indexFctPhase.' + str(litter_id))
+                        self._set_fct_phase(ground_optical_property_link, 'ground.ident.' + str(litter_id),
+                                            'ground.indexFctPhase.' + str(litter_id),
+                                            optical.kind(self._get('ground.type.' + str(litter_id))), library)
                         self._set_path(ground_optical_property_link, 'type', 'ground.type.' + str(litter_id))
 
                         ground_thermal_property_link = et.SubElement(plot, 'GroundThermalPropertyLink')
@@ -767,11 +855,9 @@ class Plots(Component):
 class CoeffDiff(Component):
     COMPONENT_NAME = 'Coeff_diff'
     COMPONENT_FILE_NAME = 'coeff_diff.xml'
+    CONFIG_KEY = 'coeff_diff'
     IMPLEMENTED_WRITE_VERSION = ['5.7.5']
 
-    def _check_params(self, params):
-        return True
-
     def _write575(self, params, *args, **kwargs):
         self._written_params = params
 
@@ -783,9 +869,10 @@ class CoeffDiff(Component):
         # *** 2d lambertian spectra ***
         lambertian_multi_functions = et.SubElement(coeff_diff, 'LambertianMultiFunctions')
 
+        # identical models are written once, see simulation.optical
+        library = optical.OpticalLibrary.from_params(params)
         if self._get('lop2d.model') is not None:
-            for m in range(len(self._get('lop2d.model'))):
-                model = self._get('lop2d.model.' + str(m))
+            for model in library.models('lop2d'):
                 lambertian_multi = et.SubElement(lambertian_multi_functions, 'LambertianMulti')
 
                 self._set(lambertian_multi, 'ModelName', model.get('ModelName'))
@@ -847,8 +934,7 @@ class CoeffDiff(Component):
         # self._set_path(UnderstoryMultiFunctions, 'useBunnick','0')
 
         if self._get('lop3d.model') is not None:
-            for m in range(len(self._get('lop3d.model'))):
-                model = self._get('lop3d.model.' + str(m))
+            for model in library.models('lop3d'):
 
                 understory_multi = et.SubElement(understory_multi_functions, 'UnderstoryMulti')
                 self._set(understory_multi, 'dimFoliar', model.get('dimFoliar'))
@@ -920,11 +1006,9 @@ class CoeffDiff(Component):
 class Object3d(Component):
     COMPONENT_NAME = 'object_3d'
     COMPONENT_FILE_NAME = 'object_3d.xml'
+    CONFIG_KEY = 'object3d'
     IMPLEMENTED_WRITE_VERSION = ['5.7.5']
 
-    def _check_params(self, params):
-        return True
-
     def _write575(self, params, *args, **kwargs):
         self._written_params = params
 
@@ -964,9 +1048,11 @@ class Object3d(Component):
         self._set_path(pos_prop, 'zpos', 'location.2')
 
         dimension = et.SubElement(geom_prop, 'Dimension3D')
-        self._set_path(dimension, 'xdim', 'dim.0')
-        self._set_path(dimension, 'ydim', 'dim.1')
-        self._set_path(dimension, 'zdim', 'dim.2')
+        dim = self._get('dim')
+        if dim is None or dim == 'auto':
+            dim = self._obj_dimensions()
+        for i, key in enumerate(['xdim', 'ydim', 'zdim']):
+            self._set(dimension, key, dim[i])
 
         scale_prop = et.SubElement(geom_prop, 'ScaleProperties')
         self._set_path(scale_prop, 'xScaleDeviation', 'scale.xScaleDeviation')
@@ -992,7 +1078,8 @@ class Object3d(Component):
 
         object_property_link = et.SubElement(object_optical_prop, 'OpticalPropertyLink')
         self._set_path(object_property_link, 'ident', 'optical_property.modelName')
-        self._set_path(object_property_link, 'indexFctPhase', 'optical_property.indexFctPhase')
+        self._set_fct_phase(object_property_link, 'optical_property.modelName', 'optical_property.indexFctPhase',
+                            optical.kind(self._get('optical_property.type')), kwargs.get('library'))
         self._set_path(object_property_link, 'type', 'optical_property.type')
 
         thermal_property_link = et.SubElement(object_optical_prop, 'ThermalPropertyLink')
@@ -1008,16 +1095,130 @@ class Object3d(Component):
 
         object_fields = et.SubElement(object_3d, 'ObjectFields')
 
+        self._instances = None
+        if self._get('instancing'):
+            self._instances = self._load_instances(obj)
+
+    def _obj_dimensions(self):
+        """
+        Dimensions of the mesh in path2obj, from the geometry cache (see utils.obj_utils).
+
+        :return: [x, y, z]
+        """
+        path = self._get('path2obj')
+        if path is None or not os.path.exists(os.path.expanduser(str(path))):
+            raise Exception("Cannot compute the dimensions of the 3d object " + str(path) + " (dim = 'auto'), "
+                            "file not found.")
+        return utils.obj_utils.metadata(str(path))['dim']
+
+    def _load_instances(self, template):
+        """
+        Load the instance table from objPosFile. Every row is one instance of the object, the columns are named by
+        objPosColumns: x, y, z (added to location), xscale, yscale, zscale, scale (all three scales), xrot, yrot, zrot.
+
+        :param template: Object element all instances are copied from
+        :return: (list of attribute names, list of value columns)
+        """
+        path = os.path.expanduser(str(self._get('objPosFile')))
+        columns = self._get('objPosColumns') or ['x', 'y']
+        with utils.timing.span('object3d.load_instances', path=path):
+            table = np.loadtxt(path, ndmin=2, comments='#')
+        if table.shape[1] < len(columns):
+            raise Exception(path + ' has ' + str(table.shape[1]) + ' columns, objPosColumns names ' +
+                            str(len(columns)))
+
+        location = [float(v) for v in (self._get('location') or [0, 0, 0])] + [0.] * 3
+        values = collections.OrderedDict()
+        for i, column in enumerate(columns):
+            if column not in _INSTANCE_COLUMNS:
+                raise Exception('Unknown objPosColumns entry ' + column + '. Use one of ' +
+                                ', '.join(_INSTANCE_COLUMNS))
+            for attribute in _INSTANCE_COLUMNS[column]:
+                offset = location['xyz'.index(column)] if column in 'xyz' else 0.
+                values[attribute] = (table[:, i] + offset).tolist()
+        values['num'] = list(range(table.shape[0]))
+
+        # first instance in the tree itself, so that patching and reading the xml root still work
+        for attribute, column in values.items():
+            _instance_element(template, attribute).set(attribute, str(column[0]))
+        return list(values.keys()), list(values.values())
+
+    def _write_tree(self, tree, xml_path):
+        """
+        Stream all instances into the ObjectList instead of building one element per instance.
+        """
+        if not getattr(self, '_instances', None):
+            return Component._write_tree(self, tree, xml_path)
+
+        attributes, columns = self._instances
+        template = tree.getroot().find('./' + self.COMPONENT_NAME + '/ObjectList/Object')
+        object_list = template.getparent()
+
+        # serialize the template once and split it at the instance attributes
+        originals = dict((a, _instance_element(template, a).get(a)) for a in attributes)
+        for a in attributes:
+            _instance_element(template, a).set(a, _INSTANCE_MARKER + a)
+        pattern = et.tostring(template, encoding='unicode')
+        for a, v in originals.items():
+            if v is None:
+                del _instance_element(template, a).attrib[a]
+            else:
+                _instance_element(template, a).set(a, v)
+        order = sorted(attributes, key=lambda a: pattern.index('"' + _INSTANCE_MARKER + a + '"'))
+        pieces = re.split('(?:' + '|'.join(re.escape(_INSTANCE_MARKER + a) for a in order) + ')(?=")', pattern)
+
+        # columns shared by several attributes (scale) are converted once
+        strings = {}
+        for column in columns:
+            if id(column) not in strings:
+                strings[id(column)] = list(map(str, column))
+        n = len(columns[0])
+        parts = [itertools.repeat(pieces[0], n)]
+        for a, piece in zip(order, pieces[1:]):
+            parts.append(strings[id(columns[attributes.index(a)])])
+            parts.append(itertools.repeat(piece, n))
+
+        # write the rest of the tree around a placeholder
+        placeholder = et.Comment('dartpy_instances')
+        object_list.replace(template, placeholder)
+        try:
+            head, tail = et.tostring(tree, pretty_print=True, encoding='unicode').split('<!--dartpy_instances-->')
+        finally:
+            object_list.replace(placeholder, template)
+
+        with open(xml_path, 'w') as f:
+            f.write(head)
+            f.writelines(map(''.join, zip(*parts)))
+            f.write(tail)
+
+
+# objPosColumns -> instance attributes
+_INSTANCE_COLUMNS = collections.OrderedDict([
+    ('x', ['xpos']), ('y', ['ypos']), ('z', ['zpos']),
+    ('xscale', ['xscale']), ('yscale', ['yscale']), ('zscale', ['zscale']), ('scale', ['xscale', 'yscale', 'zscale']),
+    ('xrot', ['xrot']), ('yrot', ['yrot']), ('zrot', ['zrot'])])
+_INSTANCE_MARKER = '__dartpy_instance_'
+
+
+def _instance_element(obj, attribute):
+    if attribute == 'num':
+        return obj
+    if attribute.endswith('pos'):
+        return obj.find('./GeometricProperties/PositionProperties')
+    if attribute.endswith('scale'):
+        return obj.find('./GeometricProperties/ScaleProperties')
+    return obj.find('./GeometricProperties/RotationProperties')
+
 
 class Maket(Component):
     COMPONENT_NAME = 'Maket'
     COMPONENT_FILE_NAME = 'maket.xml'
+    CONFIG_KEY = 'maket'
     IMPLEMENTED_WRITE_VERSION = ['5.7.5']
 
-    def _check_params(self, params):
-        return True
-
-    def _write575(self, params, **kwargs):
+    def _write575(self, params, dem=None, **kwargs):
+        if dem is not None:
+            params = self._with_dem(params, dem)
         self._written_params = params
 
         maket = et.SubElement(self.xml_root, self.COMPONENT_NAME)
@@ -1042,7 +1243,8 @@ class Maket(Component):
         # optical property
         OpticalPropertyLink = et.SubElement(soil, 'OpticalPropertyLink')
         self._set_path(OpticalPropertyLink, 'ident', 'optical_property.ident')
-        self._set_path(OpticalPropertyLink, 'indexFctPhase', 'optical_property.indexFctPhase')
+        self._set_fct_phase(OpticalPropertyLink, 'optical_property.ident', 'optical_property.indexFctPhase',
+                            optical.kind(self._get('optical_property.type')), kwargs.get('library'))
         self._set_path(OpticalPropertyLink, 'type', 'optical_property.type')
 
         # thermal function
@@ -1051,12 +1253,12 @@ class Maket(Component):
         self._set_path(thermal_property_link, 'indexTemperature', 'thermal_property.indexTemperature')
 
         # topography
-        if not 'topography.fileName':
+        if not self._get('topography.fileName'):
             topography = et.SubElement(soil, 'Topography')
-            self._set_path(topography, 'presenceOfTopography', '0')
+            self._set(topography, 'presenceOfTopography', 0)
 
             DEM_properties = et.SubElement(soil, 'DEM_properties')
-            self._set_path(DEM_properties, 'createTopography', '0')
+            self._set(DEM_properties, 'createTopography', 0)
 
         else:
             topography = et.SubElement(soil, 'Topography')
@@ -1084,15 +1286,112 @@ class Maket(Component):
         self._set_path(location, 'latitude', 'location.0')
         self._set_path(location, 'longitude', 'location.1')
 
+    def _with_dem(self, params, dem):
+        """
+        Write a DEM to the input directory and return params importing it.
+
+        :param params:
+        :param dem: 2d numpy array of heights (rows along y) or path to a .npy file, which is memory mapped
+        :return: patched copy of params
+        """
+        if type(dem) is str:
+            dem = np.load(os.path.expanduser(dem), mmap_mode='r')
+        if dem.ndim != 2:
+            raise Exception('The DEM must be a 2d array, got shape ' + str(dem.shape))
+
+        scene, voxel = params.get('sceneDim'), params.get('voxelDim')
+        if scene and voxel:
+            expected = (int(round(scene[1] / voxel[1])), int(round(scene[0] / voxel[0])))
+            if tuple(dem.shape) != expected:
+                logging.warning('DEM shape ' + str(dem.shape) + ' does not match the ' + str(expected) +
+                                ' cells of the scene')
+
+        file_name = write_dem(dem, utils.general.create_path(self.simulation_dir, 'input'))
+        params = utils.general.merge_dicts(copy.deepcopy(params), {
+            'topography': {'presenceOfTopography': 1, 'fileName': DEM_OUTPUT_FILE},
+            'DEM': {'createTopography': 1, 'caseDEM': DEM_IMPORT_CASE, 'outputFileName': DEM_OUTPUT_FILE},
+            'DEM5': {'dataEncoding': 0, 'dataFormat': 8, 'fileName': file_name}})
+        return params
+
+
+# DEM_5: import of a raw raster, written as little endian (dataEncoding 0) doubles (dataFormat 8)
+DEM_IMPORT_CASE = 5
+DEM_OUTPUT_FILE = 'DEM.mp#'
+DEM_FILE = 'dem.bin'
+DEM_CHUNK_ROWS = 1024
+
+
+def cache_dem(dem):
+    """
+    Write a DEM as raw little endian doubles to the dartpy cache, once per content.
+
+    :param dem: 2d array, may be memory mapped
+    :return: path of the cached file
+    """
+    def blocks():
+        for i in range(0, dem.shape[0], DEM_CHUNK_ROWS):
+            yield np.ascontiguousarray(dem[i:i + DEM_CHUNK_ROWS], dtype='<f8').tobytes()
+
+    with utils.timing.span('maket.hash_dem'):
+        h = hashlib.sha1(str(tuple(dem.shape)).encode('utf-8'))
+        for block in blocks():
+            h.update(block)
+    cached = utils.general.create_path(utils.general.cache_dir('dem'), h.hexdigest() + '.bin')
+
+    if not os.path.exists(cached):
+        # concurrent writers of the same DEM write the same bytes, the last replace wins
+        part = cached + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+        with utils.timing.span('file.write', path=cached), open(part, 'wb') as f:
+            for block in blocks():
+                f.write(block)
+        os.replace(part, cached)
+    return cached
+
+
+def load_cached_dem(cached, shape):
+    """
+    :param cached: path returned by cache_dem
+    :param shape: shape of the DEM
+    :return: memory mapped DEM
+    """
+    return np.memmap(cached, dtype='<f8', mode='r', shape=tuple(shape))
+
+
+def write_dem(dem, directory, file_name=DEM_FILE):
+    """
+    Write a DEM as raw little endian doubles. The file is written once per content to the dartpy cache and hard linked
+    (copied across filesystems) into directory, so simulations sharing the terrain share the file.
+
+    :param dem: 2d array, may be memory mapped
+    :param directory: simulation input directory
+    :param file_name:
+    :return: file_name
+    """
+    cached = cache_dem(dem)
+    os.makedirs(directory, exist_ok=True)
+    archive.copy(cached, utils.general.create_path(directory, file_name), link=True)
+    return file_name
+
 
 class Atmosphere(Component):
     COMPONENT_NAME = 'Atmosphere'
     COMPONENT_FILE_NAME = 'atmosphere.xml'
+    CONFIG_KEY = 'atmosphere'
     IMPLEMENTED_WRITE_VERSION = ['5.7.5', '5.6.0']
 
-    def _check_params(self, params):
-        # TODO: implement proper checks on type and consistency in params, should depend on self.version
-        return True
+    def transfer_functions_file(self, params=None):
+        """
+        Absolute path of general.transferFunctionsFile, relative paths are relative to the final simulation directory
+        (not the scratch space the xml may be written to).
+
+        :param params: defaults to the written params
+        :return:
+        """
+        file_name = self._get('general.transferFunctionsFile', params)
+        if not file_name:
+            raise Exception('atmosphere.general.transferFunctionsFile must be set to write the transfer functions.')
+        simulation_dir = getattr(self, 'target_dir', None) or self.simulation_dir
+        return utils.general.create_path(os.path.abspath(simulation_dir), file_name)
 
     def _write560(self, params, *args, **kwargs):
         self._written_params = params
@@ -1110,8 +1409,14 @@ class Atmosphere(Component):
         self._set_path(atmosphere_transfer_functions, 'inputOutputTransfertFunctions',
                        'general.inputOutputTransfertFunctions')
 
-        computed_transfer_functions = et.SubElement(atmosphere_transfer_functions, 'ComputedTransferFunctions')
-        self._set_path(computed_transfer_functions, 'writeTransferFunctions', 'general.writeTransferFunctions')
+        if str(self._get('general.inputOutputTransfertFunctions')) == '1':
+            imported_transfer_functions = et.SubElement(atmosphere_transfer_functions, 'ImportedTransferFunctions')
+            self._set_path(imported_transfer_functions, 'transferFunctionsFile', 'general.transferFunctionsFile')
+        else:
+            computed_transfer_functions = et.SubElement(atmosphere_transfer_functions, 'ComputedTransferFunctions')
+            self._set_path(computed_transfer_functions, 'writeTransferFunctions', 'general.writeTransferFunctions')
+            if str(self._get('general.writeTransferFunctions')) == '1':
+                self._set(computed_transfer_functions, 'transferFunctionsFile', self.transfer_functions_file())
 
         atmosphere_products = et.SubElement(atmosphere_iterations, 'AtmosphereProducts')
         self._set_path(atmosphere_products, 'atmosphereBRF_TOA', 'products.atmosphereBRF_TOA')
@@ -1223,8 +1528,14 @@ class Atmosphere(Component):
         self._set_path(atmosphere_transfer_functions, 'inputOutputTransfertFunctions',
                        'general.inputOutputTransfertFunctions')
 
-        computed_transfer_functions = et.SubElement(atmosphere_transfer_functions, 'ComputedTransferFunctions')
-        self._set_path(computed_transfer_functions, 'writeTransferFunctions', 'general.writeTransferFunctions')
+        if str(self._get('general.inputOutputTransfertFunctions')) == '1':
+            imported_transfer_functions = et.SubElement(atmosphere_transfer_functions, 'ImportedTransferFunctions')
+            self._set_path(imported_transfer_functions, 'transferFunctionsFile', 'general.transferFunctionsFile')
+        else:
+            computed_transfer_functions = et.SubElement(atmosphere_transfer_functions, 'ComputedTransferFunctions')
+            self._set_path(computed_transfer_functions, 'writeTransferFunctions', 'general.writeTransferFunctions')
+            if str(self._get('general.writeTransferFunctions')) == '1':
+                self._set(computed_transfer_functions, 'transferFunctionsFile', self.transfer_functions_file())
 
         atmosphere_products = et.SubElement(atmosphere_iterations, 'AtmosphereProducts')
         self._set_path(atmosphere_products, 'atmosphereBRF_TOA', 'products.atmosphereBRF_TOA')
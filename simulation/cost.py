@@ -0,0 +1,192 @@
+"""
+Runtime cost model for DART simulations, used to schedule batch runs longest job first.
+
+The predicted runtime is a power law of config features:
+
+    cost = exp(b_0) * prod_i feature_i ** b_i
+
+The exponents start at DEFAULT_EXPONENTS and are refined by least squares in log space from recorded durations.
+"""
+import heapq
+import json
+import logging
+import math
+import os
+
+import utils.general
+from . import archive
+
+toml = utils.general.lazy_import('toml')
+
+COST_MODEL_FILE = 'dartpy_cost_model.json'
+
+FEATURES = ['cells', 'bands', 'directions', 'subcenters', 'iterations', 'meshes']
+DEFAULT_EXPONENTS = {'cells': 1., 'bands': 1., 'directions': 1., 'subcenters': 1., 'iterations': 1., 'meshes': 1.}
+
+# exponents are pulled towards the defaults, so that a few observations do not produce wild models
+REGULARIZATION = 1.
+
+
+def features(config):
+    """
+    Cost relevant features of a simulation config.
+
+    :param config: full simulation config dict
+    :return: dict feature -> positive float
+    """
+    get = lambda path, default: _get(config, path, default)
+
+    scene = get('maket.sceneDim', [1, 1, 1])
+    voxel = get('maket.voxelDim', [1, 1, 1])
+    cells = 1.
+    for i in range(2):
+        try:
+            cells *= max(float(scene[i]) / float(voxel[i]), 1.)
+        except (IndexError, TypeError, ValueError, ZeroDivisionError):
+            pass
+
+    mesh = get('object3d.importObject3d', False) and get('object3d.path2obj', None)
+    return {'cells': cells,
+            'bands': max(len(get('phase.spectral.meanLambda', [0])), 1),
+            'directions': max(float(get('directions.numberOfPropagationDirections', 1)), 1.),
+            'subcenters': max(float(get('phase.expert_flux_tracking.nbSubcenterIllumination', 1)) ** 2, 1.),
+            'iterations': max(float(get('phase.flux_tracking.numberOfIteration', 1)), 1.),
+            # triangle meshes make every ray-voxel interception more expensive
+            'meshes': 2. if mesh else 1.}
+
+
+def _get(config, path, default):
+    node = config
+    for key in path.split('.'):
+        if not isinstance(node, dict) or key not in node:
+            return default
+        node = node[key]
+    return node
+
+
+class CostModel(object):
+    def __init__(self, exponents=None, intercept=0., observations=None):
+        self.exponents = dict(DEFAULT_EXPONENTS)
+        if exponents is not None:
+            self.exponents.update(exponents)
+        self.intercept = intercept
+        self.observations = observations if observations is not None else []
+
+    def predict(self, config=None, feature_values=None):
+        """
+        Predicted runtime in seconds (up to the accuracy of the model).
+
+        :param config: simulation config dict
+        :param feature_values: precomputed features(config)
+        :return:
+        """
+        if feature_values is None:
+            feature_values = features(config)
+        return math.exp(self.intercept + sum(self.exponents[f] * math.log(feature_values[f]) for f in FEATURES))
+
+    def observe(self, feature_values, duration):
+        if duration is not None and duration > 0:
+            self.observations.append((feature_values, duration))
+
+    def fit(self):
+        """
+        Refit intercept and exponents to the observations by ridge regression in log space.
+
+        :return: self
+        """
+        if not self.observations:
+            return self
+
+        n = len(FEATURES) + 1
+        prior = [0.] + [DEFAULT_EXPONENTS[f] for f in FEATURES]
+        ata = [[REGULARIZATION if i == j and i > 0 else 0. for j in range(n)] for i in range(n)]
+        aty = [REGULARIZATION * prior[i] if i > 0 else 0. for i in range(n)]
+
+        for feature_values, duration in self.observations:
+            row = [1.] + [math.log(feature_values[f]) for f in FEATURES]
+            y = math.log(duration)
+            for i in range(n):
+                aty[i] += row[i] * y
+                for j in range(n):
+                    ata[i][j] += row[i] * row[j]
+
+        solution = _solve(ata, aty)
+        self.intercept = solution[0]
+        self.exponents = dict(zip(FEATURES, solution[1:]))
+        return self
+
+    def refine(self, ledger, sweep=None):
+        """
+        Add the durations of all successful runs recorded in a job ledger and refit.
+
+        :param ledger (JobLedger):
+        :param sweep:
+        :return: self
+        """
+        from .simulation import CONFIG_FILE_NAME
+
+        seen = set(tuple(sorted(f.items())) + (d,) for f, d in self.observations)
+        for job in ledger.jobs(sweep=sweep, state='done'):
+            config_path = utils.general.create_path(job['path'], CONFIG_FILE_NAME)
+            if not archive.exists(config_path):
+                continue
+            feature_values = features(toml.loads(archive.read_text(config_path), _dict=dict))
+            if tuple(sorted(feature_values.items())) + (job['duration'],) not in seen:
+                self.observe(feature_values, job['duration'])
+        return self.fit()
+
+    @classmethod
+    def load(cls, simulation_location):
+        path = utils.general.create_path(simulation_location, COST_MODEL_FILE)
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            state = json.load(f)
+        return cls(state['exponents'], state['intercept'], [tuple(o) for o in state['observations']])
+
+    def save(self, simulation_location):
+        path = utils.general.create_path(simulation_location, COST_MODEL_FILE)
+        with open(path, 'w') as f:
+            json.dump({'exponents': self.exponents, 'intercept': self.intercept,
+                       'observations': self.observations}, f)
+
+
+def _solve(a, b):
+    """
+    Solve the linear system a x = b by Gaussian elimination with partial pivoting.
+    """
+    n = len(b)
+    m = [list(a[i]) + [b[i]] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+        if abs(m[pivot][col]) < 1e-12:
+            logging.warning('Cost model fit is singular, keeping default exponents')
+            return [0.] + [DEFAULT_EXPONENTS[f] for f in FEATURES]
+        m[col], m[pivot] = m[pivot], m[col]
+        for r in range(col + 1, n):
+            factor = m[r][col] / m[col][col]
+            for c in range(col, n + 1):
+                m[r][c] -= factor * m[col][c]
+
+    x = [0.] * n
+    for r in reversed(range(n)):
+        x[r] = (m[r][n] - sum(m[r][c] * x[c] for c in range(r + 1, n))) / m[r][r]
+    return x
+
+
+def lpt_schedule(costs, slots):
+    """
+    Longest processing time first bin packing: assign jobs in descending cost order to the least loaded slot.
+
+    :param costs: dict job -> cost
+    :param slots: number of concurrent slots (CPU cores / DART threads per job)
+    :return: (list of job lists per slot, makespan)
+    """
+    slots = max(int(slots), 1)
+    heap = [(0., i) for i in range(slots)]
+    assignment = [[] for _ in range(slots)]
+    for job in sorted(costs, key=costs.get, reverse=True):
+        load, i = heapq.heappop(heap)
+        assignment[i].append(job)
+        heapq.heappush(heap, (load + costs[job], i))
+    return assignment, max(load for load, _ in heap)
@@ -0,0 +1,286 @@
+"""
+Long running dartpy daemon keeping its caches warm.
+
+Every short lived script pays for the imports, parsing the default configs and schemas and parsing the base simulations
+again. The daemon does this once and serves requests over a local socket (a Unix domain socket or a localhost TCP
+port), so a scheduler can submit thousands of small requests at a few milliseconds each:
+
+    python -m simulation.cli daemon --socket /tmp/dartpy.sock
+
+    from simulation import daemon
+    client = daemon.Client('/tmp/dartpy.sock')
+    path = client.request(op='create', config={'directions': {...}}, simulation_location='/data/sims')['path']
+
+Messages are newline delimited JSON objects as in simulation.distributed, every request is answered by exactly one
+response. Failed requests are answered with {"error": message}:
+
+    {"op": "ping"}                                                  -> {"pid": p, "uptime": s, "requests": n}
+    {"op": "validate", "config": c, "version": v}                   -> {"errors": [...]}
+    {"op": "create", "config": c, "pack": b, ...Simulation kwargs}  -> {"path": p}
+    {"op": "derive", "base_path": b, "patches": [...], "pack": b, ...bulk_from_simulation kwargs}  -> {"paths": [...]}
+    {"op": "run", "path": p}                                        -> {"status": {...}}
+    {"op": "shutdown"}                                              -> {"ok": true}
+
+Anyone who can connect may send requests (a TCP port is open to all local users), so requests cannot choose what is
+executed: runs always use the dart_path the daemon was started with (never the one of a simulation config), a
+dart_path in a request is rejected.
+Simulations are only created in and run from directories below the roots of the daemon.
+
+Configs are config dicts or paths to config files as in Simulation. Simulation names get a unique suffix
+(simulation_name_<8 hex digits>_<time>), so requests arriving within the same second do not share a directory. Requests
+are handled concurrently, one thread per connection.
+"""
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+import uuid
+
+import utils.general
+import utils.timing
+from . import run
+from . import schema
+from . import simulation as simul
+
+DEFAULT_SOCKET = '/tmp/dartpy.sock'
+
+# modules imported lazily everywhere else, imported on start
+WARM_MODULES = ['lxml.etree', 'toml', 'dill']
+
+# message keys handled by the daemon itself, all others are passed on to Simulation or bulk_from_simulation
+_RESERVED = ['op', 'pack', 'parallel']
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.daemon.handle(json.loads(line.decode('utf-8')))
+            except Exception as e:
+                logging.exception('Daemon could not handle request')
+                response = {'error': str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class Daemon(object):
+    def __init__(self, socket_path=DEFAULT_SOCKET, port=None, versions=('5.7.5',), dart_path=None, staging=None,
+                 roots=None):
+        """
+        :param socket_path: Unix domain socket to listen on, ignored if port is given
+        :param port: listen on this localhost TCP port instead, 0 picks a free port, see self.address
+        :param versions: DART versions whose default configs and schemas are loaded on start
+        :param dart_path: DART launcher for run requests, run requests are refused without it
+        :param staging (Staging): write and run simulations on local scratch space
+        :param roots (list of str): directories simulations may be created in and run from, defaults to the working
+                                    directory
+        """
+        self.versions = list(versions)
+        self.staging = staging
+        self.dart_path = dart_path
+        self.roots = [os.path.realpath(r) for r in (roots or [os.getcwd()])]
+        self.runner = run.SimulationRunner(dart_path=dart_path, staging=staging)
+        self.started = time.time()
+        self.requests = 0
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        if port is None:
+            if os.path.exists(socket_path):
+                _remove_stale(socket_path)
+            self._server = _UnixServer(socket_path, _Handler)
+        else:
+            self._server = _TCPServer(('127.0.0.1', port), _Handler)
+        self._server.daemon = self
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def warm(self):
+        """
+        Import the heavy modules and parse the default configs and schemas of self.versions.
+
+        :return:
+        """
+        with utils.timing.span('daemon.warm', versions=self.versions):
+            for module in WARM_MODULES:
+                __import__(module)
+            for version in self.versions:
+                path = simul.default_config_path(version)
+                if path is not None:
+                    simul.load_config(path)
+                    schema.for_version(version)
+
+    def handle(self, message):
+        with self._lock:
+            self.requests += 1
+
+        op = message.get('op')
+        if op == 'ping':
+            return {'pid': os.getpid(), 'uptime': time.time() - self.started, 'requests': self.requests}
+        elif op == 'validate':
+            return {'errors': self._validate(message)}
+        elif op == 'create':
+            return {'path': self._create(message)}
+        elif op == 'derive':
+            return {'paths': self._derive(message)}
+        elif op == 'run':
+            return {'status': self._run(message)}
+        elif op == 'shutdown':
+            self.stop()
+            return {'ok': True}
+        raise Exception('Unknown operation ' + str(op))
+
+    def _validate(self, message):
+        config = message.get('config') or {}
+        if type(config) is str:
+            config = simul.load_config(config)
+        version = message.get('version', config.get('version', '5.7.5'))
+        version_schema = schema.for_version(version)
+        if version_schema is None:
+            return []
+        return version_schema.validate(simul.Simulation._patch_configs(
+            simul.load_config(simul.default_config_path(version)), config, ignore=[None]))
+
+    def _create(self, message):
+        kwargs = _unique(self._checked(message))
+        sim = simul.Simulation(kwargs.pop('config', None), **kwargs)
+        sim.to_file(staging=self.staging, parallel=message.get('parallel', 1), pack=message.get('pack', False))
+        return sim.path
+
+    def _derive(self, message):
+        kwargs = _unique(self._checked(message))
+        self._check_root(kwargs['base_path'])
+        sims = simul.Simulation.bulk_from_simulation(kwargs.pop('base_path'), kwargs.pop('patches'), **kwargs)
+        for sim in sims:
+            sim.to_file(staging=self.staging, parallel=message.get('parallel', 1), pack=message.get('pack', False))
+        return [sim.path for sim in sims]
+
+    def _run(self, message):
+        if self.dart_path is None:
+            raise Exception('The daemon was started without a dart_path, it does not run simulations.')
+        if 'dart_path' in message:
+            raise Exception('Run requests cannot choose the dart_path, the daemon runs ' + self.dart_path)
+        return self.runner._dart_run(self._check_root(message['path']))
+
+    def _checked(self, message):
+        """
+        Simulation kwargs of a create or derive request, with the simulation location checked against self.roots.
+        """
+        kwargs = _kwargs(message)
+        if 'dart_path' in kwargs:
+            raise Exception('Requests cannot set the dart_path, the daemon runs its own.')
+        self._check_root(kwargs.get('simulation_location', './test_simulations'))
+        return kwargs
+
+    def _check_root(self, path):
+        real = os.path.realpath(path)
+        if not any(os.path.commonpath([real, root]) == root for root in self.roots):
+            raise Exception(path + ' is not below the daemon roots ' + ', '.join(self.roots))
+        return path
+
+    def serve(self):
+        """
+        Serve requests until a shutdown request or stop.
+
+        :return:
+        """
+        self.warm()
+        thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        thread.start()
+        logging.info('dartpy daemon listening on ' + str(self.address))
+        try:
+            self._stop.wait()
+        finally:
+            self._server.shutdown()
+            self._server.server_close()
+            self.runner.wait_postprocessing()
+            if self.runner.postprocessor is not None:
+                self.runner.postprocessor.shutdown()
+            if isinstance(self._server, _UnixServer) and os.path.exists(self.address):
+                os.remove(self.address)
+
+    def stop(self):
+        self._stop.set()
+
+
+def _remove_stale(socket_path):
+    """
+    Remove a socket left over by a daemon that did not shut down cleanly.
+
+    :param socket_path:
+    :return:
+    """
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return
+    finally:
+        probe.close()
+    raise Exception('A daemon is already listening on ' + socket_path)
+
+
+def _kwargs(message):
+    return dict((k, v) for k, v in message.items() if k not in _RESERVED)
+
+
+def _unique(kwargs):
+    # simulation directories are only named by time to the second
+    kwargs['simulation_name'] = kwargs.get('simulation_name', 'new') + '_' + uuid.uuid4().hex[:8]
+    return kwargs
+
+
+class Client(object):
+    def __init__(self, address=DEFAULT_SOCKET, timeout=None):
+        """
+        :param address: Unix socket path of the daemon or (host, port)
+        :param timeout: seconds to wait for a response, None waits forever (runs may take long)
+        """
+        if type(address) is str:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.settimeout(timeout)
+            self._socket.connect(address)
+        else:
+            self._socket = socket.create_connection(tuple(address), timeout=timeout)
+        self._file = self._socket.makefile('rwb')
+        self._lock = threading.Lock()
+
+    def request(self, **message):
+        with self._lock:
+            self._file.write((json.dumps(message) + '\n').encode('utf-8'))
+            self._file.flush()
+            line = self._file.readline()
+        if not line:
+            raise ConnectionError('Daemon closed the connection')
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise Exception('Daemon error: ' + response['error'])
+        return response
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,223 @@
+"""
+Read only access to the DART optical property databases (Lambertian.db, Vegetation.db, Roughness.db, ...).
+
+Every model of a database is a table named by its ModelName holding the spectrum (wavelength and the optical
+properties as columns), the optional _comment table describes the models. The model names of a database are indexed
+once per database file version, connections are pooled per database and opened read only:
+
+    databases = database.for_directories(['/opt/DART/database', '~/dart_user/database'])
+    databases.models('Lambertian.db')                       # frozenset of model names
+    databases.check(config['coeff_diff'])                   # errors for models that do not exist
+    databases.spectrum('Vegetation.db', 'leaf_top')         # dict column -> numpy array, e.g. for postprocessing
+
+The directories are searched in order, DART_DATABASE (os.pathsep separated) and the database directory of a DART
+installation are used by default, see default_directories.
+"""
+import functools
+import os
+import queue
+import sqlite3
+import threading
+import urllib.parse
+from contextlib import contextmanager
+
+import utils.general
+import utils.timing
+
+np = utils.general.lazy_import('numpy')
+
+DATABASE_ENV = 'DART_DATABASE'
+DATABASE_DIR = 'database'
+
+# how many directories above dart_path the database directory of the installation may be
+MAX_DEPTH = 4
+
+
+def default_directories(dart_path=None):
+    """
+    :param dart_path: DART launcher, its installation is searched for a database directory
+    :return: list of database directories
+    """
+    directories = [d for d in os.environ.get(DATABASE_ENV, '').split(os.pathsep) if d]
+    if dart_path:
+        directory = os.path.abspath(os.path.expanduser(dart_path))
+        for _ in range(MAX_DEPTH):
+            directory = os.path.dirname(directory)
+            if os.path.isdir(os.path.join(directory, DATABASE_DIR)):
+                directories.append(os.path.join(directory, DATABASE_DIR))
+                break
+    return directories
+
+
+@functools.lru_cache(maxsize=8)
+def _for_directories(directories, pool_size):
+    return OpticalDatabases(list(directories), pool_size=pool_size)
+
+
+def for_directories(directories, pool_size=4):
+    """
+    Databases shared by all callers with the same directories, so the model indices and connections are reused.
+
+    :param directories: database directories, searched in order
+    :param pool_size: connections per database
+    :return: OpticalDatabases
+    """
+    return _for_directories(tuple(os.path.abspath(os.path.expanduser(d)) for d in directories), pool_size)
+
+
+class _Pool(object):
+    """
+    Read only connections to one database, at most size of them are open.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                connect = self._opened < self.size
+                if connect:
+                    self._opened += 1
+            connection = self._connect() if connect else self._idle.get()
+        try:
+            yield connection
+        finally:
+            self._idle.put(connection)
+
+    def _connect(self):
+        uri = 'file:' + urllib.parse.quote(self.path) + '?mode=ro'
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._opened = 0
+
+
+class OpticalDatabases(object):
+    def __init__(self, directories, pool_size=4):
+        """
+        :param directories: database directories, searched in order
+        :param pool_size: connections per database
+        """
+        self.directories = [os.path.expanduser(d) for d in directories]
+        self.pool_size = pool_size
+        self._pools = {}
+        self._indices = {}
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        """
+        :param name: database file name, e.g. 'Lambertian.db'
+        :return: path of the database, None if it is in none of the directories
+        """
+        for directory in self.directories:
+            path = utils.general.create_path(directory, name)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def models(self, name):
+        """
+        :param name: database file name
+        :return: frozenset of the model names in the database
+        """
+        path = self._path(name)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        index = self._indices.get(path)
+        if index is None or index[0] != version:
+            with utils.timing.span('database.index', path=path), self._pool(path).connection() as connection:
+                tables = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+            index = (version, frozenset(t[0] for t in tables if not t[0].startswith(('_', 'sqlite_'))))
+            self._indices[path] = index
+        return index[1]
+
+    def descriptions(self, name):
+        """
+        :param name: database file name
+        :return: dict model name -> description of the _comment table, empty if there is none
+        """
+        with self._pool(self._path(name)).connection() as connection:
+            try:
+                return dict(connection.execute('SELECT name, description FROM _comment').fetchall())
+            except sqlite3.OperationalError:
+                return {}
+
+    def spectrum(self, name, model):
+        """
+        :param name: database file name
+        :param model: model name
+        :return: dict column name -> numpy array, rows ordered by the first column (the wavelength)
+        """
+        if model not in self.models(name):
+            raise Exception('Model ' + str(model) + ' is not in ' + name)
+        with self._pool(self._path(name)).connection() as connection:
+            # model is one of the indexed table names, quoting it is safe
+            cursor = connection.execute('SELECT * FROM "' + model.replace('"', '""') + '"')
+            columns = [c[0] for c in cursor.description]
+            rows = cursor.fetchall()
+        rows.sort(key=lambda row: row[0])
+        return dict((column, np.array([row[i] for row in rows])) for i, column in enumerate(columns))
+
+    def check(self, coeff_diff, path='coeff_diff'):
+        """
+        Check that the models of all coeff_diff entries exist.
+
+        :param coeff_diff: coeff_diff params
+        :param path: config path of coeff_diff in the messages
+        :return: list of error messages
+        """
+        errors = []
+        for kind in ['lop2d', 'lop3d']:
+            models = ((coeff_diff or {}).get(kind) or {}).get('model') or []
+            for i, model in enumerate(models):
+                prefix = path + '.' + kind + '.model[' + str(i) + '].'
+                links = [('databaseName', 'ModelName')]
+                if str(model.get('useSpecular')) == '1' and 'specularDatabaseName' in model:
+                    links.append(('specularDatabaseName', 'specularModelName'))
+                for database_key, model_key in links:
+                    message = self._missing(model.get(database_key), model.get(model_key))
+                    if message is not None:
+                        errors.append(prefix + model_key + ' = ' + repr(model.get(model_key)) + ': ' + message)
+        return errors
+
+    def _missing(self, name, model):
+        if name is None:
+            return None
+        if self.path(name) is None:
+            return 'database ' + name + ' not found in ' + ', '.join(self.directories)
+        if model not in self.models(name):
+            return 'not in ' + name
+        return None
+
+    def _path(self, name):
+        path = self.path(name)
+        if path is None:
+            raise Exception('Database ' + name + ' not found in ' + ', '.join(self.directories))
+        return path
+
+    def _pool(self, path):
+        with self._lock:
+            pool = self._pools.get(path)
+            if pool is None:
+                pool = self._pools[path] = _Pool(path, self.pool_size)
+            return pool
+
+    def close(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools = {}
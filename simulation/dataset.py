@@ -0,0 +1,329 @@
+"""
+Lazy labelled view of the outputs of all simulations of a simulation_location.
+
+The images of the finished runs recorded in the ledger are opened as one array with the dimensions simulation, band,
+direction, y and x without loading any simulation object or output. Selections only narrow the view, values are read
+when asked for, image by image with memory maps (or streamed up to the last selected row if the output was compressed
+by a retention policy):
+
+    ds = dataset.for_location('/data/sims', sweep='lai_sun')
+    ds.parameters                                       # dict swept parameter -> value of every simulation
+    red = ds.sel(band=0.665, **{'directions.sun.sunViewingZenithAngle': 30.})
+    red.isel(y=slice(0, 100)).mean(['y', 'x'])          # reads 100 rows of the selected images only
+    ds.isel(simulation=0, band=0, direction=0).values  # one image
+
+Dimensions: simulation (labelled by the swept parameters), band (central wavelength in micrometer, or the sensor bands
+of simulation.sensor with sensor='<name>'), direction (the image files, labelled by their view zenith and azimuth),
+y and x (pixels). The band and direction labels and the image shape are taken from the first simulation, all
+simulations are expected to share them. Missing images read as NaN.
+"""
+import json
+import os
+import re
+
+import utils.general
+from . import ledger
+from .postprocessing import COMPRESSED_SUFFIX, open_output, read_config
+from .sensor import BANDS_FILE, IMAGE_DTYPE, SENSOR_PREFIX
+
+np = utils.general.lazy_import('numpy')
+
+OUTPUT_DIR = 'output'
+DEFAULT_PRODUCT = 'BRF/ITERX/IMAGES_DART'
+IMAGE_SUFFIX = '.mp#'
+DIMS = ('simulation', 'band', 'direction', 'y', 'x')
+
+_DIRECTION = re.compile(r'VZ=(\d+)_(\d+)_VA=(\d+)_(\d+)')
+
+
+def for_location(simulation_location, sweep=None, product=DEFAULT_PRODUCT, sensor=None, shape=None):
+    """
+    :param simulation_location: directory holding the simulations and their ledger
+    :param sweep: only the simulations of this sweep
+    :param product: directory of the images, relative to output/BAND<i>
+    :param sensor: open the sensor bands written by simulation.sensor with this sensor name instead
+    :param shape: (y, x) pixels of the images, inferred from maket.sceneDim and maket.voxelDim by default
+    :return: Dataset
+    """
+    jobs = ledger.JobLedger(simulation_location).jobs(sweep=sweep, state=ledger.DONE)
+    if not jobs:
+        raise Exception('No finished simulations in ' + simulation_location)
+    paths = [job['path'] for job in jobs]
+    config = read_config(paths[0])
+
+    root = OUTPUT_DIR if sensor is None else utils.general.create_path(OUTPUT_DIR, SENSOR_PREFIX + sensor)
+    if sensor is None:
+        bands = np.array([float(v) for v in config['phase']['spectral']['meanLambda']])
+    else:
+        with open(utils.general.create_path(paths[0], root, BANDS_FILE)) as f:
+            bands = np.array([band['centre'] for band in json.load(f)['bands']])
+
+    directory = utils.general.create_path(paths[0], root, 'BAND0', product)
+    images = _images(directory)
+    if not images:
+        raise Exception('No images in ' + directory)
+    if shape is None:
+        first = utils.general.create_path(directory, images[0])
+        pixels = os.path.getsize(first) // np.dtype(IMAGE_DTYPE).itemsize if os.path.exists(first) else None
+        shape = _shape(config, pixels)
+
+    names = sorted(set(k for job in jobs for k in (job.get('parameters') or {})))
+    parameters = dict((k, [(job.get('parameters') or {}).get(k) for job in jobs]) for k in names)
+    directions = [_direction(image) for image in images]
+    coords = {'simulation': [job['name'] for job in jobs], 'band': bands, 'direction': images,
+              'zenith': np.array([d[0] for d in directions]), 'azimuth': np.array([d[1] for d in directions]),
+              'y': np.arange(shape[0]), 'x': np.arange(shape[1])}
+    return Dataset(paths, root, product, coords, parameters)
+
+
+class Dataset(object):
+    def __init__(self, paths, root, product, coords, parameters, index=None, dropped=()):
+        """
+        Use for_location. A Dataset is a view, selections return new views of the same files.
+
+        :param paths: simulation directories
+        :param root: directory of the band directories, relative to each simulation
+        :param product: directory of the images, relative to each band directory
+        :param coords: dict with the labels of all positions of each dimension
+        :param parameters: dict swept parameter -> value of each simulation
+        :param index: dict dimension -> array of the selected positions, all by default
+        :param dropped: dimensions selected by a single position, not part of the shape
+        """
+        self.paths = paths
+        self.root = root
+        self.product = product
+        self.coords = coords
+        self._parameters = parameters
+        self.index = index or dict((dim, np.arange(len(coords[dim]))) for dim in DIMS)
+        self.dropped = tuple(dropped)
+
+    @property
+    def dims(self):
+        return tuple(dim for dim in DIMS if dim not in self.dropped)
+
+    @property
+    def shape(self):
+        return tuple(len(self.index[dim]) for dim in self.dims)
+
+    @property
+    def parameters(self):
+        """
+        :return: dict swept parameter -> values of the selected simulations
+        """
+        return dict((k, [v[i] for i in self.index['simulation']]) for k, v in self._parameters.items())
+
+    def labels(self, dim):
+        """
+        :param dim:
+        :return: labels of the selected positions of dim
+        """
+        labels, index = self.coords[dim], self._selected(dim)
+        return [labels[i] for i in index] if type(labels) is list else labels[index]
+
+    def isel(self, **positions):
+        """
+        Select by position: an int drops the dimension, a slice or list of ints keeps it.
+
+        :param positions: dimension -> position(s) relative to the current view
+        :return: Dataset
+        """
+        index, dropped = dict(self.index), list(self.dropped)
+        for dim, position in positions.items():
+            if dim not in self.dims:
+                raise Exception('Unknown dimension ' + dim + ', dimensions are ' + ', '.join(self.dims))
+            if isinstance(position, (int, np.integer)):
+                index[dim] = self.index[dim][[position]]
+                dropped.append(dim)
+            else:
+                index[dim] = self.index[dim][position]
+        return Dataset(self.paths, self.root, self.product, self.coords, self._parameters, index, dropped)
+
+    def sel(self, **labels):
+        """
+        Select by label: band by the nearest wavelength, direction by image name or (zenith, azimuth), simulation by
+        name. Swept parameters select all simulations with that value (a list selects any of the values).
+
+        :param labels: dimension or swept parameter -> label(s)
+        :return: Dataset
+        """
+        view = self
+        for key, label in labels.items():
+            if key in self._parameters:
+                accepted = label if type(label) is list else [label]
+                selected = [i for i, v in enumerate(view.parameters[key]) if v in accepted]
+                if not selected:
+                    raise Exception('No simulation with ' + key + ' = ' + str(label))
+                view = view.isel(simulation=selected)
+            elif key in ('simulation', 'band', 'direction'):
+                position = [view._position(key, l) for l in label] if type(label) is list else \
+                    view._position(key, label)
+                view = view.isel(**{key: position})
+            else:
+                raise Exception('Unknown dimension or swept parameter ' + key)
+        return view
+
+    def _position(self, dim, label):
+        labels = self.labels(dim)
+        if dim == 'band':
+            return int(np.argmin(abs(np.asarray(labels) - float(label))))
+        if dim == 'direction' and type(label) is tuple:
+            zenith, azimuth = self.labels('zenith'), self.labels('azimuth')
+            matches = np.flatnonzero((zenith == label[0]) & (azimuth == label[1]))
+            if not len(matches):
+                raise Exception('No image with view direction ' + str(label))
+            return int(matches[0])
+        if label not in labels:
+            raise Exception('Unknown ' + dim + ' ' + str(label))
+        return list(labels).index(label)
+
+    def _selected(self, dim):
+        # positions of the direction coordinates follow the direction dimension
+        return self.index['direction' if dim in ('zenith', 'azimuth') else dim]
+
+    @property
+    def values(self):
+        """
+        :return: numpy array of the selected values, read image by image
+        """
+        result = np.empty(tuple(len(self.index[dim]) for dim in DIMS))
+        for (s, b, d), image in self._images():
+            result[s, b, d] = image
+        return self._squeeze(result)
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.values
+        return values if dtype is None else values.astype(dtype)
+
+    def sum(self, dims=None):
+        return self._reduce(np.add, dims)
+
+    def min(self, dims=None):
+        return self._reduce(np.minimum, dims)
+
+    def max(self, dims=None):
+        return self._reduce(np.maximum, dims)
+
+    def mean(self, dims=None):
+        dims = self._reduced(dims)
+        count = int(np.prod([len(self.index[dim]) for dim in dims]))
+        return self.sum(dims) / count
+
+    def _reduced(self, dims):
+        if dims is None:
+            return list(self.dims)
+        dims = [dims] if type(dims) is str else list(dims)
+        for dim in dims:
+            if dim not in self.dims:
+                raise Exception('Unknown dimension ' + dim + ', dimensions are ' + ', '.join(self.dims))
+        return dims
+
+    def _reduce(self, ufunc, dims):
+        """
+        Reduce with ufunc over dims, accumulating one image at a time.
+
+        :return: numpy array (a float if all dimensions are reduced)
+        """
+        dims = self._reduced(dims)
+        if 0 in self.shape:
+            raise Exception('Cannot reduce an empty selection ' + repr(self))
+        pixel_axes = tuple(i for i, dim in enumerate(('y', 'x')) if dim in dims)
+        shape = [1 if dim in dims else len(self.index[dim]) for dim in DIMS]
+        result = np.empty(shape)
+        seen = np.zeros(shape[:3], dtype=bool)
+        for (s, b, d), image in self._images():
+            if pixel_axes:
+                image = ufunc.reduce(image, axis=pixel_axes, keepdims=True)
+            target = tuple(0 if dim in dims else i for dim, i in zip(DIMS, (s, b, d)))
+            if seen[target]:
+                result[target] = ufunc(result[target], image)
+            else:
+                result[target] = image
+                seen[target] = True
+        result = result.squeeze(axis=tuple(i for i, dim in enumerate(DIMS) if dim in dims or dim in self.dropped))
+        return result if result.ndim else float(result)
+
+    def _squeeze(self, values):
+        return values.squeeze(axis=tuple(DIMS.index(dim) for dim in self.dropped)) if self.dropped else values
+
+    def _images(self):
+        """
+        :return: iterator of ((simulation, band, direction) positions in the view, 2d array of the selected pixels)
+        """
+        ys, xs = self.index['y'], self.index['x']
+        shape = (len(self.coords['y']), len(self.coords['x']))
+        for s, simulation in enumerate(self.index['simulation']):
+            for b, band in enumerate(self.index['band']):
+                directory = utils.general.create_path(self.paths[simulation], self.root, 'BAND' + str(band),
+                                                      self.product)
+                for d, direction in enumerate(self.index['direction']):
+                    path = utils.general.create_path(directory, self.coords['direction'][direction])
+                    yield (s, b, d), _read(path, shape, ys, xs)
+
+    def __getitem__(self, key):
+        key = key if type(key) is tuple else (key,)
+        return self.isel(**dict(zip(self.dims, key)))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return '<dartpy Dataset (' + ', '.join(dim + ': ' + str(len(self.index[dim])) for dim in self.dims) + ')>'
+
+
+def _read(path, shape, ys, xs):
+    """
+    Selected pixels of one image, NaN if it does not exist.
+    """
+    if os.path.exists(path):
+        image = np.memmap(path, dtype=IMAGE_DTYPE, mode='r', shape=shape)
+        return np.array(image[np.ix_(ys, xs)])
+    if os.path.exists(path + COMPRESSED_SUFFIX):
+        # compressed images can only be streamed, up to the last selected row
+        rows = int(ys.max()) + 1 if len(ys) else 0
+        with open_output(path) as f:
+            data = f.read(rows * shape[1] * np.dtype(IMAGE_DTYPE).itemsize)
+        return np.frombuffer(data, dtype=IMAGE_DTYPE).reshape(rows, shape[1])[np.ix_(ys, xs)]
+    return np.full((len(ys), len(xs)), np.nan)
+
+
+def _images(directory):
+    """
+    :return: sorted names of the images in directory, compressed images by their original name
+    """
+    if not os.path.isdir(directory):
+        return []
+    names = set()
+    for name in os.listdir(directory):
+        if name.endswith(COMPRESSED_SUFFIX):
+            name = name[:-len(COMPRESSED_SUFFIX)]
+        if name.endswith(IMAGE_SUFFIX):
+            names.add(name)
+    return sorted(names)
+
+
+def _direction(image):
+    """
+    :param image: image file name, e.g. ima01_VZ=030_0_VA=090_0.mp#
+    :return: (zenith, azimuth) in degrees, NaN if the name holds none
+    """
+    match = _DIRECTION.search(image)
+    if match is None:
+        return float('nan'), float('nan')
+    return float(match.group(1) + '.' + match.group(2)), float(match.group(3) + '.' + match.group(4))
+
+
+def _shape(config, pixels):
+    """
+    :param config: simulation config
+    :param pixels: number of pixels of an image, None if unknown
+    :return: (y, x) shape of the images
+    """
+    maket = config.get('maket') or {}
+    if maket.get('sceneDim') and maket.get('voxelDim'):
+        shape = (int(round(float(maket['sceneDim'][1]) / float(maket['voxelDim'][1]))),
+                 int(round(float(maket['sceneDim'][0]) / float(maket['voxelDim'][0]))))
+        if pixels is None or shape[0] * shape[1] == pixels:
+            return shape
+    if pixels is not None and int(round(pixels ** 0.5)) ** 2 == pixels:
+        return int(round(pixels ** 0.5)), int(round(pixels ** 0.5))
+    raise Exception('Cannot infer the image shape of ' + str(pixels) + ' pixels, pass shape=(y, x).')
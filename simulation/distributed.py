@@ -0,0 +1,251 @@
+"""
+Coordinator/worker execution over plain TCP.
+
+The coordinator owns the job ledger and hands out jobs. Workers on other nodes that share the simulation filesystem
+claim jobs, run DART and report status and timings back. Running jobs are kept alive by heartbeats; jobs of workers
+that stop sending heartbeats are requeued.
+
+Messages are newline delimited JSON objects, every request is answered by exactly one response:
+
+    {"op": "claim", "worker": w}                           -> {"job": {...} or null, "finished": bool}
+    {"op": "heartbeat", "worker": w, "name": n}            -> {"ok": bool}
+    {"op": "report", "worker": w, "name": n, "exit_code": c, "duration": d, "error": e}  -> {"ok": bool}
+"""
+import json
+import logging
+import socket
+import socketserver
+import threading
+import time
+
+from . import ledger as jl
+from . import run
+
+DEFAULT_PORT = 7305
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.coordinator.handle(json.loads(line.decode('utf-8')))
+            except Exception as e:
+                logging.exception('Coordinator could not handle request')
+                response = {'error': str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class Coordinator(object):
+    def __init__(self, ledger, sweep=None, host='0.0.0.0', port=DEFAULT_PORT, heartbeat_timeout=30.,
+                 max_attempts=3):
+        """
+        :param ledger (JobLedger): ledger the jobs are claimed from
+        :param sweep: only hand out jobs of this sweep
+        :param host:
+        :param port: 0 picks a free port, see self.address
+        :param heartbeat_timeout: seconds without heartbeat after which a running job is requeued
+        :param max_attempts:
+        """
+        self.ledger = ledger
+        self.sweep = sweep
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+
+        self._heartbeats = {}
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.coordinator = self
+        self._stop = threading.Event()
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def handle(self, message):
+        op = message.get('op')
+        if op == 'claim':
+            return self._claim(message['worker'])
+        elif op == 'heartbeat':
+            return {'ok': self._heartbeat(message['worker'], message['name'])}
+        elif op == 'report':
+            return {'ok': self._report(message)}
+        raise Exception('Unknown operation ' + str(op))
+
+    def _claim(self, worker):
+        job = self.ledger.claim(worker=worker, sweep=self.sweep, max_attempts=self.max_attempts)
+        if job is not None:
+            with self._lock:
+                self._heartbeats[job['name']] = (worker, time.time())
+        return {'job': job, 'finished': job is None and self.finished()}
+
+    def _heartbeat(self, worker, name):
+        with self._lock:
+            if self._heartbeats.get(name, (None,))[0] != worker:
+                return False
+            self._heartbeats[name] = (worker, time.time())
+        return True
+
+    def _report(self, message):
+        with self._lock:
+            if self._heartbeats.get(message['name'], (None,))[0] != message['worker']:
+                # job was requeued in the meantime and belongs to another worker now
+                logging.warning('Ignoring report of ' + message['name'] + ' by ' + message['worker'])
+                return False
+            self._heartbeats.pop(message['name'])
+        self.ledger.finish(message['name'], message['exit_code'], message['duration'], message.get('error'))
+        return True
+
+    def requeue_dead(self):
+        """
+        Requeue running jobs whose worker did not send a heartbeat within heartbeat_timeout.
+
+        :return: names of requeued jobs
+        """
+        now = time.time()
+        with self._lock:
+            dead = [name for name, (worker, last) in self._heartbeats.items() if now - last > self.heartbeat_timeout]
+            for name in dead:
+                logging.warning('Worker ' + self._heartbeats.pop(name)[0] + ' died, requeueing ' + name)
+        for name in dead:
+            self.ledger.transition(name, jl.EMITTED)
+        return dead
+
+    def finished(self):
+        # fails jobs whose dependency failed for good
+        self.ledger.waiting(sweep=self.sweep, max_attempts=self.max_attempts)
+        counts = self.ledger.counts(sweep=self.sweep)
+        if counts[jl.EMITTED] or counts[jl.RUNNING]:
+            return False
+        return all(job['attempts'] >= self.max_attempts for job in self.ledger.jobs(sweep=self.sweep, state=jl.FAILED))
+
+    def serve(self, until_finished=True):
+        """
+        Serve workers. Blocks until all jobs are finished (or forever if until_finished is False).
+
+        :param until_finished:
+        :return:
+        """
+        # jobs running in a previous coordinator life have no heartbeat to time out on
+        for job in self.ledger.jobs(sweep=self.sweep, state=jl.RUNNING):
+            self.ledger.transition(job['name'], jl.EMITTED)
+
+        thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            while not self._stop.wait(min(1., self.heartbeat_timeout / 3.)):
+                self.requeue_dead()
+                if until_finished and self.finished():
+                    break
+        finally:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def stop(self):
+        self._stop.set()
+
+
+class _Connection(object):
+    def __init__(self, host, port, timeout=60.):
+        self._socket = socket.create_connection((host, port), timeout=timeout)
+        self._file = self._socket.makefile('rwb')
+        self._lock = threading.Lock()
+
+    def request(self, **message):
+        with self._lock:
+            self._file.write((json.dumps(message) + '\n').encode('utf-8'))
+            self._file.flush()
+            line = self._file.readline()
+        if not line:
+            raise ConnectionError('Coordinator closed the connection')
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise Exception('Coordinator error: ' + response['error'])
+        return response
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+class Worker(object):
+    def __init__(self, host, port=DEFAULT_PORT, jobs=1, dart_path=None, heartbeat_interval=5., poll_interval=2.,
+                 staging=None, threads=None, postprocess_jobs=2):
+        """
+        :param host: coordinator host
+        :param port: coordinator port
+        :param jobs: number of DART processes this worker runs concurrently
+        :param dart_path: DART launcher, defaults to the dart_path of each simulation config
+        :param heartbeat_interval: seconds between heartbeats, must be well below the coordinator heartbeat_timeout
+        :param poll_interval: seconds to wait before asking again when no job is available yet
+        :param staging (Staging): run DART on node local scratch space
+        :param threads: nbThreads of every run, see SimulationRunner
+        :param postprocess_jobs: postprocessing threads, 0 leaves the outputs untouched, see SimulationRunner
+        """
+        self.host = host
+        self.port = port
+        self.jobs = jobs
+        self.runner = run.SimulationRunner(dart_path=dart_path, staging=staging, threads=threads,
+                                           postprocess_jobs=postprocess_jobs)
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.name = jl.worker_id()
+
+    def work(self):
+        """
+        Claim and run jobs until the coordinator reports that all jobs are finished.
+
+        :return: list of run status dicts
+        """
+        slots = [threading.Thread(target=self._slot, args=(i,)) for i in range(self.jobs)]
+        self._results = []
+        for slot in slots:
+            slot.start()
+        for slot in slots:
+            slot.join()
+        self.runner.wait_postprocessing()
+        if self.runner.postprocessor is not None:
+            self.runner.postprocessor.shutdown()
+        return self._results
+
+    def _slot(self, index):
+        worker = self.name + ':' + str(index)
+        connection = _Connection(self.host, self.port)
+        try:
+            while True:
+                response = connection.request(op='claim', worker=worker)
+                job = response['job']
+                if job is None:
+                    if response['finished']:
+                        return
+                    time.sleep(self.poll_interval)
+                    continue
+
+                running = threading.Event()
+                heartbeat = threading.Thread(target=self._heartbeat, args=(connection, worker, job['name'], running))
+                heartbeat.start()
+                try:
+                    status = self.runner._dart_run(job['path'])
+                finally:
+                    running.set()
+                    heartbeat.join()
+
+                connection.request(op='report', worker=worker, name=job['name'], exit_code=status['exit_code'],
+                                   duration=status['duration'], error=status.get('error'))
+                self._results.append(status)
+        finally:
+            connection.close()
+
+    def _heartbeat(self, connection, worker, name, running):
+        while not running.wait(self.heartbeat_interval):
+            try:
+                connection.request(op='heartbeat', worker=worker, name=name)
+            except Exception:
+                logging.exception('Heartbeat for ' + name + ' failed')
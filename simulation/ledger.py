@@ -0,0 +1,273 @@
+import json
+import os
+import socket
+import sqlite3
+import time
+from contextlib import contextmanager
+
+import utils.general
+
+LEDGER_FILE = 'dartpy_ledger.sqlite'
+
+CREATED, EMITTED, RUNNING, DONE, FAILED = 'created', 'emitted', 'running', 'done', 'failed'
+STATES = [CREATED, EMITTED, RUNNING, DONE, FAILED]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT PRIMARY KEY,
+    sweep TEXT,
+    path TEXT,
+    parameters TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    priority REAL NOT NULL DEFAULT 0,
+    worker TEXT,
+    created REAL,
+    updated REAL,
+    started REAL,
+    duration REAL,
+    exit_code INTEGER,
+    error TEXT,
+    depends TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_sweep_state ON jobs (sweep, state);
+CREATE TABLE IF NOT EXISTS transitions (
+    name TEXT NOT NULL,
+    state TEXT NOT NULL,
+    time REAL NOT NULL,
+    worker TEXT
+);
+"""
+
+
+def worker_id():
+    return socket.gethostname() + ':' + str(os.getpid())
+
+
+class JobLedger(object):
+    """
+    Persistent record of the simulations of a simulation_location: state transitions, attempts, durations and exit
+    codes. Backed by a SQLite database, so several processes can claim jobs from the same ledger.
+
+    States: created -> emitted -> running -> done | failed
+
+    A job may depend on another job (e.g. on the run writing the atmosphere transfer functions it imports), it is
+    only claimed once that job is done.
+    """
+
+    def __init__(self, simulation_location, timeout=60.):
+        if not os.path.exists(simulation_location):
+            os.makedirs(simulation_location)
+        self.path = utils.general.create_path(simulation_location, LEDGER_FILE)
+        self.timeout = timeout
+
+        with self._connection() as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.executescript(_SCHEMA)
+            # ledgers written before jobs could depend on each other
+            if 'depends' not in [row['name'] for row in con.execute('PRAGMA table_info(jobs)')]:
+                con.execute('ALTER TABLE jobs ADD COLUMN depends TEXT')
+
+    @contextmanager
+    def _connection(self):
+        con = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        con.row_factory = sqlite3.Row
+        try:
+            yield con
+        finally:
+            con.close()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Write transaction taking the database lock up front, so read-modify-write sequences are atomic across
+        processes.
+        """
+        with self._connection() as con:
+            con.execute('BEGIN IMMEDIATE')
+            try:
+                yield con
+            except BaseException:
+                con.execute('ROLLBACK')
+                raise
+            con.execute('COMMIT')
+
+    @staticmethod
+    def _row(row):
+        if row is None:
+            return None
+        job = dict(row)
+        if job.get('parameters') is not None:
+            job['parameters'] = json.loads(job['parameters'])
+        return job
+
+    @staticmethod
+    def _log(con, name, state, worker=None):
+        con.execute('INSERT INTO transitions (name, state, time, worker) VALUES (?, ?, ?, ?)',
+                    (name, state, time.time(), worker))
+
+    def register(self, name, state=CREATED, sweep=None, path=None, parameters=None, priority=0., depends=None):
+        """
+        Add a job or reset an existing one to state.
+
+        :param name: unique job name, e.g. the sweep variant name
+        :param state:
+        :param sweep: name of the sweep the job belongs to
+        :param path: simulation directory
+        :param parameters: dict of swept parameters
+        :param priority: jobs with higher priority are claimed first
+        :param depends: name of a job that has to be done before this one is claimed
+        :return:
+        """
+        now = time.time()
+        with self._transaction() as con:
+            con.execute('INSERT INTO jobs (name, sweep, path, parameters, state, priority, depends, created, updated) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                        'ON CONFLICT(name) DO UPDATE SET sweep=excluded.sweep, path=excluded.path, '
+                        'parameters=excluded.parameters, state=excluded.state, priority=excluded.priority, '
+                        'depends=excluded.depends, updated=excluded.updated',
+                        (name, sweep, path, json.dumps(parameters) if parameters is not None else None, state,
+                         priority, depends, now, now))
+            self._log(con, name, state)
+
+    def transition(self, name, state, **fields):
+        """
+        Move a job to state and update further columns (path, exit_code, duration, error, worker, priority).
+
+        :param name:
+        :param state:
+        :param fields:
+        :return:
+        """
+        fields['state'] = state
+        fields['updated'] = time.time()
+        columns = ', '.join(k + '=?' for k in fields)
+        with self._transaction() as con:
+            con.execute('UPDATE jobs SET ' + columns + ' WHERE name=?', list(fields.values()) + [name])
+            self._log(con, name, state, fields.get('worker'))
+
+    def claim(self, worker=None, sweep=None, max_attempts=3):
+        """
+        Atomically claim the next runnable job, i.e. an emitted job or a failed one with attempts left whose
+        dependency (if any) is done.
+
+        :param worker: worker identifier, defaults to host:pid
+        :param sweep: only claim jobs of this sweep
+        :param max_attempts:
+        :return: job dict or None if there is nothing left to run
+        """
+        worker = worker or worker_id()
+        query = ('SELECT * FROM jobs WHERE (state=? OR (state=? AND attempts<?)) '
+                 'AND (depends IS NULL OR depends IN (SELECT name FROM jobs WHERE state=?))')
+        args = [EMITTED, FAILED, max_attempts, DONE]
+        if sweep is not None:
+            query += ' AND sweep=?'
+            args.append(sweep)
+        query += ' ORDER BY priority DESC, name LIMIT 1'
+
+        now = time.time()
+        with self._transaction() as con:
+            row = con.execute(query, args).fetchone()
+            if row is None:
+                return None
+            con.execute('UPDATE jobs SET state=?, attempts=attempts+1, worker=?, started=?, updated=?, '
+                        'exit_code=NULL, duration=NULL, error=NULL WHERE name=?',
+                        (RUNNING, worker, now, now, row['name']))
+            self._log(con, row['name'], RUNNING, worker)
+
+        job = self._row(row)
+        job.update({'state': RUNNING, 'attempts': job['attempts'] + 1, 'worker': worker, 'started': now})
+        return job
+
+    def finish(self, name, exit_code, duration, error=None):
+        self.transition(name, DONE if exit_code == 0 else FAILED, exit_code=exit_code, duration=duration,
+                        error=error)
+
+    def waiting(self, sweep=None, max_attempts=3):
+        """
+        Runnable jobs that cannot be claimed yet because their dependency is not done. Jobs whose dependency failed
+        for good are failed as well, so that they do not wait forever.
+
+        :param sweep:
+        :param max_attempts:
+        :return: names of waiting jobs
+        """
+        jobs = dict((job['name'], job) for job in self.jobs(sweep=sweep))
+        waiting = []
+        for job in jobs.values():
+            runnable = job['state'] == EMITTED or (job['state'] == FAILED and job['attempts'] < max_attempts)
+            if not runnable or job['depends'] is None:
+                continue
+            dependency = jobs.get(job['depends']) or self.get(job['depends'])
+            if dependency is None or (dependency['state'] == FAILED and dependency['attempts'] >= max_attempts):
+                self.transition(job['name'], FAILED, attempts=max_attempts,
+                                error='Dependency ' + str(job['depends']) + ' failed')
+            elif dependency['state'] != DONE:
+                waiting.append(job['name'])
+        return waiting
+
+    def requeue_stale(self, sweep=None):
+        """
+        Put running jobs of dead local processes back to emitted, e.g. after a crash.
+
+        :param sweep:
+        :return: names of requeued jobs
+        """
+        host = socket.gethostname()
+        stale = []
+        for job in self.jobs(sweep=sweep, state=RUNNING):
+            worker_host, _, pid = (job['worker'] or '').rpartition(':')
+            if worker_host == host and pid.isdigit() and not _pid_alive(int(pid)):
+                stale.append(job['name'])
+
+        for name in stale:
+            self.transition(name, EMITTED)
+        return stale
+
+    def reset(self, sweep=None, states=(DONE, FAILED)):
+        """
+        Put finished jobs back to emitted with a fresh attempt count so they are run again.
+
+        :param sweep:
+        :param states:
+        :return:
+        """
+        for job in self.jobs(sweep=sweep):
+            if job['state'] in states:
+                self.transition(job['name'], EMITTED, attempts=0)
+
+    def get(self, name):
+        with self._connection() as con:
+            return self._row(con.execute('SELECT * FROM jobs WHERE name=?', (name,)).fetchone())
+
+    def jobs(self, sweep=None, state=None):
+        query, args = 'SELECT * FROM jobs WHERE 1=1', []
+        if sweep is not None:
+            query += ' AND sweep=?'
+            args.append(sweep)
+        if state is not None:
+            query += ' AND state=?'
+            args.append(state)
+
+        with self._connection() as con:
+            return [self._row(row) for row in con.execute(query + ' ORDER BY name', args)]
+
+    def counts(self, sweep=None):
+        """
+        :param sweep:
+        :return: dict state -> number of jobs
+        """
+        counts = dict((state, 0) for state in STATES)
+        for job in self.jobs(sweep=sweep):
+            counts[job['state']] += 1
+        return counts
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
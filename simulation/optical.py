@@ -0,0 +1,129 @@
+"""
+Optical property library of a simulation: the lop2d (lambertian) and lop3d (turbid vegetation) models of coeff_diff.
+
+Plots, maket and object3d link to an optical property by its ident and its index in the list of its type
+(indexFctPhase). The library deduplicates identical models, assigns the indices in coeff_diff order and resolves
+idents in O(1), so the links can leave the index to dartpy:
+
+    [maket.optical_property]
+        type = 0
+        ident = 'litter'
+        indexFctPhase = 'auto'
+
+Libraries are cached by content, all simulations with the same coeff_diff models (e.g. the variants of a sweep) share
+one library per process. Shared libraries must not be modified.
+"""
+import functools
+import json
+
+AUTO = 'auto'
+
+KINDS = ['lop2d', 'lop3d']
+
+# DART optical property types (OpticalPropertyLink.type) of the library kinds
+TYPES = {'lop2d': 0, 'lop3d': 3}
+
+
+def kind(optical_type):
+    """
+    :param optical_type: DART optical property type
+    :return: library kind or None if the type is not held by the library (e.g. Hapke, RPV)
+    """
+    for k, t in TYPES.items():
+        if str(t) == str(optical_type):
+            return k
+    return None
+
+
+class OpticalLibrary(object):
+    def __init__(self):
+        self._models = dict((k, []) for k in KINDS)
+        self._by_content = {}
+        self._by_ident = {}
+
+    @classmethod
+    def from_params(cls, params):
+        """
+        Library of the coeff_diff params, shared by all callers with the same models.
+
+        :param params: coeff_diff params, may be None
+        :return: OpticalLibrary
+        """
+        models = dict((k, ((params or {}).get(k) or {}).get('model') or []) for k in KINDS)
+        return _library(json.dumps(models, sort_keys=True, default=str))
+
+    def add(self, kind, model):
+        """
+        Add a model unless an identical one was added before.
+
+        :param kind: 'lop2d' or 'lop3d'
+        :param model: model params dict
+        :return: index of the model in the list of its kind
+        """
+        content = (kind, json.dumps(model, sort_keys=True, default=str))
+        index = self._by_content.get(content)
+        if index is not None:
+            return index
+
+        ident = model.get('ident')
+        if (kind, ident) in self._by_ident:
+            raise Exception(kind + ' model ' + str(ident) + ' is defined twice with different properties.')
+        index = len(self._models[kind])
+        self._models[kind].append(model)
+        self._by_content[content] = index
+        self._by_ident[(kind, ident)] = index
+        return index
+
+    def models(self, kind):
+        """
+        :param kind:
+        :return: deduplicated models of kind in index order
+        """
+        return self._models[kind]
+
+    def index(self, ident, kind):
+        """
+        :param ident: ident of the model
+        :param kind:
+        :return: indexFctPhase of the model
+        """
+        index = self._by_ident.get((kind, ident))
+        if index is None:
+            raise Exception('Unknown ' + kind + ' optical property ' + str(ident) + ', known are ' +
+                            ', '.join(str(m.get('ident')) for m in self._models[kind]))
+        return index
+
+    def resolve(self, ident, index, kind):
+        """
+        indexFctPhase of an optical property link.
+
+        :param ident: ident of the link
+        :param index: indexFctPhase of the link, 'auto' to resolve it from ident. An explicit index must be the index of
+                      ident, it is passed on as it is for idents and types the library does not hold
+        :param kind: library kind of the link, None for types the library does not hold
+        :return: index
+        """
+        if str(index) == AUTO:
+            if kind is None:
+                raise Exception('indexFctPhase of ' + str(ident) + ' can only be resolved for the optical property '
+                                'types ' + ', '.join(str(t) for t in TYPES.values()))
+            return self.index(ident, kind)
+
+        # identical models are written once, which moves the models after them, an explicit index may be stale
+        resolved = self._by_ident.get((kind, ident))
+        if isinstance(index, int) and resolved is not None and resolved != index:
+            raise Exception('indexFctPhase ' + str(index) + ' of ' + str(ident) + ' does not match its index ' +
+                            str(resolved) + " in the deduplicated coeff_diff models, use 'auto' to resolve it")
+        return index
+
+    def __len__(self):
+        return sum(len(models) for models in self._models.values())
+
+
+@functools.lru_cache(maxsize=32)
+def _library(models):
+    library = OpticalLibrary()
+    for k, kind_models in json.loads(models).items():
+        for model in kind_models:
+            library.add(k, model)
+    return library
@@ -0,0 +1,283 @@
+"""
+Retention policies applied to simulation directories after a DART run.
+
+The [postprocessing] table of a simulation config selects what happens to the files of a finished run:
+
+    [postprocessing]
+    keep = ['output/BAND0/BRF/*']                # never touched
+    drop = ['output/*/Tapes/*', 'output/*/RADIATIVE_BUDGET/*']      # deleted
+    compress = ['output/*']                      # replaced by zstd compressed <file>.zst
+    compression_level = 3
+
+Only the outputs of the run (the output directory) are touched, inputs and the files dartpy relies on never are.
+Patterns are globs relative to the simulation directory, the first of keep, drop, compress that matches a file decides.
+Files matching none of them are left as they are. Compressed outputs are read back transparently with open_output and
+read_output.
+
+The sensor_* keys resample the band outputs to the bands of a sensor before the retention policy is applied, see
+simulation/sensor.py.
+"""
+import fnmatch
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import utils.general
+import utils.timing
+from . import archive
+
+toml = utils.general.lazy_import('toml')
+zstandard = utils.general.lazy_import('zstandard')
+
+COMPRESSED_SUFFIX = '.zst'
+OUTPUT_DIR = 'output'
+
+
+class RetentionPolicy(object):
+    def __init__(self, keep=None, drop=None, compress=None, compression_level=3):
+        """
+        :param keep (list of str): glob patterns of files that are kept as they are
+        :param drop (list of str): glob patterns of files that are deleted
+        :param compress (list of str): glob patterns of files that are compressed with zstd
+        :param compression_level: zstd compression level
+        """
+        self.keep = list(keep or [])
+        self.drop = list(drop or [])
+        self.compress = list(compress or [])
+        self.compression_level = compression_level
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: simulation config dict or path to a simulation directory
+        :return: RetentionPolicy, None if the config has no retention policy
+        """
+        if type(config) is str:
+            config = read_config(config)
+            if config is None:
+                return None
+
+        params = config.get('postprocessing') or {}
+        keep = list(params.get('keep') or [])
+
+        # transfer functions written for other simulations to import
+        atmosphere = (config.get('atmosphere') or {}).get('general') or {}
+        if str(atmosphere.get('writeTransferFunctions')) == '1' and atmosphere.get('transferFunctionsFile'):
+            keep.append(atmosphere['transferFunctionsFile'])
+
+        policy = cls(keep=keep, drop=params.get('drop'), compress=params.get('compress'),
+                     compression_level=params.get('compression_level', 3))
+        return policy if policy.drop or policy.compress else None
+
+    def action(self, rel):
+        """
+        :param rel: file path relative to the simulation directory
+        :return: 'keep', 'drop' or 'compress', files outside the output directory are always kept
+        """
+        if not rel.startswith(OUTPUT_DIR + '/') or rel.endswith(COMPRESSED_SUFFIX) or _matches(rel, self.keep):
+            return 'keep'
+        if _matches(rel, self.drop):
+            return 'drop'
+        if _matches(rel, self.compress):
+            return 'compress'
+        return 'keep'
+
+    def apply(self, path):
+        """
+        Apply the policy to the output directory of a simulation directory. Applying it again is a no-op.
+
+        :param path: simulation directory
+        :return: (bytes before, bytes after) of the output directory
+        """
+        before = after = 0
+        emptied = set()
+        output = os.path.join(path, OUTPUT_DIR)
+        with utils.timing.span('postprocessing.apply', path=path):
+            for dirpath, dirnames, filenames in os.walk(output, topdown=False):
+                rel_dir = os.path.relpath(dirpath, path)
+                for name in filenames:
+                    file_path = os.path.join(dirpath, name)
+                    rel = name if rel_dir == '.' else utils.general.create_path(rel_dir, name)
+                    size = os.path.getsize(file_path)
+                    before += size
+
+                    action = self.action(rel)
+                    if action == 'drop':
+                        os.remove(file_path)
+                        emptied.add(dirpath)
+                    elif action == 'compress':
+                        after += compress_file(file_path, self.compression_level)
+                    else:
+                        after += size
+
+                # remove directories emptied by drop
+                if dirpath != output and dirpath in emptied and not os.listdir(dirpath):
+                    os.rmdir(dirpath)
+                    emptied.add(os.path.dirname(dirpath))
+
+        logging.info('Retention policy reduced ' + path + ' from ' + str(before) + ' to ' + str(after) + ' bytes')
+        return before, after
+
+
+class Postprocessor(object):
+    """
+    Background thread pool resampling the outputs (simulation.sensor) and applying the retention policy of each
+    simulation directory it is handed.
+    """
+
+    def __init__(self, jobs=2):
+        self.jobs = jobs
+        self._pool = None
+        self._futures = []
+        self._resamplings = {}
+        self._lock = threading.Lock()
+
+    def submit(self, path):
+        """
+        Resample the outputs and apply the retention policy of the config in path in the background.
+
+        :param path: simulation directory
+        :return: Future or None if the simulation has neither a sensor response nor a retention policy
+        """
+        config = read_config(path)
+        if config is None:
+            return None
+        resampling = self._resampling(config)
+        policy = RetentionPolicy.from_config(config)
+        if resampling is None and policy is None:
+            return None
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.jobs)
+            future = self._pool.submit(_process, path, config, resampling, policy)
+            self._futures.append(future)
+        return future
+
+    def _resampling(self, config):
+        # one Resampling per sensor, so its weights are shared by all simulations with the same band table
+        from . import sensor
+        resampling = sensor.Resampling.from_config(config)
+        if resampling is None:
+            return None
+        key = (resampling.name, id(resampling.response), tuple(resampling.images), tuple(resampling.tables))
+        with self._lock:
+            return self._resamplings.setdefault(key, resampling)
+
+    def wait(self):
+        """
+        Wait for all submitted policies. Failures are logged, the outputs of such a simulation are left as they are.
+
+        :return: (bytes before, bytes after) summed over all successfully processed simulations
+        """
+        with self._lock:
+            futures, self._futures = self._futures, []
+        before = after = 0
+        for future in futures:
+            try:
+                b, a = future.result()
+            except Exception:
+                logging.exception('Could not postprocess outputs')
+                continue
+            before += b
+            after += a
+        return before, after
+
+    def shutdown(self):
+        self.wait()
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+def read_config(path):
+    """
+    :param path: simulation directory, packed or not
+    :return: its config dict, None if it has none
+    """
+    from .simulation import CONFIG_FILE_NAME
+    config_path = utils.general.create_path(path, CONFIG_FILE_NAME)
+    if not archive.exists(config_path):
+        return None
+    return toml.loads(archive.read_text(config_path), _dict=dict)
+
+
+def postprocess(path, config=None):
+    """
+    Resample the outputs and apply the retention policy of a simulation directory right away, see Postprocessor.
+
+    :param path: simulation directory
+    :param config: simulation config dict, defaults to the config in path
+    :return: (bytes before, bytes after)
+    """
+    from . import sensor
+    if config is None:
+        config = read_config(path)
+        if config is None:
+            return 0, 0
+    return _process(path, config, sensor.Resampling.from_config(config), RetentionPolicy.from_config(config))
+
+
+def _process(path, config, resampling, policy):
+    if resampling is not None:
+        resampling.apply(path, config=config)
+    if policy is None:
+        return 0, 0
+    return policy.apply(path)
+
+
+def compress_file(path, level=3):
+    """
+    Replace a file by its zstd compressed version path + '.zst'.
+
+    :param path:
+    :param level:
+    :return: size of the compressed file
+    """
+    target = path + COMPRESSED_SUFFIX
+    with open(path, 'rb') as src, open(target + '.part', 'wb') as dst:
+        zstandard.ZstdCompressor(level=level).copy_stream(src, dst)
+    os.replace(target + '.part', target)
+    os.remove(path)
+    return os.path.getsize(target)
+
+
+def open_output(path):
+    """
+    Open a DART output file for binary reading, whether it was compressed by a retention policy or not.
+
+    :param path: path of the original, uncompressed output file
+    :return: binary file object
+    """
+    if not os.path.exists(path) and os.path.exists(path + COMPRESSED_SUFFIX):
+        return zstandard.ZstdDecompressor().stream_reader(open(path + COMPRESSED_SUFFIX, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+
+def read_output(path):
+    """
+    :param path: path of the original, uncompressed output file
+    :return: file content as bytes
+    """
+    with open_output(path) as f:
+        return f.read()
+
+
+def decompress_file(path):
+    """
+    Restore the original file of a compressed output in place.
+
+    :param path: path of the original, uncompressed output file
+    :return:
+    """
+    with open_output(path) as src, open(path + '.part', 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(path + '.part', path)
+    if os.path.exists(path + COMPRESSED_SUFFIX):
+        os.remove(path + COMPRESSED_SUFFIX)
+
+
+def _matches(rel, patterns):
+    return any(fnmatch.fnmatch(rel, p) for p in patterns)
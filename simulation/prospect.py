@@ -0,0 +1,315 @@
+"""
+Leaf optical properties of lop3d models computed with PROSPECT-D from leaf biochemistry, vectorized over batches.
+
+The [prospect] table of a config assigns biochemical parameters to lop3d models by ident:
+
+    [prospect]
+        coefficients = '/data/prospect/dataSpec_PDB.txt'   # PROSPECT-D refractive index and absorption coefficients
+        database_dir = '~/DART/user_data/database'        # DART database directory prospect.db is written to,
+                                                            # defaults to the first of database.default_directories
+        [prospect.models.Turbid_Leaf_Deciduous_Phase_Function]
+            N = 1.5
+            Cab = 40.0                                      # ug cm-2
+            Car = 8.0                                       # ug cm-2
+            Anth = 0.0                                      # ug cm-2
+            Cbrown = 0.0
+            Cw = 0.01                                       # cm
+            Cm = 0.009                                      # g cm-2
+
+The coefficients are not shipped with dartpy, any text table with the columns wavelength (nm), refractive index and
+the specific absorption coefficients of Cab, Car, Anth, Cbrown, Cw and Cm (the layout of the published PROSPECT-D
+data) can be used.
+
+Every parameter set becomes a model of prospect.db named by a hash of the parameters and the coefficients, the lop3d
+model is pointed to it (databaseName, ModelName). Spectra already in the database are not computed again. Sweeps over
+the parameters, e.g. 'prospect.models.Turbid_Leaf_Deciduous_Phase_Function.Cab' = [20, 40, 60], compute the spectra
+of all variants as one batch before the first variant is created (see prepare).
+"""
+import copy
+import functools
+import hashlib
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+
+import utils.general
+import utils.timing
+
+np = utils.general.lazy_import('numpy')
+
+PROSPECT_KEY = 'prospect'
+DATABASE = 'prospect.db'
+PARAMETERS = ['N', 'Cab', 'Car', 'Anth', 'Cbrown', 'Cw', 'Cm']
+DEFAULTS = {'N': 1.5, 'Cab': 40., 'Car': 8., 'Anth': 0., 'Cbrown': 0., 'Cw': 0.01, 'Cm': 0.009}
+
+# columns of the coefficient table after the wavelength
+COEFFICIENTS = ['nr', 'kab', 'kcar', 'kanth', 'kbrown', 'kw', 'km']
+
+# incidence solid angle of the leaf surface in degrees
+ALPHA = 40.
+
+_EULER = 0.5772156649015329
+# terms of the continued fraction of the exponential integral, double precision for x > 1
+_CF_TERMS = 64
+# terms of the power series of the exponential integral, double precision for x <= 1
+_SERIES_TERMS = 24
+
+_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=8)
+def _load_coefficients(path, mtime_ns, size):
+    with open(path) as f:
+        table = np.loadtxt([line.replace(',', ' ') for line in f if line.strip() and not line.lstrip().startswith('#')
+                            and not line.lstrip()[0].isalpha()])
+    if table.ndim != 2 or table.shape[1] < 1 + len(COEFFICIENTS):
+        raise Exception(path + ' must have the columns wavelength, ' + ', '.join(COEFFICIENTS))
+    return table[:, :1 + len(COEFFICIENTS)], utils.general.file_hash(path)
+
+
+def coefficients(path):
+    """
+    PROSPECT coefficient table, loaded once as long as the file does not change.
+
+    :param path: text table with the columns wavelength (nm), nr, kab, kcar, kanth, kbrown, kw, km
+    :return: (array of shape (wavelengths, 8), sha1 of the file)
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    stat = os.stat(path)
+    return _load_coefficients(path, stat.st_mtime_ns, stat.st_size)
+
+
+def exp1(x):
+    """
+    Exponential integral E1 of positive x, elementwise.
+    """
+    x = np.asarray(x, dtype=float)
+    small = x <= 1.
+    result = np.empty_like(x)
+
+    xs = x[small]
+    term = np.ones_like(xs)
+    total = np.zeros_like(xs)
+    for k in range(1, _SERIES_TERMS + 1):
+        term = term * -xs / k
+        total += term / k
+    result[small] = -_EULER - np.log(xs) - total
+
+    # continued fraction evaluated backwards with a fixed depth
+    xl = x[~small]
+    f = xl + 2 * _CF_TERMS + 1
+    for k in range(_CF_TERMS, 0, -1):
+        f = xl + 2 * k - 1 - k * k / f
+    result[~small] = np.exp(-xl) / f
+    return result
+
+
+def _tav(alpha, nr):
+    """
+    Average transmissivity of a dielectric plane surface for incidence angles up to alpha (Stern 1964).
+    """
+    n2 = nr * nr
+    n_p = n2 + 1
+    n_m = n2 - 1
+    a = (nr + 1) ** 2 / 2.
+    k = -(n2 - 1) ** 2 / 4.
+    sa = math.sin(math.radians(alpha))
+
+    b1 = np.sqrt((sa * sa - n_p / 2) ** 2 + k) if alpha != 90. else 0.
+    b2 = sa * sa - n_p / 2
+    b = b1 - b2
+    ts = (k ** 2 / (6 * b ** 3) + k / b - b / 2) - (k ** 2 / (6 * a ** 3) + k / a - a / 2)
+    tp1 = -2 * n2 * (b - a) / n_p ** 2
+    tp2 = -2 * n2 * n_p * np.log(b / a) / n_m ** 2
+    tp3 = n2 * (1 / b - 1 / a) / 2
+    tp4 = 16 * n2 ** 2 * (n2 ** 2 + 1) * np.log((2 * n_p * b - n_m ** 2) / (2 * n_p * a - n_m ** 2)) / (
+        n_p ** 3 * n_m ** 2)
+    tp5 = 16 * n2 ** 3 * (1 / (2 * n_p * b - n_m ** 2) - 1 / (2 * n_p * a - n_m ** 2)) / n_p ** 3
+    return (ts + tp1 + tp2 + tp3 + tp4 + tp5) / (2 * sa * sa)
+
+
+def simulate(params, table):
+    """
+    PROSPECT-D reflectance and transmittance of a batch of leaves.
+
+    :param params: dict parameter name -> array of shape (leaves,) (or scalars), see PARAMETERS
+    :param table: coefficient table, see coefficients
+    :return: (wavelength in um of shape (wavelengths,), reflectance and transmittance of shape (leaves, wavelengths))
+    """
+    values = dict((p, np.atleast_1d(np.asarray(params.get(p, DEFAULTS[p]), dtype=float))[:, None])
+                  for p in PARAMETERS)
+    wavelength, nr, kab, kcar, kanth, kbrown, kw, km = table.T
+
+    with utils.timing.span('prospect.simulate', leaves=max(len(v) for v in values.values())):
+        n = values['N']
+        k = (values['Cab'] * kab + values['Car'] * kcar + values['Anth'] * kanth + values['Cbrown'] * kbrown +
+             values['Cw'] * kw + values['Cm'] * km) / n
+
+        # transmissivity of the elementary layer
+        tau = np.ones(k.shape)
+        absorbing = k > 0
+        ka = k[absorbing]
+        tau[absorbing] = (1 - ka) * np.exp(-ka) + ka * ka * exp1(ka)
+
+        # reflectance and transmittance of the first (elementary) layer
+        talf = _tav(ALPHA, nr)
+        ralf = 1 - talf
+        t12 = _tav(90., nr)
+        r12 = 1 - t12
+        t21 = t12 / (nr * nr)
+        r21 = 1 - t21
+        denom = 1 - r21 * r21 * tau * tau
+        ta = talf * tau * t21 / denom
+        ra = ralf + r21 * tau * ta
+        t = t12 * tau * t21 / denom
+        r = r12 + r21 * tau * t
+
+        # N - 1 further layers (Stokes equations)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d = np.sqrt(np.maximum((1 + r + t) * (1 + r - t) * (1 - r + t) * (1 - r - t), 0.))
+            a = (1 + r * r - t * t + d) / (2 * r)
+            b = (1 - r * r + t * t + d) / (2 * t)
+            b_nm1 = b ** (n - 1)
+            b_n2 = b_nm1 ** 2
+            denom = a * a * b_n2 - 1
+            r_sub = a * (b_n2 - 1) / denom
+            t_sub = b_nm1 * (a * a - 1) / denom
+
+        # no absorption
+        lossless = r + t >= 1
+        n_full = np.broadcast_to(n, r.shape)
+        t_sub = np.where(lossless, t / (t + (1 - t) * (n_full - 1)), t_sub)
+        r_sub = np.where(lossless, 1 - t_sub, r_sub)
+
+        denom = 1 - r_sub * r
+        transmittance = ta * t_sub / denom
+        reflectance = ra + ta * r_sub * t / denom
+    return wavelength / 1000., reflectance, transmittance
+
+
+def model_name(params, coefficients_hash):
+    """
+    :param params: parameter dict, missing parameters are DEFAULTS
+    :param coefficients_hash: sha1 of the coefficient table
+    :return: name of the model of params in prospect.db
+    """
+    values = [float(params.get(p, DEFAULTS[p])) for p in PARAMETERS]
+    key = json.dumps([values, coefficients_hash, ALPHA])
+    return 'prospect_' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def prepare(configs):
+    """
+    Compute the spectra of all PROSPECT parameter sets of configs as one batch per coefficient table and add them to
+    the prospect databases. Parameter sets already in a database are skipped.
+
+    :param configs: iterable of config dicts
+    :return: number of computed spectra
+    """
+    todo = {}
+    for config in configs:
+        settings = config.get(PROSPECT_KEY)
+        if not settings:
+            continue
+        _, digest = coefficients(settings['coefficients'])
+        database_path = _database_path(config)
+        existing = _models(database_path)
+        batch = todo.setdefault((database_path, settings['coefficients']), {})
+        for ident, params in (settings.get('models') or {}).items():
+            _check(ident, params)
+            name = model_name(params, digest)
+            if name not in existing:
+                batch[name] = params
+
+    computed = 0
+    for (database_path, coefficients_path), batch in todo.items():
+        if not batch:
+            continue
+        table, _ = coefficients(coefficients_path)
+        names = list(batch)
+        wavelength, reflectance, transmittance = simulate(
+            dict((p, [batch[name].get(p, DEFAULTS[p]) for name in names]) for p in PARAMETERS), table)
+        _write(database_path, names, [batch[name] for name in names], wavelength, reflectance, transmittance)
+        computed += len(names)
+        logging.info('Computed ' + str(len(names)) + ' PROSPECT spectra into ' + database_path)
+    return computed
+
+
+def apply(config):
+    """
+    Point the lop3d models of the [prospect] table to their spectra in prospect.db, computing them if necessary.
+
+    :param config: config dict, not modified
+    :return: config with databaseName and ModelName of the lop3d models set
+    """
+    settings = config.get(PROSPECT_KEY)
+    if not settings:
+        return config
+
+    prepare([config])
+    config = copy.deepcopy(config)
+    _, digest = coefficients(settings['coefficients'])
+    models = dict((m.get('ident'), m) for m in config.get('coeff_diff', {}).get('lop3d', {}).get('model') or [])
+    for ident, params in (settings.get('models') or {}).items():
+        if ident not in models:
+            raise Exception('prospect.models.' + str(ident) + ' is not the ident of a coeff_diff.lop3d model')
+        models[ident]['databaseName'] = DATABASE
+        models[ident]['ModelName'] = model_name(params, digest)
+    return config
+
+
+def _check(ident, params):
+    unknown = [p for p in params if p not in PARAMETERS]
+    if unknown:
+        raise Exception('prospect.models.' + str(ident) + ': unknown parameters ' + ', '.join(unknown) +
+                        ', PROSPECT-D takes ' + ', '.join(PARAMETERS))
+
+
+def _database_path(config):
+    """
+    prospect.db in prospect.database_dir or the DART database directory of dart_path, where DART finds it.
+    """
+    directory = config[PROSPECT_KEY].get('database_dir')
+    if not directory:
+        from . import database
+        directories = database.default_directories(config.get('dart_path'))
+        if not directories:
+            raise Exception('prospect.database_dir is not set and no DART database directory was found (set ' +
+                            database.DATABASE_ENV + ' or dart_path), DART could not find ' + DATABASE)
+        directory = directories[0]
+    directory = os.path.expanduser(directory)
+    os.makedirs(directory, exist_ok=True)
+    return utils.general.create_path(directory, DATABASE)
+
+
+def _models(database_path):
+    if not os.path.exists(database_path):
+        return frozenset()
+    from . import database
+    return database.for_directories([os.path.dirname(database_path)]).models(DATABASE)
+
+
+def _write(database_path, names, params, wavelength, reflectance, transmittance):
+    """
+    Add models in the DART database layout: one table per model and a _comment table describing them.
+    """
+    with _lock, utils.timing.span('prospect.write', path=database_path):
+        connection = sqlite3.connect(database_path, timeout=60.)
+        try:
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS _comment (name TEXT, description TEXT)')
+                for i, name in enumerate(names):
+                    connection.execute('CREATE TABLE IF NOT EXISTS "' + name +
+                                       '" (wavelength REAL, reflectance REAL, transmittance REAL)')
+                    connection.execute('DELETE FROM "' + name + '"')
+                    connection.executemany('INSERT INTO "' + name + '" VALUES (?, ?, ?)',
+                                           zip(wavelength.tolist(), reflectance[i].tolist(),
+                                               transmittance[i].tolist()))
+                    connection.execute('DELETE FROM _comment WHERE name = ?', (name,))
+                    connection.execute('INSERT INTO _comment VALUES (?, ?)', (name, 'PROSPECT-D ' + ', '.join(
+                        p + '=' + str(params[i].get(p, DEFAULTS[p])) for p in PARAMETERS)))
+        finally:
+            connection.close()
@@ -1,13 +1,314 @@
+import json
+import logging
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import utils.general
+import utils.timing
+from . import archive
+from . import ledger as jl
+from . import postprocessing
+
+toml = utils.general.lazy_import('toml')
+
+RUN_STATUS_FILE = 'run_status.json'
+RUN_LOG_FILE = 'dart.log'
+
+# seconds to wait before claiming again while the remaining jobs wait for their dependencies
+POLL_INTERVAL = 2.
+
+CREATED, RUNNING, DONE, FAILED = jl.CREATED, jl.RUNNING, jl.DONE, jl.FAILED
+
+
 class SimulationRunner(object):
     """
     Class dispatching and handling the running of possibly multiple DART simulations
     """
 
-    def __init__(self, simulation):
-        self.simulation = simulation
+    def __init__(self, simulation=None, jobs=1, dart_path=None, ledger=None, sweep=None, max_attempts=3,
+                 cost_model=None, threads=None, staging=None, postprocess_jobs=2, sequence_path=None):
+        """
+        :param simulation: Simulation, simulation directory path or a list of those, ignored if ledger is given
+        :param jobs: number of DART processes running concurrently
+        :param dart_path: DART launcher, defaults to the dart_path of each simulation config
+        :param ledger (JobLedger): claim jobs from this ledger instead of running a fixed list of simulations
+        :param sweep: only run jobs of this sweep when using a ledger
+        :param max_attempts: failed ledger jobs are retried until they were attempted max_attempts times
+        :param cost_model (CostModel): run the simulations longest predicted runtime first. Ledger jobs are always
+                                       claimed in order of their priority, which is the predicted runtime.
+        :param threads: rewrite nbThreads in phase.xml to this value before running, see tune
+        :param staging (Staging): run DART on a scratch copy of each simulation and publish the selected outputs
+        :param postprocess_jobs: threads applying the [postprocessing] retention policies of finished runs in the
+                                 background, 0 to leave the outputs untouched
+        :param sequence_path: DART sequence launcher for simulations with a sequence file, defaults to dart-sequence
+                              next to the DART launcher
+        """
+        if simulation is None:
+            simulation = []
+        elif type(simulation) is str or not hasattr(simulation, '__iter__'):
+            simulation = [simulation]
+        self.simulations = list(simulation)
+        self.jobs = jobs
+        self.dart_path = dart_path
+        self.ledger = ledger
+        self.sweep = sweep
+        self.max_attempts = max_attempts
+        self.cost_model = cost_model
+        self.threads = threads
+        self.staging = staging
+        self.postprocessor = postprocessing.Postprocessor(postprocess_jobs) if postprocess_jobs else None
+        self.sequence_path = sequence_path
+
+    def run(self, resume=False, dry_run=False, *args, **kwargs):
+        """
+        Run all simulations.
+
+        :param resume: skip simulations that already finished successfully
+        :param dry_run: do not run DART, only return the paths that would be run
+        :return: list of run status dicts (list of paths if dry_run)
+        """
+        try:
+            if self.ledger is not None:
+                return self._run_ledger(resume, dry_run, *args, **kwargs)
+            return self._run_paths(resume, dry_run, *args, **kwargs)
+        finally:
+            self.wait_postprocessing()
+            if self.postprocessor is not None:
+                # its threads are started again by the next run
+                self.postprocessor.shutdown()
+
+    def _run_paths(self, resume, dry_run, *args, **kwargs):
+        paths = [self._path(sim) for sim in self.simulations]
+        if resume:
+            paths = [p for p in paths if (self.status(p) or {}).get('state') != DONE]
+        if self.cost_model is not None:
+            costs = self.predict(paths)
+            paths.sort(key=costs.get, reverse=True)
+
+        if dry_run:
+            return paths
+
+        if self.jobs <= 1:
+            return [self._dart_run(p, *args, **kwargs) for p in paths]
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            return list(pool.map(lambda p: self._dart_run(p, *args, **kwargs), paths))
+
+    def _run_ledger(self, resume, dry_run, *args, **kwargs):
+        """
+        Run jobs claimed from the ledger until none is left. Several processes may do this on the same ledger.
+        """
+        if dry_run:
+            runnable = [jl.EMITTED, jl.FAILED] + ([] if resume else [jl.DONE])
+            return [job['path'] for job in self.ledger.jobs(sweep=self.sweep)
+                    if job['state'] in runnable and (job['state'] != jl.FAILED or not resume
+                                                     or job['attempts'] < self.max_attempts)]
+
+        if not resume:
+            self.ledger.reset(sweep=self.sweep)
+        self.ledger.requeue_stale(sweep=self.sweep)
+
+        def work():
+            results = []
+            while True:
+                job = self.ledger.claim(sweep=self.sweep, max_attempts=self.max_attempts)
+                if job is None:
+                    if not self.ledger.waiting(sweep=self.sweep, max_attempts=self.max_attempts):
+                        return results
+                    time.sleep(POLL_INTERVAL)
+                    continue
+                status = self._dart_run(job['path'], *args, **kwargs)
+                self.ledger.finish(job['name'], status['exit_code'], status['duration'], status.get('error'))
+                results.append(status)
+
+        with ThreadPoolExecutor(max_workers=max(self.jobs, 1)) as pool:
+            futures = [pool.submit(work) for _ in range(max(self.jobs, 1))]
+            return [status for future in futures for status in future.result()]
+
+    def predict(self, paths):
+        """
+        Predicted runtimes of simulation directories according to self.cost_model.
+
+        :param paths:
+        :return: dict path -> predicted runtime
+        """
+        from .simulation import CONFIG_FILE_NAME
+        return {p: self.cost_model.predict(toml.loads(archive.read_text(utils.general.create_path(p, CONFIG_FILE_NAME)),
+                                                      _dict=dict))
+                for p in paths}
+
+    def tune(self, paths, cores=None, splits=None):
+        """
+        Calibrate DART threads per run against concurrent runs on representative simulations and use the split with
+        the highest throughput for the following runs (sets self.jobs and self.threads).
+
+        :param paths: directories of representative, emitted simulations
+        :param cores: number of cores to distribute, defaults to all
+        :param splits: list of (jobs, threads) to try
+        :return: Tuning
+        """
+        from . import tuning
+        result = tuning.calibrate(paths, cores=cores, splits=splits, dart_path=self.dart_path)
+        self.jobs, self.threads = result.jobs, result.threads
+        logging.info('Tuned to {} concurrent runs with {} threads each'.format(self.jobs, self.threads))
+        return result
+
+    def serve(self, host='0.0.0.0', port=None, heartbeat_timeout=30., until_finished=True):
+        """
+        Coordinator mode: hand out the jobs of the ledger to remote workers (see simulation.distributed).
+
+        :param host:
+        :param port:
+        :param heartbeat_timeout: seconds without heartbeat after which a job is requeued
+        :param until_finished: return once all jobs are finished
+        :return:
+        """
+        from . import distributed
+        if self.ledger is None:
+            raise Exception('Coordinator mode needs a job ledger.')
+
+        coordinator = distributed.Coordinator(self.ledger, sweep=self.sweep, host=host,
+                                              port=distributed.DEFAULT_PORT if port is None else port,
+                                              heartbeat_timeout=heartbeat_timeout, max_attempts=self.max_attempts)
+        coordinator.serve(until_finished=until_finished)
+
+    def work(self, host, port=None, heartbeat_interval=5.):
+        """
+        Worker mode: run jobs handed out by a coordinator with self.jobs concurrent DART processes.
+
+        :param host: coordinator host
+        :param port: coordinator port
+        :param heartbeat_interval:
+        :return: list of run status dicts
+        """
+        from . import distributed
+        worker = distributed.Worker(host, port=distributed.DEFAULT_PORT if port is None else port, jobs=self.jobs,
+                                    dart_path=self.dart_path, heartbeat_interval=heartbeat_interval,
+                                    staging=self.staging, threads=self.threads,
+                                    postprocess_jobs=self.postprocessor.jobs if self.postprocessor is not None else 0)
+        return worker.work()
+
+    def _dart_run(self, path, *args, **kwargs):
+        """
+        Run DART on a single simulation directory. stdout and stderr of DART go to dart.log in the simulation
+        directory, the outcome to run_status.json.
+
+        :param path: simulation directory
+        :return: run status dict
+        """
+        status = self.status(path) or {}
+        status.update({'state': RUNNING, 'attempts': status.get('attempts', 0) + 1, 'started': time.time(),
+                       'exit_code': None, 'duration': None})
+        self._write_status(path, status)
+
+        dart_path = self._dart_path(path)
+        start = time.time()
+        try:
+            with utils.timing.span('dart.run', path=path), \
+                    open(utils.general.create_path(path, RUN_LOG_FILE), 'w') as log:
+                if self.staging is None:
+                    # packed simulations are extracted for the run only
+                    with archive.materialized(path):
+                        self._set_threads(path)
+                        exit_code = subprocess.call(self._command(dart_path, path), stdout=log,
+                                                    stderr=subprocess.STDOUT)
+                else:
+                    with self.staging.stage(path, copy=True) as staged:
+                        self._set_threads(staged)
+                        exit_code = subprocess.call(self._command(dart_path, staged), stdout=log,
+                                                    stderr=subprocess.STDOUT)
+                        if exit_code != 0:
+                            # do not publish the outputs of failed runs
+                            raise _DartFailed(exit_code)
+        except _DartFailed as e:
+            exit_code = e.exit_code
+        except Exception as e:
+            logging.exception('Could not run DART with ' + dart_path + ' on ' + path)
+            exit_code = -1
+            status['error'] = str(e)
+
+        status.update({'state': DONE if exit_code == 0 else FAILED, 'exit_code': exit_code,
+                       'duration': time.time() - start})
+        self._write_status(path, status)
+
+        if exit_code != 0:
+            logging.warning('DART run of ' + path + ' failed with exit code ' + str(exit_code))
+        elif self.postprocessor is not None:
+            try:
+                self.postprocessor.submit(path)
+            except Exception:
+                logging.exception('Could not read the retention policy of ' + path)
+        return status
+
+    def wait_postprocessing(self):
+        """
+        Wait until the retention policies of all finished runs are applied.
+
+        :return: (bytes before, bytes after) of the processed simulation directories
+        """
+        if self.postprocessor is None:
+            return 0, 0
+        return self.postprocessor.wait()
+
+    def _command(self, dart_path, path):
+        """
+        DART command line for a simulation directory, simulations with a sequence file are run by the sequence launcher.
+        """
+        from . import sequence
+        sequence_file = utils.general.create_path(path, sequence.SEQUENCE_FILE)
+        if not os.path.exists(sequence_file):
+            return [dart_path, path]
+
+        sequence_path = self.sequence_path
+        if sequence_path is None:
+            directory, name = os.path.split(dart_path)
+            sequence_path = os.path.join(directory, sequence.SEQUENCE_LAUNCHER + os.path.splitext(name)[1])
+        return [sequence_path, sequence_file, '-start']
+
+    def _dart_path(self, path):
+        if self.dart_path is not None:
+            return self.dart_path
+
+        from .simulation import CONFIG_FILE_NAME
+        config = toml.loads(archive.read_text(utils.general.create_path(path, CONFIG_FILE_NAME)), _dict=dict)
+        return config['dart_path']
+
+    def _set_threads(self, path):
+        if self.threads is not None:
+            from . import tuning
+            tuning.set_threads(path, self.threads)
+
+    @staticmethod
+    def _path(simulation):
+        if type(simulation) is str:
+            return simulation
+        return simulation.path
+
+    @staticmethod
+    def status(path):
+        """
+        Run status of a simulation directory.
+
+        :param path:
+        :return: status dict with state, attempts, exit_code and duration or None if the simulation was never run
+        """
+        status_path = utils.general.create_path(path, RUN_STATUS_FILE)
+        if not os.path.exists(status_path):
+            return None
+        with open(status_path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def _write_status(path, status):
+        status_path = utils.general.create_path(path, RUN_STATUS_FILE)
+        with open(status_path + '.tmp', 'w') as f:
+            json.dump(status, f)
+        os.replace(status_path + '.tmp', status_path)
 
-    def run(self, *args, **kwargs):
-        raise NotImplemented
 
-    def _dart_run(self, *args, **kwargs):
-        raise NotImplemented
+class _DartFailed(Exception):
+    def __init__(self, exit_code):
+        Exception.__init__(self, 'DART exited with ' + str(exit_code))
+        self.exit_code = exit_code
@@ -0,0 +1,507 @@
+"""
+Config validation against the schema implied by the default config of a DART version (see default_params).
+
+Every parameter of the default config defines the kind of value it accepts: numbers, flags (booleans), strings, lists
+of those, tables and arrays of tables. The default config is compiled once per file into a tree of validators, a few
+parameters get additional constraints (CONSTRAINTS) and some parameters have to agree with each other (CROSS_RULES).
+
+Validation collects all errors instead of stopping at the first one:
+
+    errors = schema.for_version('5.7.5').validate(config, components=['phase', 'directions'])
+
+Parameters that are missing from a component config are errors unless the component is patched with an xml file
+(partial), unknown parameters are only logged since the writers ignore them.
+"""
+import collections
+import functools
+import itertools
+import json
+import logging
+import re
+import numbers
+import os
+
+import utils.general
+
+toml = utils.general.lazy_import('toml')
+
+
+def _choices(*values):
+    def check(value):
+        if str(value) not in [str(v) for v in values]:
+            return 'must be one of ' + ', '.join(str(v) for v in values)
+    return check
+
+
+def _between(lower=None, upper=None):
+    def check(value):
+        if (lower is not None and float(value) < lower) or (upper is not None and float(value) > upper):
+            return 'must be in [' + str('-inf' if lower is None else lower) + ', ' + \
+                   str('inf' if upper is None else upper) + ']'
+    return check
+
+
+def _positive(value):
+    if float(value) <= 0:
+        return 'must be positive'
+
+# constraints on the values (or list elements) of single parameters in addition to their kind
+CONSTRAINTS = {
+    'phase.calculatorMethod': _choices(0, 1, 2),
+    'phase.expert_flux_tracking.nbThreads': _between(lower=1),
+    'phase.spectral.deltaLambda': _positive,
+    'phase.spectral.meanLambda': _positive,
+    'phase.spectral.spectralDartMode': _choices(0, 1, 2),
+    'directions.numberOfPropagationDirections': _between(lower=1),
+    'directions.sun.sunViewingZenithAngle': _between(0, 90),
+    'directions.sun.sunViewingAzimuthAngle': _between(-360, 360),
+    'maket.voxelDim': _positive,
+    'maket.sceneDim': _between(lower=0),
+    'atmosphere.general.writeTransferFunctions': _choices(0, 1),
+    'atmosphere.general.inputOutputTransfertFunctions': _choices(0, 1),
+    'object3d.instancing': _choices(0, 1),
+    'postprocessing.compression_level': _between(1, 22),
+}
+
+
+def _same_length(*values):
+    if len(set(len(v) for v in values)) > 1:
+        return 'must have the same length, got ' + ', '.join(str(len(v)) for v in values)
+
+
+def _not_both(read, write):
+    if str(read) == '1' and str(write) == '1':
+        return 'transfer functions cannot be imported and written by the same simulation'
+
+
+# rules on several parameters of one component, checked once all parameters are valid on their own
+CROSS_RULES = [
+    (('phase.spectral.deltaLambda', 'phase.spectral.meanLambda', 'phase.spectral.spectralDartMode'), _same_length),
+    (('plots.vegetation.height', 'plots.vegetation.stDev', 'plots.vegetation.lai', 'plots.vegetation.ident',
+      'plots.vegetation.indexFctPhase'), _same_length),
+    (('plots.ground.ident', 'plots.ground.indexFctPhase', 'plots.ground.type'), _same_length),
+    (('atmosphere.general.inputOutputTransfertFunctions', 'atmosphere.general.writeTransferFunctions'), _not_both),
+]
+
+
+class _Value(object):
+    """
+    Scalar parameter: number, flag or string.
+    """
+
+    def __init__(self, kind, constraint=None):
+        self.kind = kind
+        self.constraint = constraint
+
+    def check(self, value, path, errors, partial=False, skip=()):
+        message = self.message(value)
+        if message is not None:
+            errors.append(path + ' = ' + repr(value) + ': ' + message)
+
+    def message(self, value):
+        if value is None:
+            return 'is not set'
+        if self.kind == 'number':
+            if isinstance(value, bool) or not _is_number(value):
+                return 'must be a number'
+        elif self.kind == 'flag':
+            if value not in (True, False, 0, 1) and str(value) not in ('0', '1'):
+                return 'must be a boolean, 0 or 1'
+        elif isinstance(value, (dict, list, tuple)):
+            return 'must be a string'
+        if self.constraint is not None:
+            return self.constraint(value)
+
+
+class _List(object):
+    def __init__(self, element):
+        self.element = element
+
+    def check(self, value, path, errors, partial=False, skip=()):
+        if not isinstance(value, (list, tuple)):
+            errors.append(path + ' = ' + repr(value) + ': must be a list')
+            return
+        for i, v in enumerate(value):
+            self.element.check(v, path + '[' + str(i) + ']', errors)
+
+
+class _Any(object):
+    """
+    Parameter accepting any of several forms, e.g. 'auto' or a list of numbers.
+    """
+
+    def __init__(self, description, *forms):
+        self.description = description
+        self.forms = forms
+
+    def check(self, value, path, errors, partial=False, skip=()):
+        for form in self.forms:
+            form_errors = []
+            form.check(value, path, form_errors)
+            if not form_errors:
+                return
+        errors.append(path + ' = ' + repr(value) + ': must be ' + self.description)
+
+
+class _Table(object):
+    def __init__(self, children, optional=()):
+        """
+        :param children: OrderedDict name -> validator
+        :param optional: names that may be missing
+        """
+        self.children = children
+        self.optional = optional
+
+    def check(self, value, path, errors, partial=False, skip=()):
+        if not isinstance(value, dict):
+            errors.append(path + ': must be a table')
+            return
+        for name, node in self.children.items():
+            key = path + '.' + name if path else name
+            if _skipped(key, skip):
+                continue
+            if name not in value:
+                if isinstance(node, _Table) and _skipped(key, skip, prefix=True):
+                    # a table holding skipped parameters only misses its other parameters
+                    node.check({}, key, errors, partial=partial or name in self.optional, skip=skip)
+                elif not partial and name not in self.optional:
+                    errors.append(key + ': is missing')
+                continue
+            node.check(value[name], key, errors, partial=partial, skip=skip)
+
+        unknown = [name for name in value if name not in self.children]
+        if unknown:
+            logging.warning('Unknown parameters ' + ', '.join((path + '.' if path else '') + str(name)
+                                                             for name in unknown) + ' are ignored')
+
+
+def _skipped(key, skip, prefix=False):
+    """
+    :param key: parameter path, array elements as [i]
+    :param skip: dotted parameter paths, array elements as .i
+    :param prefix: whether key is skipped if it holds a skipped parameter
+    :return:
+    """
+    if not skip:
+        return False
+    key = re.sub(r'\[(\d+)\]', r'.\1', key)
+    if key in skip:
+        return True
+    return prefix and any(k.startswith(key + '.') for k in skip)
+
+
+class _Tables(object):
+    """
+    Array of tables, every element is checked against the first table of the default.
+    """
+
+    def __init__(self, element):
+        self.element = element
+
+    def check(self, value, path, errors, partial=False, skip=()):
+        if not isinstance(value, (list, tuple)):
+            errors.append(path + ': must be an array of tables')
+            return
+        for i, v in enumerate(value):
+            self.element.check(v, path + '[' + str(i) + ']', errors, partial=partial, skip=skip)
+
+
+class _Mapping(object):
+    """
+    Table with arbitrary names, e.g. idents, every value is checked against the same validator.
+    """
+
+    def __init__(self, element):
+        self.element = element
+
+    def check(self, value, path, errors, partial=False, skip=()):
+        if not isinstance(value, dict):
+            errors.append(path + ': must be a table')
+            return
+        for name, v in value.items():
+            self.element.check(v, path + '.' + str(name), errors, partial=partial, skip=skip)
+
+
+# indexFctPhase of optical property links, see simulation.optical
+_FCT_PHASE = _Any("'auto' or a non negative number", _Value('str', _choices('auto')), _Value('number', _between(lower=0)))
+
+# parameters whose default does not show all accepted forms
+OVERRIDES = {
+    'object3d.dim': _Any("'auto' or a list of non negative numbers", _Value('str', _choices('auto')),
+                         _List(_Value('number', _between(lower=0)))),
+    'object3d.optical_property.indexFctPhase': _FCT_PHASE,
+    'maket.optical_property.indexFctPhase': _FCT_PHASE,
+    'plots.vegetation.indexFctPhase': _List(_FCT_PHASE),
+    'plots.ground.indexFctPhase': _List(_FCT_PHASE),
+}
+
+
+_LEAF = ['Cab', 'Car', 'Anth', 'Cbrown', 'Cw', 'Cm']
+
+# optional top level tables of every version, only validated if present
+EXTENSIONS = {
+    # see simulation.prospect
+    'prospect': _Table(collections.OrderedDict([
+        ('coefficients', _Value('str')),
+        ('database_dir', _Value('str')),
+        ('models', _Mapping(_Table(collections.OrderedDict(
+            [('N', _Value('number', _between(lower=1)))] + [(p, _Value('number', _between(lower=0))) for p in _LEAF]),
+            optional=['N'] + _LEAF)))]), optional=['database_dir', 'models']),
+}
+
+
+class Schema(object):
+    def __init__(self, default):
+        """
+        :param default: default config dict
+        """
+        self.root = _compile(default, '')
+        for name, node in EXTENSIONS.items():
+            self.root.children.setdefault(name, node)
+        self.cross_rules = [(keys, rule) for keys, rule in CROSS_RULES if all(self.node(k) is not None for k in keys)]
+
+    @classmethod
+    def from_file(cls, path):
+        return _from_file(os.path.abspath(path))
+
+    def node(self, key):
+        """
+        Validator of a dotted parameter path, elements of arrays of tables are addressed by their index.
+
+        :param key: e.g. 'phase.spectral.meanLambda' or 'coeff_diff.lop3d.model.0.lad'
+        :return: validator or None if the schema has no such parameter
+        """
+        node = self.root
+        for name in key.split('.'):
+            if isinstance(node, _Tables):
+                if not name.isdigit():
+                    return None
+                node = node.element
+            elif isinstance(node, _Mapping):
+                node = node.element
+            elif isinstance(node, _Table) and name in node.children:
+                node = node.children[name]
+            else:
+                return None
+        return node
+
+    def validate(self, config, components=None, partial=(), skip=()):
+        """
+        Validate a config.
+
+        :param config: config dict
+        :param components: component names to validate completely, defaults to all tables of the schema. The other
+                           tables are only validated if present in config.
+        :param partial: components whose missing parameters are not an error, e.g. patched with an xml file
+        :param skip: dotted parameter paths not to validate (and not to require)
+        :return: list of error messages
+        """
+        errors, validated = [], set()
+        for name, node in self.root.children.items():
+            if not isinstance(node, _Table):
+                continue
+            required = (components is None or name in components) and name not in EXTENSIONS
+            if not required and name not in config:
+                continue
+            if name not in config:
+                if name not in partial:
+                    errors.append(name + ': is missing')
+                continue
+            if not required and _is_component(name):
+                # not generated, e.g. copied from a base simulation
+                continue
+            node.check(config[name], name, errors, partial=name in partial or not (required or name in EXTENSIONS),
+                       skip=skip)
+            validated.add(name)
+
+        for keys, rule in self.cross_rules:
+            if keys[0].split('.')[0] not in validated or any(k in skip or _has_error(errors, k) for k in keys):
+                continue
+            values = [_lookup(config, k) for k in keys]
+            if any(v is None for v in values):
+                continue
+            _apply(rule, keys, values, errors)
+        return errors
+
+    def validate_component(self, name, params, partial=False):
+        """
+        :param name: component name, e.g. 'phase'
+        :param params: component params dict
+        :param partial: whether missing parameters are allowed
+        :return: list of error messages
+        """
+        return self.validate({name: params}, components=[name], partial=[name] if partial else [])
+
+    def validate_patch(self, config, patch, components=None, partial=()):
+        """
+        Validate only what a patch changes in an already validated config: the patched parameters and the cross
+        parameter rules involving them.
+
+        :param config: validated config
+        :param patch: nested config patch
+        :param components: see validate, patching another component is an error as the patch would not be applied
+        :param partial: see validate
+        :return: list of error messages
+        """
+        errors, patched = [], set()
+        for key, value in utils.general.flatten_dict(patch).items():
+            name = key.split('.')[0]
+            if components is not None and name not in components and _is_component(name):
+                errors.append(key + ': the ' + name + ' component is not generated from the config and cannot be '
+                              'patched')
+                continue
+            node = self.node(key)
+            if node is None:
+                errors.append(key + ': is not a parameter')
+                continue
+            node.check(value, key, errors, partial=name in partial)
+            patched.add(key)
+
+        for keys, rule in self.cross_rules:
+            if not patched.intersection(keys) or any(_has_error(errors, k) for k in keys):
+                continue
+            values = [_lookup(patch, k) for k in keys]
+            values = [_lookup(config, k) if v is None else v for k, v in zip(keys, values)]
+            if all(v is not None for v in values):
+                _apply(rule, keys, values, errors)
+        return errors
+
+    def validate_sweep(self, config, parameters, mode='product', components=None, partial=()):
+        """
+        Validate all variants of a sweep without building them. The shared config is validated once, every swept
+        parameter once per distinct value and the cross parameter rules once per distinct combination of the swept
+        parameters they involve.
+
+        :param config: config shared by all variants
+        :param parameters: dict dotted parameter path -> list of values
+        :param mode: 'product' or 'zip'
+        :param components: see validate
+        :param partial: see validate
+        :return: list of error messages
+        """
+        swept = set(parameters)
+        errors = self.validate(config, components=components, partial=partial, skip=swept)
+
+        for key, values in parameters.items():
+            name = key.split('.')[0]
+            if components is not None and name not in components and _is_component(name):
+                continue
+            node = self.node(key)
+            if node is None:
+                errors.append(key + ': is not a parameter')
+                continue
+            for value in _unique(values):
+                node.check(value, key, errors, partial=name in partial)
+
+        for keys, rule in self.cross_rules:
+            axes = [k for k in keys if k in swept]
+            generated = components is None or keys[0].split('.')[0] in components
+            if not axes or not generated or any(_has_error(errors, k) for k in keys):
+                continue
+            if mode == 'zip':
+                combinations = _unique(zip(*[parameters[k] for k in axes]))
+            else:
+                combinations = itertools.product(*[_unique(parameters[k]) for k in axes])
+            fixed = [_lookup(config, k) for k in keys]
+            for combination in combinations:
+                swept_values = dict(zip(axes, combination))
+                values = [swept_values[k] if k in swept_values else v for k, v in zip(keys, fixed)]
+                if all(v is not None for v in values):
+                    _apply(rule, keys, values, errors, ' (swept ' + ', '.join(
+                        k + ' = ' + repr(swept_values[k]) for k in axes) + ')')
+        return errors
+
+
+def check(errors, what):
+    """
+    Raise an Exception listing all errors, if any.
+
+    :param errors: list of error messages
+    :param what: what was validated, e.g. the simulation name
+    :return:
+    """
+    if errors:
+        raise Exception(what + ' is invalid (' + str(len(errors)) + ' errors):\n    ' + '\n    '.join(errors))
+
+
+def for_version(version, default_config=None):
+    """
+    :param version: DART version
+    :param default_config: default config file, defaults to the one of the closest lower version
+    :return: Schema or None if there is no default config for the version
+    """
+    if default_config is None:
+        from .simulation import default_config_path
+        default_config = default_config_path(version)
+        if default_config is None:
+            return None
+    return Schema.from_file(default_config)
+
+
+@functools.lru_cache(maxsize=None)
+def _from_file(path):
+    return Schema(toml.load(path, _dict=dict))
+
+
+def _compile(default, path):
+    if path in OVERRIDES:
+        return OVERRIDES[path]
+    if isinstance(default, dict):
+        return _Table(collections.OrderedDict((name, _compile(value, path + '.' + name if path else name))
+                                              for name, value in default.items()))
+    if isinstance(default, list):
+        if default and all(isinstance(v, dict) for v in default):
+            return _Tables(_compile(default[0], path))
+        kinds = set(_kind(v) for v in default)
+        return _List(_Value(kinds.pop() if len(kinds) == 1 else 'str', CONSTRAINTS.get(path)))
+    return _Value(_kind(default), CONSTRAINTS.get(path))
+
+
+def _kind(value):
+    if isinstance(value, bool):
+        return 'flag'
+    if isinstance(value, numbers.Number):
+        return 'number'
+    return 'str'
+
+
+def _is_number(value):
+    if isinstance(value, numbers.Number):
+        return True
+    try:
+        float(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def _is_component(name):
+    from .simulation import COMPONENTS
+    return name in COMPONENTS
+
+
+def _lookup(config, key):
+    for name in key.split('.'):
+        if not isinstance(config, dict) or name not in config:
+            return None
+        config = config[name]
+    return config
+
+
+def _has_error(errors, key):
+    return any(e.startswith(key + ' ') or e.startswith(key + '[') or e.startswith(key + ':') for e in errors)
+
+
+def _apply(rule, keys, values, errors, suffix=''):
+    message = rule(*values)
+    if message is not None:
+        errors.append(', '.join(keys) + ': ' + message + suffix)
+
+
+def _unique(values):
+    seen = set()
+    for value in values:
+        key = json.dumps(value, sort_keys=True, default=str)
+        if key not in seen:
+            seen.add(key)
+            yield value
@@ -0,0 +1,354 @@
+"""
+Resampling of the DART band outputs to the spectral bands of a sensor.
+
+DART writes one output directory per simulated band (output/BAND<i>). A sensor band is the average of the simulated
+bands weighted by its spectral response function (SRF). The weights only depend on the band table and the SRF, they
+are computed once per band table and kept as a sparse matrix, most sensor bands only see a few simulated bands:
+
+    [postprocessing]
+    sensor_response = '/data/srf/S2A_MSI.csv'     # wavelength (nm or micrometer) and one response column per band
+    sensor_name = 'S2A'
+    sensor_images = ['BRF/*/IMAGES_DART/*.mp#']   # binary float64 images, relative to output/BAND<i>
+    sensor_tables = ['BRF/*/brf']                 # text tables, their last column is resampled
+
+The products are written to output/SENSOR_<sensor_name>/BAND<k> with the same relative paths, together with
+bands.json describing the sensor bands. Images are streamed in chunks through all simulated bands at once, so memory
+stays bounded by chunk_size whatever the size of the images and the number of bands. Outputs compressed by a retention
+policy are read transparently.
+
+Resampling runs before the retention policy, which can then drop the simulated bands.
+"""
+import functools
+import glob
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import utils.general
+import utils.timing
+from .postprocessing import COMPRESSED_SUFFIX, open_output, read_config
+
+np = utils.general.lazy_import('numpy')
+
+OUTPUT_DIR = 'output'
+SENSOR_PREFIX = 'SENSOR_'
+BANDS_FILE = 'bands.json'
+
+# DART images are raw little endian float64 arrays
+IMAGE_DTYPE = '<f8'
+
+# pixels per chunk, memory is about (simulated bands + sensor bands) * chunk_size * 8 bytes
+CHUNK_SIZE = 1 << 16
+
+# weights below this fraction of the largest weight of a sensor band are dropped
+TOLERANCE = 1e-6
+
+
+def load_response(path):
+    """
+    Spectral response table, loaded once as long as the file does not change.
+
+    :param path: text table (comma or whitespace separated) with the wavelength in the first column and the response of
+                 one band per further column, an optional header line names the bands
+    :return: SpectralResponse
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    stat = os.stat(path)
+    return _load_response(path, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=16)
+def _load_response(path, mtime_ns, size):
+    with open(path) as f:
+        lines = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    delimiter = ',' if ',' in lines[0] else None
+    names = None
+    try:
+        float(lines[0].split(delimiter)[0])
+    except ValueError:
+        names = [n.strip() for n in lines[0].split(delimiter)[1:]]
+        lines = lines[1:]
+    table = np.array([[float(v) for v in line.split(delimiter)] for line in lines])
+    return SpectralResponse(table[:, 0], table[:, 1:].T, names=names)
+
+
+class SpectralResponse(object):
+    def __init__(self, wavelength, responses, names=None):
+        """
+        :param wavelength: sampled wavelengths in micrometer, nanometer if any is above 100
+        :param responses: array of shape (sensor bands, wavelengths)
+        :param names: band names, defaults to B0, B1, ...
+        """
+        wavelength = np.asarray(wavelength, dtype=float)
+        responses = np.atleast_2d(np.asarray(responses, dtype=float))
+        if responses.shape[1] != len(wavelength):
+            raise Exception('Spectral response has ' + str(responses.shape[1]) + ' samples per band but ' +
+                            str(len(wavelength)) + ' wavelengths.')
+        if wavelength.max() > 100:
+            wavelength = wavelength / 1000.
+        order = np.argsort(wavelength)
+        self.wavelength = wavelength[order]
+        self.responses = responses[:, order]
+        self.names = list(names) if names else ['B' + str(k) for k in range(len(self.responses))]
+        if len(self.names) != len(self.responses):
+            raise Exception('Spectral response has ' + str(len(self.responses)) + ' bands but ' +
+                            str(len(self.names)) + ' names.')
+
+    @classmethod
+    def gaussian(cls, centres, fwhms, names=None, step=0.0005):
+        """
+        Gaussian responses.
+
+        :param centres: band centres in micrometer
+        :param fwhms: full widths at half maximum in micrometer
+        :param names:
+        :param step: sampling of the responses in micrometer
+        :return: SpectralResponse
+        """
+        centres, fwhms = np.asarray(centres, dtype=float), np.asarray(fwhms, dtype=float)
+        wavelength = np.arange((centres - 2 * fwhms).min(), (centres + 2 * fwhms).max() + step, step)
+        sigmas = fwhms / (2 * np.sqrt(2 * np.log(2)))
+        responses = np.exp(-0.5 * ((wavelength[None, :] - centres[:, None]) / sigmas[:, None]) ** 2)
+        return cls(wavelength, responses, names=names)
+
+    def centres(self):
+        """
+        :return: response weighted mean wavelength of each band in micrometer
+        """
+        return self._cumulative(self.responses * self.wavelength)[:, -1] / self._cumulative(self.responses)[:, -1]
+
+    def weights(self, mean_lambda, delta_lambda):
+        """
+        Weights of the simulated bands in each sensor band: the integral of the response over each simulated band,
+        normalized to sum to 1 per sensor band.
+
+        :param mean_lambda: centres of the simulated bands in micrometer
+        :param delta_lambda: widths of the simulated bands in micrometer
+        :return: Weights
+        """
+        mean_lambda, delta_lambda = np.asarray(mean_lambda, dtype=float), np.asarray(delta_lambda, dtype=float)
+        lower, upper = mean_lambda - delta_lambda / 2, mean_lambda + delta_lambda / 2
+
+        # cumulative integral of every response, evaluated at the band edges
+        dense = np.array([np.interp(upper, self.wavelength, c) - np.interp(lower, self.wavelength, c)
+                          for c in self._cumulative(self.responses)])
+
+        totals = dense.sum(axis=1)
+        uncovered = [self.names[k] for k in np.flatnonzero(totals <= 0)]
+        if uncovered:
+            raise Exception('Sensor bands ' + ', '.join(uncovered) + ' do not overlap any simulated band.')
+        dense /= totals[:, None]
+        dense[dense < TOLERANCE * dense.max(axis=1, keepdims=True)] = 0.
+        return Weights(dense)
+
+    def _cumulative(self, values):
+        """
+        :param values: array of shape (bands, wavelengths)
+        :return: cumulative trapezoidal integrals over the wavelength, same shape
+        """
+        steps = (values[:, 1:] + values[:, :-1]) / 2 * np.diff(self.wavelength)
+        return np.concatenate([np.zeros((len(values), 1)), np.cumsum(steps, axis=1)], axis=1)
+
+
+class Weights(object):
+    """
+    Sparse (compressed row) matrix of shape (sensor bands, simulated bands). Only the simulated bands with a weight in
+    some sensor band (self.bands) have to be read.
+    """
+
+    def __init__(self, dense):
+        rows, columns = np.nonzero(dense)
+        self.shape = dense.shape
+        self.bands = np.unique(columns)
+        # column indices into self.bands, so inputs only hold the used bands
+        self.indices = np.searchsorted(self.bands, columns)
+        self.data = dense[rows, columns] / dense.sum(axis=1)[rows]
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=dense.shape[0]))])
+
+    def apply(self, values, out=None):
+        """
+        :param values: array of shape (len(self.bands), n), the values of the used simulated bands
+        :param out: optional array of shape (sensor bands, n) to write to
+        :return: array of shape (sensor bands, n)
+        """
+        if out is None:
+            out = np.empty((self.shape[0], values.shape[1]))
+        for k in range(self.shape[0]):
+            start, stop = self.indptr[k], self.indptr[k + 1]
+            np.dot(self.data[start:stop], values[self.indices[start:stop]], out=out[k])
+        return out
+
+    def __len__(self):
+        return self.shape[0]
+
+
+class Resampling(object):
+    def __init__(self, response, name='sensor', images=None, tables=None, chunk_size=CHUNK_SIZE):
+        """
+        :param response (SpectralResponse):
+        :param name: sensor name, outputs are written to output/SENSOR_<name>
+        :param images (list of str): glob patterns of binary float64 images, relative to output/BAND<i>
+        :param tables (list of str): glob patterns of text tables whose last column is resampled
+        :param chunk_size: pixels read per band and chunk
+        """
+        self.response = response
+        self.name = name
+        self.images = list(images or [])
+        self.tables = list(tables or [])
+        self.chunk_size = chunk_size
+        self._weights = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: simulation config dict or path to a simulation directory
+        :return: Resampling, None if the config has no sensor response
+        """
+        if type(config) is str:
+            config = read_config(config)
+            if config is None:
+                return None
+        params = config.get('postprocessing') or {}
+        if not params.get('sensor_response'):
+            return None
+        return cls(load_response(params['sensor_response']), name=params.get('sensor_name') or 'sensor',
+                   images=params.get('sensor_images'), tables=params.get('sensor_tables'))
+
+    def weights(self, spectral):
+        """
+        :param spectral: phase.spectral params of a simulation
+        :return: Weights, shared by all simulations with the same band table
+        """
+        table = (tuple(float(v) for v in spectral['meanLambda']), tuple(float(v) for v in spectral['deltaLambda']))
+        with self._lock:
+            weights = self._weights.get(table)
+            if weights is None:
+                weights = self._weights[table] = self.response.weights(*table)
+        return weights
+
+    def output_dir(self, path):
+        return utils.general.create_path(path, OUTPUT_DIR, SENSOR_PREFIX + self.name)
+
+    def apply(self, path, config=None):
+        """
+        Resample the band outputs of a simulation directory. Applying it again rewrites the sensor products.
+
+        :param path: simulation directory
+        :param config: simulation config dict, read from path if not given
+        :return: list of written files
+        """
+        config = config if config is not None else read_config(path)
+        weights = self.weights(config['phase']['spectral'])
+        output = utils.general.create_path(path, OUTPUT_DIR)
+        band_dirs = [utils.general.create_path(output, 'BAND' + str(i)) for i in weights.bands]
+        missing = [d for d in band_dirs if not os.path.isdir(d)]
+        if missing:
+            raise Exception('Band outputs ' + ', '.join(missing) + ' do not exist.')
+
+        target = self.output_dir(path)
+        written = []
+        with utils.timing.span('sensor.apply', path=path, sensor=self.name):
+            for rel in _products(band_dirs[0], self.images):
+                written += self._resample_image([utils.general.create_path(d, rel) for d in band_dirs],
+                                                weights, target, rel)
+            for rel in _products(band_dirs[0], self.tables):
+                written += self._resample_table([utils.general.create_path(d, rel) for d in band_dirs],
+                                                weights, target, rel)
+
+            centres = self.response.centres()
+            bands = [{'band': k, 'name': n, 'centre': float(centres[k])} for k, n in enumerate(self.response.names)]
+            with open(utils.general.create_path(target, BANDS_FILE), 'w') as f:
+                json.dump({'sensor': self.name, 'bands': bands}, f, indent=2)
+
+        logging.info('Resampled ' + str(len(written)) + ' files of ' + path + ' to sensor ' + self.name)
+        return written
+
+    def _resample_image(self, sources, weights, target, rel):
+        readers = [open_output(s) for s in sources]
+        targets = _targets(target, rel, len(weights))
+        writers = [open(t + '.part', 'wb') for t in targets]
+        item = np.dtype(IMAGE_DTYPE).itemsize
+        values = np.empty((len(sources), self.chunk_size))
+        out = np.empty((len(weights), self.chunk_size))
+        try:
+            while True:
+                chunks = [r.read(self.chunk_size * item) for r in readers]
+                sizes = set(len(c) for c in chunks)
+                if len(sizes) > 1:
+                    raise Exception('Band images of ' + rel + ' differ in size.')
+                n = sizes.pop() // item
+                if n == 0:
+                    break
+                for i, chunk in enumerate(chunks):
+                    values[i, :n] = np.frombuffer(chunk, dtype=IMAGE_DTYPE, count=n)
+                weights.apply(values[:, :n], out=out[:, :n])
+                for k, writer in enumerate(writers):
+                    writer.write(out[k, :n].astype(IMAGE_DTYPE).tobytes())
+        finally:
+            for f in readers + writers:
+                f.close()
+        for t in targets:
+            os.replace(t + '.part', t)
+        return targets
+
+    def _resample_table(self, sources, weights, target, rel):
+        tables = []
+        for source in sources:
+            with open_output(source) as f:
+                tables.append(np.atleast_2d(np.loadtxt(f)))
+        if len(set(t.shape for t in tables)) > 1:
+            raise Exception('Band tables of ' + rel + ' differ in shape.')
+        resampled = weights.apply(np.array([t[:, -1] for t in tables]))
+        targets = _targets(target, rel, len(weights))
+        for k, t in enumerate(targets):
+            table = tables[0].copy()
+            table[:, -1] = resampled[k]
+            np.savetxt(t + '.part', table, fmt='%.9g')
+            os.replace(t + '.part', t)
+        return targets
+
+
+def resample(paths, resampling, jobs=2):
+    """
+    Resample the outputs of several simulations (e.g. the finished variants of a sweep) in parallel. Simulations
+    with the same band table share their weights.
+
+    :param paths: simulation directories
+    :param resampling (Resampling):
+    :param jobs: threads
+    :return: dict path -> list of written files, failed simulations are logged and left out
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = dict((pool.submit(resampling.apply, path), path) for path in paths)
+        for future, path in futures.items():
+            try:
+                results[path] = future.result()
+            except Exception:
+                logging.exception('Could not resample ' + path + ' to sensor ' + resampling.name)
+    return results
+
+
+def _products(band_dir, patterns):
+    """
+    :return: sorted relative paths of the files in band_dir matching any pattern, compressed files by their original
+             name
+    """
+    found = set()
+    for pattern in patterns:
+        for file_path in glob.glob(utils.general.create_path(band_dir, pattern)) + \
+                glob.glob(utils.general.create_path(band_dir, pattern + COMPRESSED_SUFFIX)):
+            if os.path.isfile(file_path):
+                rel = os.path.relpath(file_path, band_dir)
+                found.add(rel[:-len(COMPRESSED_SUFFIX)] if rel.endswith(COMPRESSED_SUFFIX) else rel)
+    return sorted(found)
+
+
+def _targets(target, rel, bands):
+    targets = [utils.general.create_path(target, 'BAND' + str(k), rel) for k in range(bands)]
+    for t in targets:
+        os.makedirs(os.path.dirname(t), exist_ok=True)
+    return targets
@@ -0,0 +1,186 @@
+"""
+DART sequence files: run all variants of a sweep in one launch of the DART sequencer instead of one DART process per
+variant, which saves the process startup and reuses the scene preprocessing.
+
+A sequence consists of groups of entries. Every entry varies one DART property over an enumerated list of values.
+Entries of one group vary together, the groups are combined as product. A product sweep thus becomes one group per
+parameter, a zip sweep a single group.
+
+DART property names (e.g. Directions.SunViewingAngles.sunViewingZenithAngle) are derived from the component writers:
+the parameter is written with a marker value and the attribute the marker ends up in is looked up in the xml. Every
+parameter the writers map to a single attribute is therefore supported, parameters that change the xml structure
+(e.g. atmosphere.general.typeOfAtmosphere) are not. Neither are the plots parameters: they are written once per plot
+of the land cover, which a sweep does not provide.
+"""
+import copy
+import json
+import logging
+import operator
+from functools import reduce
+
+import utils.general
+import utils.timing
+
+et = utils.general.lazy_import('lxml.etree')
+
+SEQUENCE_FILE = 'dartpy_sequence.xml'
+SEQUENCE_MANIFEST = 'dartpy_sequence.json'
+SEQUENCE_LAUNCHER = 'dart-sequence'
+
+_MARKER = '__dartpy_sequence__'
+
+# defaults of the sequencer, can be overridden by the sequence_preferences of a sweep
+PREFERENCES = {'numberParallelThreads': 1, 'dartLaunched': 'true', 'directionLaunched': 'true',
+               'phaseLaunched': 'true', 'maketLaunched': 'true', 'vegetationLaunched': 'true',
+               'atmosphereMaketLaunched': 'true', 'triangleFileProcessorLaunched': 'true',
+               'demGeneratorLaunched': 'true', 'deleteAll': 'false', 'deleteInputs': 'false',
+               'deleteAtmosphere': 'false', 'zippedResults': 'false', 'genMode': 'XML'}
+LUT_PREFERENCES = {'generateLUT': 'false'}
+
+
+def property_name(simulation, key, index=None):
+    """
+    DART property name of a config parameter.
+
+    :param simulation (Simulation): base simulation providing the component params
+    :param key: dotted config path, e.g. 'directions.sun.sunViewingZenithAngle'
+    :param index: element of a list valued parameter, e.g. the band of phase.spectral.meanLambda
+    :return: dotted DART property name
+    """
+    from .simulation import COMPONENTS
+
+    component_name, _, path = key.partition('.')
+    if component_name not in simulation.component_params or not path:
+        raise Exception(key + ' is not a parameter of a generated component, it cannot be sequenced.')
+
+    kwargs = dict(simulation.component_params[component_name])
+    params = copy.deepcopy(kwargs.pop('params'))
+    nodes = path.split('.')
+    try:
+        parent = reduce(operator.getitem, nodes[:-1], params)
+        if index is None:
+            parent[nodes[-1]] = _MARKER
+        else:
+            parent[nodes[-1]][index] = _MARKER
+
+        component = COMPONENTS[component_name](simulation.path, params, simulation.version, **kwargs)
+        component._write(params, check=False, **component._write_kwargs)
+    except Exception as e:
+        raise Exception(key + ' cannot be sequenced: ' + str(e))
+
+    for element in component.xml_root.iter():
+        for attribute, value in element.attrib.items():
+            if value == _MARKER:
+                return _element_path(element) + '.' + attribute
+    raise Exception(key + ' is not written to a single DART attribute, it cannot be sequenced.')
+
+
+def _element_path(element):
+    """
+    Dotted path of an element below the DartFile root, repeated siblings are indexed as Tag[i].
+    """
+    names = []
+    while element.getparent() is not None:
+        parent = element.getparent()
+        siblings = [e for e in parent if e.tag == element.tag]
+        name = element.tag
+        if len(siblings) > 1:
+            name += '[' + str(siblings.index(element)) + ']'
+        names.append(name)
+        element = parent
+    return '.'.join(reversed(names))
+
+
+class Sequence(object):
+    def __init__(self, name, groups, preferences=None):
+        """
+        :param name: sequence name
+        :param groups (list of list of tuples): groups of (DART property name, list of values)
+        :param preferences: DartSequencerPreferences overriding PREFERENCES
+        """
+        self.name = name
+        self.groups = groups
+        self.preferences = dict(PREFERENCES)
+        self.preferences.update(preferences or {})
+
+    def __len__(self):
+        return reduce(operator.mul, [len(group[0][1]) for group in self.groups if group], 1)
+
+    def to_xml(self, version):
+        root = et.Element('DartFile')
+        root.set('version', version)
+        descriptor = et.SubElement(root, 'DartSequencerDescriptor')
+        descriptor.set('sequenceName', 'sequence;;' + self.name)
+
+        entries = et.SubElement(descriptor, 'DartSequencerDescriptorEntries')
+        for i, group in enumerate(self.groups):
+            group_element = et.SubElement(entries, 'DartSequencerDescriptorGroup')
+            group_element.set('groupName', 'group' + str(i + 1))
+            for prop, values in group:
+                entry = et.SubElement(group_element, 'DartSequencerDescriptorEntry')
+                entry.set('args', ';'.join(str(v) for v in values))
+                entry.set('propertyName', prop)
+                entry.set('type', 'enumerate')
+
+        preferences = et.SubElement(descriptor, 'DartSequencerPreferences')
+        for k, v in sorted(self.preferences.items()):
+            preferences.set(k, _str(v))
+        lut_preferences = et.SubElement(descriptor, 'DartLutPreferences')
+        for k, v in sorted(LUT_PREFERENCES.items()):
+            lut_preferences.set(k, _str(v))
+        return root
+
+    def to_file(self, path, version, variants=None):
+        """
+        Write the sequence xml and a manifest of the variants in sequence order to a simulation directory.
+
+        :param path: directory of the base simulation
+        :param version: DART version
+        :param variants: variants in the order of the sequence runs
+        :return: path of the sequence file
+        """
+        sequence_path = utils.general.create_path(path, SEQUENCE_FILE)
+        with utils.timing.span('file.write', path=sequence_path):
+            et.ElementTree(self.to_xml(version)).write(sequence_path, pretty_print=True, xml_declaration=True,
+                                                       encoding='UTF-8')
+        with open(utils.general.create_path(path, SEQUENCE_MANIFEST), 'w') as f:
+            json.dump({'name': self.name, 'variants': [{'name': v.name, 'parameters': v.parameters}
+                                                      for v in variants or []]}, f, indent=2)
+        return sequence_path
+
+
+def from_sweep(sweep, simulation):
+    """
+    Sequence covering all variants of a sweep.
+
+    :param sweep (Sweep):
+    :param simulation (Simulation): base simulation, e.g. the first variant of the sweep
+    :return: Sequence
+    """
+    groups = []
+    for key, values in sweep.parameters.items():
+        if values and isinstance(values[0], (list, tuple)):
+            # list valued parameters vary element wise, all elements in one group
+            lengths = set(len(v) for v in values)
+            if len(lengths) > 1:
+                raise Exception('All values of ' + key + ' must have the same length to be sequenced.')
+            group = [(property_name(simulation, key, i), [v[i] for v in values]) for i in range(lengths.pop())]
+        else:
+            group = [(property_name(simulation, key), list(values))]
+
+        if sweep.mode == 'zip' and groups:
+            groups[0].extend(group)
+        else:
+            groups.append(group)
+
+    sequence = Sequence(sweep.name, groups, preferences=sweep.sequence_preferences)
+    logging.info('Sequence ' + sweep.name + ' with ' + str(len(sequence)) + ' runs: ' +
+                 ', '.join(prop for group in groups for prop, _ in group))
+    return sequence
+
+
+def _str(value):
+    if type(value) is bool:
+        return 'true' if value else 'false'
+    return str(value)
+
@@ -1,18 +1,29 @@
 
 import utils.xml_utils
+from . import archive
 from . import components as cmp
+from . import optical
 from . import run
+from . import schema
 import utils.general
+import utils.timing
 
-import toml
+import copy
+import functools
+import itertools
 import logging
-from pkg_resources import parse_version
-import dill
+from utils.general import parse_version
 import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from time import gmtime, strftime
 import re
 
 
+toml = utils.general.lazy_import('toml')
+dill = utils.general.lazy_import('dill')
+
 COMPONENTS = {'atmosphere': cmp.Atmosphere, 'phase': cmp.Phase, 'directions': cmp.Directions, 'plots': cmp.Plots,
               'coeff_diff': cmp.CoeffDiff, 'object3d': cmp.Object3d, 'maket': cmp.Maket, 'inversion': cmp.Inversion,
               'trees': cmp.Trees, 'triangleFile': cmp.TriangleFile, 'urban': cmp.Urban, 'water': cmp.Water}
@@ -22,16 +33,54 @@ DEFAULT_CONFIG_FILE_PER_VERSION = {'5.7.5': '../default_params/default575.toml'}
 DILL_FIL = 'simulation.dill'
 
 
+def default_config_path(version):
+    """
+    :param version: DART version
+    :return: path of the default config of the most recent version still before version, None if there is none
+    """
+    path_ver = [(path, parse_version(v)) for v, path in DEFAULT_CONFIG_FILE_PER_VERSION.items()
+                if parse_version(v) <= parse_version(version)]
+    if not path_ver:
+        return None
+    path_ver.sort(key=lambda i: i[1])
+    return utils.general.create_path(os.path.dirname(os.path.abspath(__file__)), path_ver[-1][0])
+
+
+def load_config(path):
+    """
+    Parsed config file. A file is only parsed again once it changed, so long-lived processes (see simulation.daemon)
+    parse the default configs and base simulations once. Every call returns its own copy.
+
+    :param path: config file, may be a member of a packed simulation
+    :return: config dict
+    """
+    located = None if os.path.exists(path) else archive.locate(path)
+    if located is None and not os.path.exists(path):
+        raise Exception('config file path ' + path + ' does not exist')
+    stat = os.stat(path if located is None else archive.archive_path(located[0]))
+    return copy.deepcopy(_parse_config(os.path.abspath(path), stat.st_mtime_ns, stat.st_size))
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_config(path, mtime_ns, size):
+    with utils.timing.span('config.load', path=path):
+        return toml.loads(archive.read_text(path), _dict=dict)
+
+
 class Simulation(object):
     def __init__(self, config, default_config=None, default_patch=True, xml_patch=None, land_cover=None, maket=None,
                  no_gen=None, version='5.7.5', simulation_name='new', simulation_location='./test_simulations',
-                 dart_path=None, *args, **kwargs):
+                 dart_path=None, validate=True, *args, **kwargs):
         """
         Create a new simulation. Configs are patched in the following order: xml_patch, default_patch, config, args
 
         :param config (str, dict or list of str and dict): paths to config files or config dicts, higher indices override
         :param default_config (path or bool): if True get default to closest lower version
         :param xml_patch (list of tuples): tuples of the form (component_name, path)
+        :param land_cover: land cover passed to the plots component
+        :param maket: DEM of the scene topography, 2d numpy array or path to a .npy file (memory mapped)
+        :param validate: validate the config before creating the simulation directory, see validate. Only skip this
+                         if the config was validated already, e.g. by a sweep.
         :param args:
         :param kwargs:
         """
@@ -42,6 +91,7 @@ class Simulation(object):
 
         self.land_cover = land_cover
         self.maket = maket
+        self._maket_cache = None
 
         self.components = {}
         self.component_params = {}
@@ -61,20 +111,27 @@ class Simulation(object):
             else:
                 self.config = self._patch_to_default(init_user_config)
         else:
-            if not hasattr(config, '__iter__') or type(config) is str:
+            if not hasattr(config, '__iter__') or type(config) in (str, dict):
                 config = [config]
 
             patched_config = {}
             for conf in config:
                 if type(conf) is str:
-                    conf = toml.load(conf, _dict=dict)
+                    conf = load_config(conf)
                 patched_config = utils.general.merge_dicts(src_dict=patched_config, patch_dict=conf)
 
             self.config = self._patch_configs(patched_config, init_user_config, [None])
             if default_patch:
                 self.config = self._patch_to_default(self.config)
 
+        if self.config.get('prospect'):
+            # lop3d spectra computed from leaf biochemistry
+            from . import prospect
+            self.config = prospect.apply(self.config)
+
         self._split_config()
+        if validate:
+            schema.check(self.validate(), 'Config of simulation ' + str(self.config.get('simulation_name')))
         self._create_simulation_dir(self.config, *args, **kwargs)
         self._generate_components(ignore=self.non_generated_components, xml_patch=self.xml_patch)
 
@@ -85,8 +142,7 @@ class Simulation(object):
 
     @classmethod
     def load(cls, path):
-        with open(utils.general.create_path(path, DILL_FIL), 'rb') as f:
-            return dill.load(f)
+        return dill.loads(archive.read(utils.general.create_path(path, DILL_FIL)))
 
     @classmethod
     def from_simulation(cls, base_path, config=None, default_patch=False, simulation_patch=True, xml_patch=None,
@@ -95,8 +151,9 @@ class Simulation(object):
         Create a new simulation based on an existing simulation directory. Configs are patched in the following order:
         xml_patch, default_patch, base_simulation_config, config, args
 
-        :param default_config (path or bool): if True get default to closest lower version
         :param base_path: path to the base simulation
+        :param config (str, dict or list of str and dict): paths to config files or config dicts, higher indices
+                                                           override
         :param simulation_patch (bool): whether to patch config to the base simulation config
         :param xml_patch (str or list of str or list of tuples): component names or tuples of the form (name, path),
                                                   if only name is supplied the component xml of the base simulation
@@ -112,19 +169,28 @@ class Simulation(object):
 
         simulation_config_path = utils.general.create_path(base_path, CONFIG_FILE_NAME)
 
-        user_config_valid = config is not None and os.path.exists(config)
-        if not user_config_valid and config is not None:
-            raise Exception('config file path does not exist')
+        if config is not None and (not hasattr(config, '__iter__') or type(config) in (str, dict)):
+            config = [config]
 
-        simulation_patch_valid = simulation_patch and os.path.exists(simulation_config_path)
+        for conf in config or []:
+            if type(conf) is str and not os.path.exists(conf):
+                raise Exception('config file path ' + conf + ' does not exist')
+        user_config_valid = config is not None and len(config) != 0
+
+        simulation_patch_valid = simulation_patch and archive.exists(simulation_config_path)
 
         # if there is a config_file in the simulation directory and a user config, the configs are patched
         if simulation_patch_valid and user_config_valid:
-            config = Simulation._patch_configs(toml.load(simulation_config_path, _dict=dict), toml.load(config, _dict=dict))
+            patched_config = load_config(simulation_config_path)
+            for conf in config:
+                if type(conf) is str:
+                    conf = load_config(conf)
+                patched_config = Simulation._patch_configs(patched_config, conf)
+            config = patched_config
 
         # if there is no user config but a config in the simulation directory and simulation_patch=True
         elif simulation_patch_valid and not user_config_valid:
-            config = simulation_config_path
+            config = load_config(simulation_config_path)
 
         if os.path.exists(base_path):
             # generate valid xml_patch_path input
@@ -145,6 +211,84 @@ class Simulation(object):
             raise Exception('Simulation directory ' + base_path + ' does not exist.')
         return sim
 
+    @classmethod
+    def bulk_from_simulation(cls, base_path, patches, config=None, default_patch=False, simulation_patch=True,
+                             xml_patch=None, copy_xml=None, no_gen=None, force=False, link_assets=True,
+                             simulation_name='new', version=None, **kwargs):
+        """
+        Create many variants of one base simulation, see from_simulation. The base config is loaded, patched and
+        validated once and the xml files of the copy_xml components are parsed once and shared by all variants. Per
+        variant only its patch is applied and validated. All patches are validated before the first variant is created.
+
+        :param base_path: path to the base simulation
+        :param patches (list of dict): config patch of each variant, patches of copy_xml and no_gen components are
+                                       rejected
+        :param config (str, dict or list of str and dict): configs applied to all variants, see from_simulation
+        :param simulation_patch (bool): whether to patch config to the base simulation config
+        :param xml_patch: see from_simulation
+        :param copy_xml: see from_simulation
+        :param no_gen:
+        :param force: disregard version inconsistencies
+        :param link_assets: hard link the triangle files and lut.properties of copy_xml components instead of copying
+        :param simulation_name: variant i is named simulation_name_<i:05d>, e.g. new_00003
+        :param version: defaults to the version of the base simulation
+        :param kwargs: further Simulation arguments, e.g. simulation_location
+        :return: list of Simulation, write them with to_file or bulk_to_file
+        """
+        if not os.path.exists(base_path):
+            raise Exception('Simulation directory ' + base_path + ' does not exist.')
+
+        with utils.timing.span('simulation.bulk_from_simulation', base_path=base_path, variants=len(patches)):
+            if config is not None and (not hasattr(config, '__iter__') or type(config) in (str, dict)):
+                config = [config]
+
+            base_config = {}
+            simulation_config_path = utils.general.create_path(base_path, CONFIG_FILE_NAME)
+            if simulation_patch and archive.exists(simulation_config_path):
+                base_config = load_config(simulation_config_path)
+            for conf in config or []:
+                if type(conf) is str:
+                    conf = load_config(conf)
+                base_config = cls._patch_configs(base_config, conf)
+
+            version = version or base_config.get('version', '5.7.5')
+            if default_patch:
+                base_config = cls._patch_configs(load_config(default_config_path(version)), base_config)
+            base_config['version'] = version
+
+            xml_patch = cls._convert_component_to_path(xml_patch, base_path)
+            copy_xml = cls._convert_component_kwarg(copy_xml)
+            no_gen_tot = copy_xml.union(cls._convert_component_kwarg(no_gen))
+
+            # validate the base once and every patch on top of it, report all errors before creating anything
+            version_schema = schema.for_version(version)
+            if version_schema is not None:
+                generated = [name for name in COMPONENTS if name not in no_gen_tot]
+                patched = [name for name, _ in xml_patch]
+                errors = version_schema.validate(base_config, components=generated, partial=patched)
+                for i, patch in enumerate(patches):
+                    errors += ['variant ' + str(i) + ': ' + e for e in version_schema.validate_patch(
+                        base_config, patch, components=generated, partial=patched)]
+                schema.check(errors, 'Variants of ' + base_path)
+
+            copied = dict((comp, COMPONENTS[comp].from_simulation(simulation_dir=None, base_path=base_path,
+                                                                  version=version, force=force,
+                                                                  link_assets=link_assets))
+                          for comp in copy_xml)
+
+            simulations = []
+            for i, patch in enumerate(patches):
+                sim = cls([base_config, patch], default_patch=False, no_gen=no_gen_tot, xml_patch=xml_patch,
+                          version=version, simulation_name='{}_{:05d}'.format(simulation_name, i), validate=False,
+                          **kwargs)
+                for comp, component in copied.items():
+                    # the parsed xml is only read when copying, all variants share it
+                    component = copy.copy(component)
+                    component.simulation_dir = sim.path
+                    sim.components[comp] = component
+                simulations.append(sim)
+        return simulations
+
     @classmethod
     def _convert_component_to_path(cls, lis, simulation_dir_path):
         """
@@ -228,10 +372,11 @@ class Simulation(object):
         else:
             os.makedirs(self.path)
             self.user_config_path = utils.general.create_path(self.path, CONFIG_FILE_NAME)
-            with open(self.user_config_path, 'w+') as f:
+            with utils.timing.span('file.write', path=self.user_config_path), open(self.user_config_path, 'w+') as f:
                 f.write(toml.dumps(user_config))
 
-        with open(utils.general.create_path(self.path, DILL_FIL), 'wb') as f:
+        dill_path = utils.general.create_path(self.path, DILL_FIL)
+        with utils.timing.span('file.write', path=dill_path), open(dill_path, 'wb') as f:
             dill.dump(self, f, protocol=dill.HIGHEST_PROTOCOL)
 
     def __getstate__(self):
@@ -241,29 +386,40 @@ class Simulation(object):
         # dicts to builtin dict
         save.pop('config')
         save.pop('component_params')
+
+        # DEM arrays are referenced by their file in the DEM cache instead of pickled into every simulation
+        if self.maket is not None and type(self.maket) is not str:
+            if self.__dict__.get('_maket_cache') is None:
+                self._maket_cache = (cmp.cache_dem(self.maket), list(self.maket.shape))
+            save['maket'] = None
+            save['_maket_cache'] = self._maket_cache
         return save
 
     def __setstate__(self, state):
         self.__dict__ = state
+        cached = state.get('_maket_cache')
+        if cached is not None:
+            if os.path.exists(cached[0]):
+                self.maket = cmp.load_cached_dem(*cached)
+            else:
+                logging.warning('The DEM ' + cached[0] + ' of ' + str(state.get('path')) + ' is no longer cached, '
+                                'the maket is written without it.')
 
         # TODO: need this because of some toml dict type messing up the pickling, find way to cast these
         # dicts to builtin dict
-        self.config = toml.load(self.user_config_path)
+        self.config = toml.loads(archive.read_text(self.user_config_path))
         self.component_params = {}
         self._split_config()
 
+    @utils.timing.timed('config.patch_to_default')
     def _patch_to_default(self, user_config):
         if self.default_config is None:
-            # get most recent version still before this version
-            path_ver = [(path, parse_version(version))
-                        for version, path in DEFAULT_CONFIG_FILE_PER_VERSION.items()
-                        if parse_version(version) <= parse_version(user_config['version'])]
-            path_ver.sort(key=lambda i: i[1])
-            self.default_config = path_ver[-1][0]
+            self.default_config = default_config_path(user_config['version'])
 
-        return Simulation._patch_configs(toml.load(self.default_config, _dict=dict), user_config, ignore=[None])
+        return Simulation._patch_configs(load_config(self.default_config), user_config, ignore=[None])
 
     @staticmethod
+    @utils.timing.timed('config.patch')
     def _patch_configs(src_config, patch_config, ignore=None):
         valid = src_config.get('version') is None or patch_config.get('version') is None \
                 or src_config['version'] == patch_config['version']
@@ -273,14 +429,36 @@ class Simulation(object):
             raise Exception('Version inconsistency')
 
     def _split_config(self):
+        # resolves the indexFctPhase of the optical property links, see simulation.optical
+        library = optical.OpticalLibrary.from_params(self.config.get('coeff_diff'))
         self.component_params['phase'] = {'params': self.config.get('phase')}
         self.component_params['directions'] = {'params': self.config.get('directions')}
-        self.component_params['maket'] = {'params': self.config.get('maket')}
+        self.component_params['maket'] = {'params': self.config.get('maket'), 'dem': self.maket, 'library': library}
         self.component_params['atmosphere'] = {'params': self.config.get('atmosphere')}
-        self.component_params['object3d'] = {'params': self.config.get('object3d')}
-        self.component_params['plots'] = {'params': self.config.get('plots'), 'land_cover': self.land_cover}
+        self.component_params['object3d'] = {'params': self.config.get('object3d'), 'library': library}
+        self.component_params['plots'] = {'params': self.config.get('plots'), 'land_cover': self.land_cover,
+                                          'library': library}
         self.component_params['coeff_diff'] = {'params': self.config.get('coeff_diff')}
 
+    def validate(self, databases=None):
+        """
+        Validate the config of all generated components against the schema of the default config, see
+        simulation.schema. Components patched with an xml file may be incomplete.
+
+        :param databases (OpticalDatabases): also check that the coeff_diff models exist, see simulation.database
+        :return: list of error messages
+        """
+        errors = []
+        generated = [name for name in self.component_params if name not in self.non_generated_components]
+        default_config = self.default_config if type(self.default_config) is str else None
+        version_schema = schema.for_version(self.config['version'], default_config=default_config)
+        if version_schema is not None:
+            patched = [name for name, _ in self.xml_patch or []]
+            errors += version_schema.validate(self.config, components=generated, partial=patched)
+        if databases is not None and 'coeff_diff' in generated:
+            errors += databases.check(self.config.get('coeff_diff'))
+        return errors
+
     def _generate_components(self, ignore=None, xml_patch=None):
         if xml_patch is None:
             xml_patch = {}
@@ -297,19 +475,93 @@ class Simulation(object):
             self.components[comp] = cls(simulation_dir=self.path, version=self.version,
                                         xml_patch_path=xml_patch.get(comp), **self.component_params[comp])
 
-    def to_file(self):
+    def to_file(self, staging=None, parallel=1, pack=False):
         """
         Write simulation to a simulation directory
+
+        :param staging (Staging): write the components to local scratch space first and publish them to the
+                                  simulation directory in one transfer
+        :param parallel: number of threads writing components concurrently (xml serialization and file I/O release
+                         the GIL)
+        :param pack: store config, dill and inputs as a single archive in the simulation directory, see
+                     simulation.archive. The components are written to local scratch space (staging.scratch or the
+                     temp directory) and packed from there.
         :return:
         """
-        for component in self.components.values():
-            component.to_file()
+        with utils.timing.span('simulation.to_file', simulation=self.simulation_name):
+            if pack:
+                local = tempfile.mkdtemp(prefix='dartpy_', dir=staging.scratch if staging is not None else None)
+                try:
+                    self._components_to_file(local, parallel)
+                    archive.pack(self.path, local)
+                finally:
+                    shutil.rmtree(local, ignore_errors=True)
+            elif staging is None:
+                self._components_to_file(self.path, parallel)
+            else:
+                with staging.stage(self.path, publish=['*']) as staged:
+                    self._components_to_file(staged, parallel)
         self._is_to_file = True
 
+    def _components_to_file(self, simulation_dir, parallel=1):
+        components = [c for c in self.components.values() if c is not None]
+        if parallel <= 1 or len(components) <= 1:
+            for component in components:
+                component.to_file(simulation_dir)
+            return
+
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            for future in [pool.submit(component.to_file, simulation_dir) for component in components]:
+                future.result()
+
+    @staticmethod
+    def bulk_to_file(simulations, jobs=None, parallel=1, staging=None, pack=False):
+        """
+        Write many simulations over a process pool. The simulations are pickled to the worker processes, components
+        included.
+
+        :param simulations (list of Simulation):
+        :param jobs: number of processes, defaults to the number of cores
+        :param parallel: component writer threads per simulation, see to_file
+        :param staging (Staging):
+        :param pack: see to_file
+        :return: list of simulation paths
+        """
+        simulations = list(simulations)
+        if jobs == 1 or len(simulations) <= 1:
+            for sim in simulations:
+                sim.to_file(staging=staging, parallel=parallel, pack=pack)
+            return [sim.path for sim in simulations]
+
+        jobs = jobs or os.cpu_count()
+        with utils.timing.span('simulation.bulk_to_file', simulations=len(simulations)), \
+                ProcessPoolExecutor(max_workers=jobs) as pool:
+            paths = list(pool.map(_to_file, simulations, itertools.repeat(staging), itertools.repeat(parallel),
+                                  itertools.repeat(pack), chunksize=max(len(simulations) // (4 * jobs), 1)))
+        for sim in simulations:
+            sim._is_to_file = True
+        return paths
+
+    def split_bands(self, parts, simulation_location=None):
+        """
+        Split the simulation into parts simulations with contiguous slices of the band table, see simulation.spectral
+
+        :param parts: number of pieces
+        :param simulation_location: where to create the pieces, defaults to the bands directory of this simulation
+        :return: list of Simulation
+        """
+        from . import spectral
+        return spectral.split(self, parts, simulation_location=simulation_location)
+
     def run(self, *args, **kwargs):
         """
         Run simulation
 
         :return:
         """
-        run.SimulationRunner(self).run(*args, **kwargs)
+        return run.SimulationRunner(self).run(*args, **kwargs)
+
+
+def _to_file(simulation, staging, parallel, pack):
+    simulation.to_file(staging=staging, parallel=parallel, pack=pack)
+    return simulation.path
@@ -0,0 +1,193 @@
+"""
+Spectral band splitting: run one multi-band simulation as several simulations on contiguous slices of the band table
+(phase.spectral) and merge their outputs back into one band indexed output.
+
+    pieces = sim.split_bands(8)
+    results = spectral.run_pieces(sim, pieces, jobs=8)      # or run the piece directories anywhere else
+    spectral.merge(sim.path)
+
+DART numbers the bands of every piece from 0, the band offset of each piece is recorded in the split manifest of the
+original simulation directory and used to rename output/BAND<i> to output/BAND<offset + i> when merging. Outputs that
+are not per band (e.g. the maket or the DART logs) are the same for all pieces and taken from the first one.
+"""
+import copy
+import json
+import logging
+import os
+import re
+import shutil
+
+import utils.general
+import utils.timing
+from . import postprocessing
+from . import run
+
+SPLIT_FILE = 'band_split.json'
+PIECES_DIR = 'bands'
+OUTPUT_DIR = 'output'
+SPECTRAL_KEYS = ['deltaLambda', 'meanLambda', 'spectralDartMode']
+
+_BAND_DIR = re.compile(r'^BAND(\d+)$')
+
+
+def band_slices(bands, parts):
+    """
+    Split range(bands) into contiguous slices of almost equal length.
+
+    :param bands: number of bands
+    :param parts: number of slices, at most bands
+    :return: list of (start, stop)
+    """
+    parts = max(min(int(parts), bands), 1)
+    size, rest = divmod(bands, parts)
+    slices, start = [], 0
+    for i in range(parts):
+        stop = start + size + (1 if i < rest else 0)
+        slices.append((start, stop))
+        start = stop
+    return slices
+
+
+def slice_config(config, start, stop):
+    """
+    Config with the band table restricted to the bands start to stop - 1.
+
+    :param config: full simulation config
+    :param start:
+    :param stop:
+    :return: new config dict
+    """
+    config = copy.deepcopy(config)
+    spectral = config['phase']['spectral']
+    for key in SPECTRAL_KEYS:
+        if isinstance(spectral.get(key), list):
+            spectral[key] = spectral[key][start:stop]
+    return config
+
+
+def split(simulation, parts, simulation_location=None):
+    """
+    Split a simulation into pieces with contiguous slices of its band table. Components that are not generated from
+    the config (e.g. copied from a base simulation) are shared by all pieces.
+
+    :param simulation (Simulation):
+    :param parts: number of pieces
+    :param simulation_location: where to create the pieces, defaults to the bands directory of the simulation
+    :return: list of piece Simulations, not yet written to file
+    """
+    from .simulation import Simulation
+
+    if 'phase' in simulation.non_generated_components:
+        raise Exception('The phase component of ' + simulation.path + ' is not generated, its bands cannot be split.')
+    bands = len(simulation.config['phase']['spectral']['meanLambda'])
+    if simulation_location is None:
+        simulation_location = utils.general.create_path(simulation.path, PIECES_DIR)
+
+    pieces, manifest = [], []
+    for start, stop in band_slices(bands, parts):
+        # constructor state that is not in the config (land cover, DEM) is shared by all pieces
+        piece = Simulation(slice_config(simulation.config, start, stop), default_config=simulation.default_config,
+                           default_patch=False, no_gen=simulation.non_generated_components,
+                           xml_patch=simulation.xml_patch, land_cover=simulation.land_cover, maket=simulation.maket,
+                           version=simulation.version,
+                           simulation_name='{}_bands_{:04d}_{:04d}'.format(simulation.config['simulation_name'],
+                                                                           start, stop - 1),
+                           simulation_location=simulation_location, dart_path=simulation.dart_path)
+        for name in simulation.non_generated_components:
+            if simulation.components.get(name) is not None:
+                component = copy.copy(simulation.components[name])
+                component.simulation_dir = piece.path
+                piece.components[name] = component
+        pieces.append(piece)
+        manifest.append({'path': os.path.abspath(piece.path), 'start': start, 'stop': stop})
+
+    with open(utils.general.create_path(simulation.path, SPLIT_FILE), 'w') as f:
+        json.dump({'bands': bands, 'pieces': manifest}, f, indent=2)
+    logging.info('Split ' + str(bands) + ' bands of ' + simulation.path + ' into ' + str(len(pieces)) + ' pieces')
+    return pieces
+
+
+def pieces(path):
+    """
+    :param path: simulation directory that was split
+    :return: list of piece dicts with path, start and stop
+    """
+    with open(utils.general.create_path(path, SPLIT_FILE)) as f:
+        return json.load(f)['pieces']
+
+
+def merge(path, move=True):
+    """
+    Merge the outputs of all pieces into the output directory of the split simulation. Band directories are renumbered
+    to the band indices of the split simulation, all other outputs are taken from the first piece.
+
+    :param path: simulation directory that was split
+    :param move: move the piece outputs instead of copying them
+    :return: path of the merged output directory
+    """
+    transfer = shutil.move if move else _copy
+    output = utils.general.create_path(path, OUTPUT_DIR)
+
+    with utils.timing.span('spectral.merge', path=path):
+        for i, piece in enumerate(pieces(path)):
+            piece_output = utils.general.create_path(piece['path'], OUTPUT_DIR)
+            if not os.path.exists(piece_output):
+                raise Exception('Piece ' + piece['path'] + ' has no output to merge.')
+            if not os.path.exists(output):
+                os.makedirs(output)
+
+            for name in sorted(os.listdir(piece_output)):
+                match = _BAND_DIR.match(name)
+                if match is not None:
+                    band = piece['start'] + int(match.group(1))
+                    if band >= piece['stop']:
+                        raise Exception('Piece ' + piece['path'] + ' has more bands than assigned.')
+                    target = utils.general.create_path(output, 'BAND' + str(band))
+                elif i == 0:
+                    target = utils.general.create_path(output, name)
+                else:
+                    logging.debug('Skipped ' + name + ' of piece ' + piece['path'] + ', taken from the first piece')
+                    continue
+
+                if os.path.isdir(target):
+                    shutil.rmtree(target)
+                elif os.path.exists(target):
+                    os.remove(target)
+                transfer(utils.general.create_path(piece_output, name), target)
+    return output
+
+
+def run_pieces(simulation, pieces, merge_outputs=True, **kwargs):
+    """
+    Write and run all pieces in parallel and merge their outputs if all runs succeeded. The pieces are not
+    postprocessed, the sensor resampling and retention policy of the split simulation are applied to the merged outputs.
+
+    :param simulation (Simulation): the split simulation
+    :param pieces: result of split
+    :param merge_outputs:
+    :param kwargs: SimulationRunner arguments, e.g. jobs, dart_path or staging
+    :return: list of run status dicts
+    """
+    for piece in pieces:
+        if not piece._is_to_file:
+            piece.to_file(staging=kwargs.get('staging'))
+
+    # a retention policy dropping or compressing piece outputs would break the merge
+    postprocess_outputs = kwargs.pop('postprocess_jobs', 2)
+    results = run.SimulationRunner(pieces, postprocess_jobs=0, **kwargs).run()
+    if merge_outputs:
+        failed = [r for r in results if r['state'] != run.DONE]
+        if failed:
+            logging.warning(str(len(failed)) + ' pieces of ' + simulation.path + ' failed, outputs are not merged')
+        else:
+            merge(simulation.path)
+            if postprocess_outputs:
+                postprocessing.postprocess(simulation.path, config=simulation.config)
+    return results
+
+
+def _copy(src, dst):
+    if os.path.isdir(src):
+        shutil.copytree(src, dst)
+    else:
+        shutil.copy2(src, dst)
@@ -0,0 +1,125 @@
+"""
+Staging of simulation directories on fast local scratch space (e.g. /dev/shm or local NVMe).
+
+Simulations are written and run in a scratch directory and only the selected files are published back to the
+simulation_location in one bulk transfer, which keeps the many small DART files off network filesystems.
+"""
+import fnmatch
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+from contextlib import contextmanager
+
+import utils.general
+import utils.timing
+from . import archive
+
+OUTPUT_DIR = 'output'
+
+
+class Staging(object):
+    def __init__(self, scratch='/dev/shm', min_free_bytes=1 << 30, publish=None, archive=None):
+        """
+        :param scratch: local scratch directory
+        :param min_free_bytes: refuse to stage if less than this is left on scratch after copying the inputs
+        :param publish (list of str): glob patterns relative to the simulation directory selecting the files and
+                                      directories published back after a run, e.g. ['output/BAND0/BRF/*', 'dart.log'].
+                                      None publishes everything.
+        :param archive: None to move the published files, 'tar' or 'gz' to publish them as a single (compressed) tar
+                        archive output.tar(.gz) instead
+        """
+        self.scratch = scratch
+        self.min_free_bytes = min_free_bytes
+        self.publish = publish
+        self.archive = archive
+
+    def check_space(self, required=0):
+        free = shutil.disk_usage(self.scratch).free
+        if free - required < self.min_free_bytes:
+            raise Exception('Not enough space on scratch ' + self.scratch + ': ' + str(free) + ' bytes free, ' +
+                            str(required) + ' needed plus ' + str(self.min_free_bytes) + ' reserved')
+
+    @contextmanager
+    def stage(self, path, copy=False, publish=None):
+        """
+        Provide a scratch directory standing in for the simulation directory path. Files selected by publish are
+        transferred to path when the block succeeds. The scratch directory is removed in any case.
+
+        :param path: simulation directory
+        :param copy: copy the current content of path except a previous output to scratch first (e.g. the inputs
+                     before a run), packed simulations are extracted to scratch. Copied entries are not published back
+                     unless selected by publish.
+        :param publish: override self.publish
+        :return:
+        """
+        copy = copy and os.path.exists(path)
+        copied = [name for name in os.listdir(path) if name != OUTPUT_DIR] if copy else []
+        self.check_space(sum(_size(utils.general.create_path(path, name)) for name in copied))
+
+        root = tempfile.mkdtemp(prefix='dartpy_', dir=self.scratch)
+        staged = utils.general.create_path(root, os.path.basename(os.path.normpath(path)))
+        try:
+            if copy:
+                with utils.timing.span('staging.copy_in', path=path):
+                    shutil.copytree(path, staged, ignore=lambda d, names: [OUTPUT_DIR, archive.ARCHIVE_FILE]
+                                    if d == path else [])
+                    if archive.ARCHIVE_FILE in copied:
+                        copied += [name.split('/')[0] for name in archive.materialize(path, staged)]
+            else:
+                os.makedirs(staged)
+
+            yield staged
+
+            with utils.timing.span('staging.publish', path=path):
+                self._publish(staged, path, self.publish if publish is None else publish, copied=copied)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+    def _publish(self, staged, path, patterns, copied=()):
+        selected = []
+        for dirpath, dirnames, filenames in os.walk(staged):
+            rel_dir = os.path.relpath(dirpath, staged)
+            for name in sorted(dirnames + filenames):
+                rel = name if rel_dir == '.' else utils.general.create_path(rel_dir, name)
+                if patterns is None:
+                    # everything that was not copied to scratch in the first place
+                    if name not in copied:
+                        selected.append(rel)
+                elif _matches(rel, patterns):
+                    selected.append(rel)
+            # selected directories are transferred as a whole
+            dirnames[:] = [] if patterns is None else [
+                d for d in dirnames if (d if rel_dir == '.' else utils.general.create_path(rel_dir, d)) not in selected]
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        if self.archive is not None:
+            archive_path = utils.general.create_path(path, 'output.tar' + ('.gz' if self.archive == 'gz' else ''))
+            with tarfile.open(archive_path + '.part', 'w:gz' if self.archive == 'gz' else 'w') as tar:
+                for rel in selected:
+                    tar.add(utils.general.create_path(staged, rel), arcname=rel)
+            os.replace(archive_path + '.part', archive_path)
+        else:
+            for rel in selected:
+                target = utils.general.create_path(path, rel)
+                if os.path.isdir(target):
+                    shutil.rmtree(target)
+                elif os.path.exists(target):
+                    os.remove(target)
+                elif not os.path.exists(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                shutil.move(utils.general.create_path(staged, rel), target)
+        logging.info('Published ' + str(len(selected)) + ' entries from ' + staged + ' to ' + path)
+
+
+def _matches(rel, patterns):
+    return any(fnmatch.fnmatch(rel, p) for p in patterns)
+
+
+def _size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(dirpath, f)) for dirpath, _, filenames in os.walk(path) for f in filenames)
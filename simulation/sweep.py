@@ -0,0 +1,399 @@
+"""
+Parameter sweeps over the regular config schema.
+
+A sweep file is a regular dartpy config (see default_params) with an additional [sweep] table describing the swept
+parameters. All other tables are applied as config patch to every variant:
+
+    [sweep]
+    name = 'sun_zenith'
+    simulation_location = '/data/simulations'
+    config = ['../config_templates/base575.toml']   # optional, relative to the sweep file
+    base_path = '/data/simulations/reference'       # optional, variants are derived with Simulation.from_simulation
+    copy_xml = 'not_implemented'
+    mode = 'product'                                # 'product' or 'zip' of the parameter axes
+    share_atmosphere = true                         # compute the atmosphere transfer functions once per group
+    sequence = false                                # run all variants in one DART sequence launch
+    pack = false                                    # store the inputs of every variant as a single archive
+
+    [sweep.parameters]
+    'directions.sun.sunViewingZenithAngle' = [0, 20, 40]
+    'phase.spectral.meanLambda' = [[0.45], [0.55]]
+
+    [phase.expert_flux_tracking]
+    nbThreads = 4
+
+With share_atmosphere, variants are grouped by a hash of their swept atmosphere (and spectral band) parameters. The
+first variant of each group writes the atmosphere transfer functions, the others import them and are only run once it
+is done. All other parameters (sun and view angles, vegetation, ...) do not change the atmosphere.
+
+All variants are validated against the config schema (see simulation.schema) before the first one is created, every
+swept value only once. A sweep with errors creates nothing and reports all of them.
+
+With pack, every variant directory holds a single simulation.zip instead of its config and input files (see
+simulation.archive), which is extracted only for the DART run.
+
+With sequence, a single base simulation (the first variant) is created together with a DART sequence file covering all
+variants (see simulation.sequence). It is recorded as one ledger job and run by the DART sequence launcher.
+"""
+import collections
+import copy
+import hashlib
+import json
+import itertools
+import logging
+import operator
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import reduce
+
+from . import archive
+from . import cost
+from . import ledger
+from . import schema
+from . import simulation as simul
+import utils.general
+
+toml = utils.general.lazy_import('toml')
+
+SWEEP_KEY = 'sweep'
+
+# swept parameters starting with these change the atmosphere transfer functions
+ATMOSPHERE_PARAMETERS = ['atmosphere.', 'phase.spectral.']
+
+
+class Variant(collections.namedtuple('Variant', ['index', 'name', 'parameters'])):
+    """
+    A single point of a sweep. parameters maps dotted config paths to values.
+    """
+
+    @property
+    def patch(self):
+        return utils.general.nest_dict(self.parameters)
+
+
+class Sweep(object):
+    def __init__(self, spec, root=None):
+        """
+        :param spec (str or dict): path to a sweep file or the parsed sweep dict
+        :param root: directory relative config paths are resolved against, defaults to the sweep file directory
+        """
+        if type(spec) is str:
+            if root is None:
+                root = os.path.dirname(os.path.abspath(spec))
+            spec = toml.load(spec, _dict=dict)
+
+        spec = copy.deepcopy(spec)
+        sweep = spec.pop(SWEEP_KEY, {})
+        self.root = root if root is not None else os.getcwd()
+
+        self.name = sweep.get('name', 'sweep')
+        self.simulation_location = self._resolve(sweep.get('simulation_location',
+                                                           spec.get('simulation_location', './test_simulations')))
+        self.version = sweep.get('version', spec.get('version', '5.7.5'))
+        self.base_path = self._resolve(sweep.get('base_path'))
+        self.copy_xml = sweep.get('copy_xml')
+        self.xml_patch = sweep.get('xml_patch')
+        self.no_gen = sweep.get('no_gen', 'not_implemented')
+        self.default_patch = sweep.get('default_patch', True)
+        self.mode = sweep.get('mode', 'product')
+        self.share_atmosphere = sweep.get('share_atmosphere', False)
+        self.sequence = sweep.get('sequence', False)
+        self.sequence_preferences = sweep.get('sequence_preferences', {})
+        self.pack = sweep.get('pack', False)
+
+        config = sweep.get('config', [])
+        if type(config) is str:
+            config = [config]
+        self.config = [self._resolve(c) for c in config]
+        if spec:
+            self.config.append(spec)
+
+        self.parameters = utils.general.flatten_dict(sweep.get('parameters', {}))
+        if self.mode not in ('product', 'zip'):
+            raise Exception('Unknown sweep mode ' + str(self.mode) + '. Use product or zip.')
+        if self.mode == 'zip' and len(set(len(v) for v in self.parameters.values())) > 1:
+            raise Exception('All swept parameters must have the same length in zip mode, got ' +
+                            ', '.join(k + ': ' + str(len(v)) for k, v in self.parameters.items()))
+
+    def _resolve(self, path):
+        if path is None or os.path.isabs(path):
+            return path
+        return utils.general.create_path(self.root, path)
+
+    @property
+    def ledger(self):
+        return ledger.JobLedger(self.simulation_location)
+
+    def has_ledger(self):
+        """
+        :return: whether the job ledger exists, unlike self.ledger this does not create it
+        """
+        return os.path.exists(utils.general.create_path(self.simulation_location, ledger.LEDGER_FILE))
+
+    def __len__(self):
+        lengths = [len(v) for v in self.parameters.values()]
+        if not lengths:
+            return 1
+        if self.mode == 'zip':
+            return lengths[0]
+        return reduce(operator.mul, lengths, 1)
+
+    def variants(self):
+        keys = list(self.parameters.keys())
+        values = [self.parameters[k] for k in keys]
+
+        if self.mode == 'zip':
+            combinations = zip(*values)
+        else:
+            combinations = itertools.product(*values)
+
+        for i, combination in enumerate(combinations):
+            yield Variant(i, '{}_{:05d}'.format(self.name, i), collections.OrderedDict(zip(keys, combination)))
+
+    def atmosphere_groups(self):
+        """
+        Variants grouped by their atmosphere. The first variant of each group computes the transfer functions.
+
+        :return: OrderedDict atmosphere hash -> list of variants
+        """
+        groups = collections.OrderedDict()
+        for variant in self.variants():
+            groups.setdefault(atmosphere_hash(variant), []).append(variant)
+        return groups
+
+    def simulation_kwargs(self, variant, patch=None):
+        """
+        Keyword arguments to create the simulation of a variant with Simulation or Simulation.from_simulation.
+
+        :param variant:
+        :param patch: additional config dict applied last
+        :return:
+        """
+        kwargs = {'config': self.config + [variant.patch] + ([patch] if patch else []),
+                  'default_patch': self.default_patch,
+                  'xml_patch': self.xml_patch, 'no_gen': self.no_gen, 'version': self.version,
+                  'simulation_name': variant.name, 'simulation_location': self.simulation_location,
+                  # create validates all variants up front
+                  'validate': False}
+        if self.base_path is not None:
+            kwargs['base_path'] = self.base_path
+            kwargs['copy_xml'] = self.copy_xml
+        return kwargs
+
+    def create_simulation(self, variant, patch=None):
+        kwargs = self.simulation_kwargs(variant, patch)
+        if self.base_path is not None:
+            return simul.Simulation.from_simulation(**kwargs)
+        return simul.Simulation(**kwargs)
+
+    def validate(self, databases=None):
+        """
+        Validate the configs of all variants against the schema of the default config before anything is created,
+        see Schema.validate_sweep.
+
+        :param databases (OpticalDatabases): also check that the coeff_diff models of all variants exist, see
+                                             simulation.database
+        :return: list of error messages
+        """
+        version_schema = schema.for_version(self.version)
+        if version_schema is None and databases is None:
+            return []
+
+        config = self.base_config()
+
+        not_generated = simul.Simulation._convert_component_kwarg(self.no_gen)
+        if self.base_path is not None:
+            not_generated = not_generated.union(simul.Simulation._convert_component_kwarg(self.copy_xml))
+        patched = [p if type(p) is str else p[0] for p in simul.Simulation._convert_component_kwarg(self.xml_patch)]
+        generated = [name for name in simul.COMPONENTS if name not in not_generated]
+        errors = []
+        if version_schema is not None:
+            errors += version_schema.validate_sweep(config, self.parameters, mode=self.mode, components=generated,
+                                                    partial=patched)
+        if databases is not None and 'coeff_diff' in generated:
+            # the model index makes this cheap, every variant is checked only if coeff_diff is swept
+            swept = any(key.startswith('coeff_diff.') for key in self.parameters)
+            configs = (utils.general.merge_dicts(copy.deepcopy(config), v.patch) for v in self.variants()) \
+                if swept else [config]
+            for variant_config in configs:
+                errors += [e for e in databases.check(variant_config.get('coeff_diff')) if e not in errors]
+        return errors
+
+    def base_config(self):
+        """
+        Config all variants are patched from: the base simulation or default config and the sweep configs.
+
+        :return: config dict
+        """
+        config = {}
+        if self.base_path is not None:
+            base_config = utils.general.create_path(self.base_path, simul.CONFIG_FILE_NAME)
+            if archive.exists(base_config):
+                config = simul.load_config(base_config)
+        elif self.default_patch:
+            config = simul.load_config(simul.default_config_path(self.version))
+        for conf in self.config:
+            if type(conf) is str:
+                conf = simul.load_config(conf)
+            config = utils.general.merge_dicts(config, copy.deepcopy(conf))
+        return config
+
+    def created(self):
+        """
+        Variants already written to file according to the job ledger.
+
+        :return: OrderedDict variant name -> ledger job of all emitted variants whose directory still exists
+        """
+        jobs = collections.OrderedDict()
+        if not self.has_ledger():
+            return jobs
+
+        for job in self.ledger.jobs(sweep=self.name):
+            if job['state'] != ledger.CREATED and os.path.exists(job['path']):
+                jobs[job['name']] = job
+        return jobs
+
+    def create(self, jobs=1, resume=True, dry_run=False, staging=None):
+        """
+        Create and write all variants of the sweep. Every variant is recorded in the job ledger as soon as it is
+        created and again once it is written, so an interrupted create can be resumed.
+
+        :param jobs: number of processes
+        :param resume: skip variants already written according to the ledger
+        :param dry_run: only return the variants that would be created
+        :param staging (Staging): write the variants on local scratch space first
+        :return: list of created (or to be created) variants
+        """
+        # report all errors of all variants before a single variant is created
+        schema.check(self.validate(), 'Sweep ' + self.name)
+        if self.sequence:
+            return self._create_sequence(resume, dry_run, staging)
+
+        done = self.created() if resume else {}
+        todo = [v for v in self.variants() if v.name not in done]
+        if dry_run or not todo:
+            return todo
+        self._prepare_prospect(todo)
+
+        # the predicted runtime is the ledger priority, so runners claim the longest jobs first
+        cost_model = cost.CostModel.load(self.simulation_location)
+        if not self.share_atmosphere:
+            self._create([(v, {}) for v in todo], jobs, cost_model, staging)
+            return todo
+
+        # transfer function writers first, their paths go into the atmosphere of the other variants
+        names = set(v.name for v in todo)
+        groups = list(self.atmosphere_groups().values())
+        self._create([(group[0], {'patch': _WRITE_TRANSFER_FUNCTIONS, 'priority_factor': len(group)})
+                      for group in groups if group[0].name in names], jobs, cost_model, staging)
+
+        paths = dict((job['name'], job['path']) for job in self.ledger.jobs(sweep=self.name))
+        self._create([(v, {'patch': _import_transfer_functions(paths[group[0].name]), 'depends': group[0].name})
+                      for group in groups for v in group[1:] if v.name in names], jobs, cost_model, staging)
+        return todo
+
+    def _prepare_prospect(self, variants):
+        """
+        Compute the PROSPECT spectra of all variants as one batch before they are created, see simulation.prospect.
+        """
+        from . import prospect
+        config = self.base_config()
+        if not config.get(prospect.PROSPECT_KEY) and \
+                not any(k.startswith(prospect.PROSPECT_KEY + '.') for k in self.parameters):
+            return
+        prospect.prepare(utils.general.merge_dicts(copy.deepcopy(config), v.patch) for v in variants)
+
+    @property
+    def sequence_name(self):
+        return self.name + '_sequence'
+
+    def _create_sequence(self, resume, dry_run, staging):
+        """
+        Create the base simulation and the sequence file running all variants.
+
+        :return: list with the base variant if it was (or would be) created
+        """
+        from . import sequence
+
+        variants = list(self.variants())
+        base = Variant(0, self.sequence_name, variants[0].parameters)
+        if resume and base.name in self.created():
+            return []
+        if dry_run:
+            return [base]
+
+        sim = self.create_simulation(base)
+        try:
+            # parameters that cannot be sequenced must not leave a base simulation or a ledger job behind
+            seq = sequence.from_sweep(self, sim)
+        except Exception:
+            shutil.rmtree(sim.path, ignore_errors=True)
+            raise
+
+        job_ledger = self.ledger
+        job_ledger.register(base.name, state=ledger.CREATED, sweep=self.name, path=sim.path,
+                            parameters={'variants': len(variants)})
+        sim.to_file(staging=staging, pack=self.pack)
+        seq.to_file(sim.path, sim.version, variants)
+        if self.pack:
+            archive.pack(sim.path)
+        job_ledger.transition(base.name, ledger.EMITTED)
+        logging.info('Created sequence ' + base.name + ' of ' + str(len(variants)) + ' variants in ' + sim.path)
+        return [base]
+
+    def _create(self, variants, jobs, cost_model, staging):
+        """
+        :param variants: list of (variant, dict of further _create_variant kwargs)
+        """
+        if jobs <= 1:
+            for variant, kwargs in variants:
+                _create_variant(self, variant, cost_model, staging, **kwargs)
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                futures = [pool.submit(_create_variant, self, v, cost_model, staging, **kwargs)
+                           for v, kwargs in variants]
+                for future in as_completed(futures):
+                    future.result()
+
+
+def atmosphere_hash(variant):
+    """
+    Hash of the swept parameters of a variant that change the atmosphere transfer functions.
+
+    :param variant:
+    :return: hex digest, equal for variants sharing the atmosphere
+    """
+    atmosphere = dict((k, v) for k, v in variant.parameters.items()
+                      if any(k.startswith(prefix) for prefix in ATMOSPHERE_PARAMETERS))
+    return hashlib.sha1(json.dumps(atmosphere, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+_WRITE_TRANSFER_FUNCTIONS = {'atmosphere': {'general': {'inputOutputTransfertFunctions': 0,
+                                                        'writeTransferFunctions': 1}}}
+
+
+def _import_transfer_functions(writer_path):
+    """
+    Atmosphere patch importing the transfer functions written by the simulation in writer_path.
+    """
+    config = toml.loads(archive.read_text(utils.general.create_path(writer_path, simul.CONFIG_FILE_NAME)), _dict=dict)
+    written = config.get('atmosphere', {}).get('general', {}).get('transferFunctionsFile')
+    if not written:
+        raise Exception('atmosphere.general.transferFunctionsFile of ' + writer_path + ' is not set.')
+    return {'atmosphere': {'general': {'inputOutputTransfertFunctions': 1, 'writeTransferFunctions': 0,
+                                       'transferFunctionsFile': utils.general.create_path(
+                                           os.path.abspath(writer_path), written)}}}
+
+
+def _create_variant(sweep, variant, cost_model=None, staging=None, patch=None, depends=None, priority_factor=1.):
+    job_ledger = sweep.ledger
+    sim = sweep.create_simulation(variant, patch)
+    # runs other jobs depend on are prioritized by the runtime they unblock
+    priority = cost_model.predict(sim.config) * priority_factor if cost_model is not None else 0.
+    job_ledger.register(variant.name, state=ledger.CREATED, sweep=sweep.name, path=sim.path,
+                        parameters=variant.parameters, priority=priority, depends=depends)
+    sim.to_file(staging=staging, pack=sweep.pack)
+    job_ledger.transition(variant.name, ledger.EMITTED)
+    logging.info('Created ' + variant.name + ' in ' + sim.path)
+    return sim.path
@@ -0,0 +1,104 @@
+"""
+Tuning of DART threads per run (phase.expert_flux_tracking.nbThreads) against the number of concurrent runs.
+
+A calibration sweep runs copies of representative simulations for every split of the available cores into
+jobs x threads and keeps the split with the highest throughput (finished runs per second).
+"""
+import collections
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import utils.general
+from . import archive
+from . import run
+
+et = utils.general.lazy_import('lxml.etree')
+
+PHASE_FILE = 'phase.xml'
+
+Tuning = collections.namedtuple('Tuning', ['jobs', 'threads', 'throughputs'])
+
+
+def set_threads(path, threads):
+    """
+    Rewrite nbThreads in the emitted phase.xml of a simulation directory.
+
+    :param path: simulation directory
+    :param threads:
+    :return:
+    """
+    phase_path = utils.general.create_path(path, 'input', PHASE_FILE)
+    tree = et.parse(phase_path)
+    zones = tree.getroot().findall('./Phase/ExpertModeZone')
+    if not zones:
+        raise Exception(phase_path + ' has no ExpertModeZone to set nbThreads in.')
+    for zone in zones:
+        zone.set('nbThreads', str(threads))
+    tree.write(phase_path, pretty_print=True)
+
+
+def candidates(cores):
+    """
+    All splits of cores into (jobs, threads) with jobs * threads == cores.
+
+    :param cores:
+    :return:
+    """
+    return [(cores // threads, threads) for threads in range(cores, 0, -1) if cores % threads == 0]
+
+
+def calibrate(paths, cores=None, splits=None, dart_path=None, scratch=None):
+    """
+    Run the calibration sweep. For every (jobs, threads) split, jobs copies of the representative simulations are
+    run concurrently with nbThreads = threads. The representative simulations themselves are left untouched.
+
+    :param paths: directories of representative, emitted simulations (preferably short ones), packed or not
+    :param cores: number of cores to distribute, defaults to os.cpu_count()
+    :param splits: list of (jobs, threads) to try, defaults to candidates(cores)
+    :param dart_path: DART launcher, defaults to the dart_path of the simulation configs
+    :param scratch: directory for the calibration copies, defaults to a temporary directory
+    :return: Tuning with the best jobs and threads and the measured throughput of every split
+    """
+    if not paths:
+        raise Exception('Calibration needs at least one representative simulation.')
+    cores = cores or os.cpu_count()
+    splits = splits or candidates(cores)
+
+    scratch = tempfile.mkdtemp(prefix='dartpy_tuning_', dir=scratch)
+    ignore = shutil.ignore_patterns('output', run.RUN_STATUS_FILE, run.RUN_LOG_FILE)
+    throughputs = collections.OrderedDict()
+    try:
+        for jobs, threads in splits:
+            copies = []
+            for i in range(jobs):
+                copy = utils.general.create_path(scratch, '{}x{}_{}'.format(jobs, threads, i))
+                shutil.copytree(paths[i % len(paths)], copy, ignore=ignore)
+                if archive.is_packed(copy):
+                    # the copies are thrown away, extract them for good
+                    archive.materialize(copy)
+                    os.remove(archive.archive_path(copy))
+                set_threads(copy, threads)
+                copies.append(copy)
+
+            start = time.time()
+            results = run.SimulationRunner(copies, jobs=jobs, dart_path=dart_path, postprocess_jobs=0).run()
+            elapsed = time.time() - start
+
+            if any(r['state'] != run.DONE for r in results):
+                logging.warning('Calibration runs with {} jobs x {} threads failed'.format(jobs, threads))
+                continue
+            throughputs[(jobs, threads)] = jobs / elapsed
+            logging.info('{} jobs x {} threads: {:.4g} runs/s'.format(jobs, threads, throughputs[(jobs, threads)]))
+
+            for copy in copies:
+                shutil.rmtree(copy, ignore_errors=True)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if not throughputs:
+        raise Exception('All calibration runs failed.')
+    jobs, threads = max(throughputs, key=throughputs.get)
+    return Tuning(jobs, threads, throughputs)
@@ -0,0 +1,82 @@
+import os
+import tempfile
+
+from simulation import archive
+from simulation import simulation
+import utils.general
+
+
+def _write(path, rel, content):
+    file_path = os.path.join(path, rel)
+    if not os.path.exists(os.path.dirname(file_path)):
+        os.makedirs(os.path.dirname(file_path))
+    with open(file_path, 'w') as f:
+        f.write(content)
+
+
+def _directory():
+    path = tempfile.mkdtemp()
+    _write(path, 'config.toml', 'simulation_name = "packed"\n')
+    _write(path, 'input/phase.xml', '<Phase/>')
+    _write(path, 'input/triangles/t0.bin', 'triangles')
+    _write(path, 'output/BAND0/brf', 'brf')
+    return path
+
+
+def pack_load_test():
+    sim = simulation.Simulation({}, no_gen='not_implemented', simulation_name='packed',
+                                simulation_location=tempfile.mkdtemp())
+    sim.to_file(pack=True)
+    assert archive.is_packed(sim.path)
+    assert sorted(os.listdir(sim.path)) == [archive.ARCHIVE_FILE]
+
+    loaded = simulation.Simulation.load(sim.path)
+    assert loaded.config == sim.config
+    assert archive.read_text(os.path.join(sim.path, 'input', 'phase.xml')).startswith('<')
+
+
+def materialized_test():
+    path = _directory()
+    archive.pack(path)
+    assert sorted(os.listdir(path)) == ['output', archive.ARCHIVE_FILE]
+
+    with archive.materialized(path):
+        with open(os.path.join(path, 'input', 'triangles', 't0.bin')) as f:
+            assert f.read() == 'triangles'
+        _write(path, 'output/BAND1/brf', 'written by the run')
+
+    # extracted inputs are removed again, run outputs are kept
+    assert sorted(os.listdir(path)) == ['output', archive.ARCHIVE_FILE]
+    assert sorted(os.listdir(os.path.join(path, 'output'))) == ['BAND0', 'BAND1']
+    assert archive.members(path) == {'config.toml', 'input/phase.xml', 'input/triangles/t0.bin'}
+
+
+def locate_test():
+    path = _directory()
+    archive.pack(path)
+    assert archive.locate(os.path.join(path, 'input', 'triangles', 't0.bin')) == \
+        (utils.general.create_path(path), 'input/triangles/t0.bin')
+    assert archive.locate(os.path.join(path, 'input', 'triangles'))[1] == 'input/triangles/'
+    assert archive.locate(os.path.join(path, 'input', 'triangles', 't1.bin')) is None
+    assert archive.locate(os.path.join(path, 'output', 'BAND0', 'brf')) is None
+    assert archive.read(os.path.join(path, 'input', 'triangles', 't0.bin')) == b'triangles'
+
+
+def repack_test():
+    path = _directory()
+    archive.pack(path)
+    # members of the existing archive are kept unless replaced
+    _write(path, 'input/phase.xml', '<Phase version="2"/>')
+    _write(path, 'input/maket.xml', '<Maket/>')
+    archive.pack(path)
+
+    assert archive.members(path) == {'config.toml', 'input/phase.xml', 'input/maket.xml', 'input/triangles/t0.bin'}
+    assert archive.read_text(os.path.join(path, 'input', 'phase.xml')) == '<Phase version="2"/>'
+    assert not os.path.exists(os.path.join(path, 'input'))
+
+
+if __name__ == '__main__':
+    pack_load_test()
+    materialized_test()
+    locate_test()
+    repack_test()
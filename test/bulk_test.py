@@ -0,0 +1,55 @@
+import os
+import tempfile
+
+from lxml import etree
+
+from simulation import simulation
+
+
+def _base():
+    base = simulation.Simulation({}, no_gen='not_implemented', simulation_name='base',
+                                 simulation_location=tempfile.mkdtemp())
+    base.to_file()
+    return base
+
+
+def _sun_zenith(path):
+    return etree.parse(os.path.join(path, 'input', 'directions.xml')).getroot().find('.//SunViewingAngles').get(
+        'sunViewingZenithAngle')
+
+
+def bulk_from_simulation_test():
+    base = _base()
+    location = tempfile.mkdtemp()
+    patches = [{'directions': {'sun': {'sunViewingZenithAngle': angle}}} for angle in [10., 20., 30.]]
+    sims = simulation.Simulation.bulk_from_simulation(base.path, patches, copy_xml='atmosphere',
+                                                      no_gen='not_implemented', simulation_name='variant',
+                                                      simulation_location=location)
+    assert [s.config['simulation_name'] for s in sims] == ['variant_00000', 'variant_00001', 'variant_00002']
+    paths = simulation.Simulation.bulk_to_file(sims, jobs=1)
+
+    with open(os.path.join(base.path, 'input', 'atmosphere.xml'), 'rb') as f:
+        atmosphere = f.read()
+    for path, angle in zip(paths, ['10.0', '20.0', '30.0']):
+        assert _sun_zenith(path) == angle
+        # copied components are taken from the base simulation as they are
+        with open(os.path.join(path, 'input', 'atmosphere.xml'), 'rb') as f:
+            assert f.read() == atmosphere
+
+
+def copy_xml_patch_test():
+    base = _base()
+    patches = [{'directions': {'sun': {'sunViewingZenithAngle': 10.}}},
+               {'atmosphere': {'general': {'typeOfAtmosphere': 1}}}]
+    try:
+        simulation.Simulation.bulk_from_simulation(base.path, patches, copy_xml='atmosphere', no_gen='not_implemented',
+                                                   simulation_location=tempfile.mkdtemp())
+    except Exception as e:
+        assert 'variant 1: atmosphere.general.typeOfAtmosphere' in str(e)
+    else:
+        raise AssertionError('a patch of a copied component must be rejected')
+
+
+if __name__ == '__main__':
+    bulk_from_simulation_test()
+    copy_xml_patch_test()
@@ -0,0 +1,63 @@
+import contextlib
+import io
+import os
+import tempfile
+
+import toml
+
+from simulation import cli
+
+
+def _sweep_file(mode='product', zenith=(10., 20.), azimuth=(0., 90.)):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'sweep.toml')
+    with open(path, 'w') as f:
+        toml.dump({'sweep': {'name': 'sun', 'simulation_location': 'sims', 'mode': mode,
+                             'parameters': {'directions': {'sun': {'sunViewingZenithAngle': list(zenith),
+                                                                   'sunViewingAzimuthAngle': list(azimuth)}}}}}, f)
+    return path
+
+
+def _main(*argv):
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        code = cli.main(list(argv))
+    return code, out.getvalue()
+
+
+def dry_run_test():
+    path = _sweep_file()
+    location = os.path.join(os.path.dirname(path), 'sims')
+
+    code, out = _main('create', path, '--dry-run')
+    assert code == 0 and '4 of 4 variants to create' in out
+    code, out = _main('run', path, '--dry-run')
+    assert code == 0 and '4 variants to create' in out
+    # dry runs leave no trace, not even the job ledger
+    assert not os.path.exists(location)
+
+    assert _main('create', path)[0] == 0
+    code, out = _main('run', path, '--dry-run', '--jobs', '2')
+    assert out.count('would run ') == 4 and 'predicted makespan' in out
+    assert _main('status', path)[1].split() == ['missing=0', 'created=0', 'emitted=4', 'running=0', 'done=0',
+                                                'failed=0']
+
+
+def zip_lengths_test():
+    path = _sweep_file(mode='zip', zenith=(10., 20., 30.))
+    for command in ['validate', 'create', 'run']:
+        try:
+            _main(command, path, '--dry-run') if command != 'validate' else _main(command, path)
+        except Exception as e:
+            assert 'same length' in str(e) and 'sunViewingZenithAngle: 3' in str(e), e
+        else:
+            raise AssertionError(command + ' accepted parameters of different lengths in zip mode')
+    assert not os.path.exists(os.path.join(os.path.dirname(path), 'sims'))
+
+    code, out = _main('validate', _sweep_file(mode='zip'))
+    assert code == 0 and '0 errors in 2 variants' in out
+
+
+if __name__ == '__main__':
+    dry_run_test()
+    zip_lengths_test()
@@ -0,0 +1,101 @@
+import math
+import os
+import random
+import tempfile
+
+import toml
+
+from simulation import cost
+from simulation import ledger
+
+
+def _config(cells=100, bands=1, directions=100):
+    return {'maket': {'sceneDim': [cells, 1, 0], 'voxelDim': [1, 1, 1]},
+            'phase': {'spectral': {'meanLambda': [0.5] * bands}},
+            'directions': {'numberOfPropagationDirections': directions}}
+
+
+def _runtime(config):
+    # synthetic DART: quadratic in the cells, linear in the bands
+    values = cost.features(config)
+    return 0.01 * values['cells'] ** 2 * values['bands']
+
+
+def features_test():
+    config = {'maket': {'sceneDim': [10, 20, 5], 'voxelDim': [1, 2, 1]},
+              'phase': {'spectral': {'meanLambda': [0.4, 0.5, 0.6]}, 'expert_flux_tracking': {
+                  'nbSubcenterIllumination': 2}},
+              'object3d': {'importObject3d': True, 'path2obj': 'tree.obj'}}
+    assert cost.features(config) == {'cells': 100., 'bands': 3, 'directions': 1., 'subcenters': 4., 'iterations': 1.,
+                                     'meshes': 2.}
+    # missing and degenerate values fall back to neutral features
+    assert cost.features({'maket': {'voxelDim': [0, 0, 0]}}) == dict((f, 1) for f in cost.FEATURES)
+
+
+def fit_test():
+    model = cost.CostModel()
+    random.seed(0)
+    for _ in range(50):
+        config = _config(cells=random.randint(10, 200), bands=random.randint(1, 20))
+        model.observe(cost.features(config), _runtime(config))
+    model.observe(cost.features(_config()), 0.)    # failed runs without duration are ignored
+    assert len(model.observations) == 50
+
+    model.fit()
+    assert abs(model.exponents['cells'] - 2.) < 0.05
+    assert abs(model.exponents['bands'] - 1.) < 0.05
+    # features that were never varied keep their default exponents
+    assert model.exponents['iterations'] == cost.DEFAULT_EXPONENTS['iterations']
+
+    # extrapolation to features outside the observed range
+    unseen = _config(cells=1000, bands=50)
+    assert abs(model.predict(unseen) / _runtime(unseen) - 1.) < 0.2
+    assert math.isclose(model.predict(_config(directions=200)), 2 * model.predict(_config(directions=100)))
+
+    location = tempfile.mkdtemp()
+    model.save(location)
+    loaded = cost.CostModel.load(location)
+    assert math.isclose(loaded.predict(unseen), model.predict(unseen))
+
+
+def refine_test():
+    location = tempfile.mkdtemp()
+    jobs = ledger.JobLedger(location)
+    for i, (cells, bands) in enumerate([(20, 1), (50, 2), (100, 1), (150, 4), (200, 2), (80, 8)]):
+        path = os.path.join(location, 'sim_' + str(i))
+        os.makedirs(path)
+        config = _config(cells=cells, bands=bands)
+        with open(os.path.join(path, 'config.toml'), 'w') as f:
+            toml.dump(config, f)
+        jobs.register('sim_' + str(i), path=path)
+        jobs.finish('sim_' + str(i), 0, _runtime(config))
+    jobs.register('failed', path=os.path.join(location, 'sim_0'))
+    jobs.finish('failed', 1, 1e6)
+
+    model = cost.CostModel()
+    before = abs(math.log(model.predict(_config(cells=120, bands=3)) / _runtime(_config(cells=120, bands=3))))
+    model.refine(jobs)
+    assert len(model.observations) == 6
+    after = abs(math.log(model.predict(_config(cells=120, bands=3)) / _runtime(_config(cells=120, bands=3))))
+    assert after < before / 10
+
+    # refining again does not count the same runs twice
+    assert len(model.refine(jobs).observations) == 6
+
+
+def lpt_schedule_test():
+    costs = {'a': 7., 'b': 5., 'c': 4., 'd': 3., 'e': 2., 'f': 2.}
+    # by hand: a|b, c->b (9), d->a (10), e->b (11), f->a (12)
+    assignment, makespan = cost.lpt_schedule(costs, 2)
+    assert assignment == [['a', 'd', 'f'], ['b', 'c', 'e']]
+    assert makespan == 12.
+
+    assert cost.lpt_schedule(costs, 10)[1] == 7.
+    assert cost.lpt_schedule(costs, 0) == ([['a', 'b', 'c', 'd', 'e', 'f']], 23.)
+
+
+if __name__ == '__main__':
+    features_test()
+    fit_test()
+    refine_test()
+    lpt_schedule_test()
@@ -0,0 +1,143 @@
+import multiprocessing
+import os
+import socket
+import stat
+import tempfile
+import time
+
+from simulation import archive
+from simulation import daemon
+
+
+FAKE_DART = """#!/bin/sh
+mkdir -p "$1/output"
+echo done > "$1/output/fake_output"
+"""
+
+
+def _fake_dart(directory):
+    path = os.path.join(directory, 'fake_dart.sh')
+    with open(path, 'w') as f:
+        f.write(FAKE_DART)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def _serve(socket_path, dart_path=None, roots=None):
+    daemon.Daemon(socket_path=socket_path, dart_path=dart_path, roots=roots).serve()
+
+
+def daemon_test(n_requests=20):
+    location = tempfile.mkdtemp()
+    socket_path = os.path.join(location, 'dartpy.sock')
+    process = multiprocessing.Process(target=_serve, args=(socket_path, None, [location]))
+    process.start()
+    for _ in range(100):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.1)
+
+    with daemon.Client(socket_path) as client:
+        assert client.request(op='ping')['pid'] == process.pid
+
+        errors = client.request(op='validate', config={'directions': {'sun': {'sunViewingZenithAngle': 120}}})
+        assert len(errors['errors']) == 1, errors
+
+        start = time.time()
+        paths = [client.request(op='create', config={'directions': {'sun': {'sunViewingZenithAngle': float(i)}}},
+                                simulation_location=location, simulation_name='sim_' + str(i),
+                                no_gen='not_implemented', pack=i % 2 == 1)['path'] for i in range(n_requests)]
+        seconds = (time.time() - start) / n_requests
+        assert all(archive.exists(os.path.join(p, 'input', 'directions.xml')) for p in paths)
+
+        # requests within the same second get their own directories
+        same = [client.request(op='create', config={'directions': {'sun': {'sunViewingZenithAngle': float(z)}}},
+                               simulation_location=location, no_gen='not_implemented')['path'] for z in [10, 50]]
+        assert same[0] != same[1]
+        assert '10.0' in archive.read_text(os.path.join(same[0], 'config.toml'))
+
+        try:
+            client.request(op='create', config={'directions': {'sun': {'sunViewingZenithAngle': 120}}},
+                           simulation_location=location, no_gen='not_implemented')
+            assert False, 'invalid config was created'
+        except Exception as e:
+            assert 'sunViewingZenithAngle' in str(e), e
+
+        # a running daemon keeps its socket
+        try:
+            daemon.Daemon(socket_path=socket_path)
+            assert False, 'second daemon took over the socket'
+        except Exception as e:
+            assert 'already listening' in str(e), e
+        assert client.request(op='ping')['pid'] == process.pid
+
+        client.request(op='shutdown')
+    process.join(10)
+    assert not os.path.exists(socket_path)
+    return seconds
+
+
+def restricted_test():
+    location = tempfile.mkdtemp()
+    socket_path = os.path.join(location, 'dartpy.sock')
+    dart_path = _fake_dart(location)
+    roots = [os.path.join(location, 'sims')]
+    process = multiprocessing.Process(target=_serve, args=(socket_path, dart_path, roots))
+    process.start()
+    for _ in range(100):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.1)
+
+    def refused(what, **message):
+        try:
+            client.request(**message)
+        except Exception as e:
+            assert what in str(e), e
+        else:
+            raise AssertionError(str(message) + ' was not refused')
+
+    with daemon.Client(socket_path) as client:
+        path = client.request(op='create', simulation_location=roots[0], no_gen='not_implemented')['path']
+        assert client.request(op='run', path=path)['status']['state'] == 'done'
+        assert os.path.exists(os.path.join(path, 'output', 'fake_output'))
+
+        # requests cannot choose the executable nor leave the roots
+        refused('dart_path', op='run', path=path, dart_path='/bin/true')
+        refused('dart_path', op='create', simulation_location=roots[0], no_gen='not_implemented', dart_path='/bin/true')
+        refused('not below the daemon roots', op='create', simulation_location=location, no_gen='not_implemented')
+        refused('not below the daemon roots', op='create', simulation_location=os.path.join(roots[0], '..'),
+                no_gen='not_implemented')
+        refused('not below the daemon roots', op='run', path=location)
+        client.request(op='shutdown')
+    process.join(10)
+
+
+def no_dart_path_test():
+    location = tempfile.mkdtemp()
+    server = daemon.Daemon(socket_path=os.path.join(location, 'dartpy.sock'), roots=[location])
+    try:
+        server.handle({'op': 'run', 'path': location})
+    except Exception as e:
+        assert 'without a dart_path' in str(e), e
+    else:
+        raise AssertionError('runs without a daemon dart_path must be refused')
+    finally:
+        server._server.server_close()
+
+
+def stale_socket_test():
+    socket_path = os.path.join(tempfile.mkdtemp(), 'dartpy.sock')
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+    assert os.path.exists(socket_path)
+    server = daemon.Daemon(socket_path=socket_path)
+    server._server.server_close()
+
+
+if __name__ == '__main__':
+    print(daemon_test())
+    restricted_test()
+    no_dart_path_test()
+    stale_socket_test()
@@ -0,0 +1,61 @@
+import os
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from simulation import database
+
+
+def _fixture(directory, name, models):
+    """
+    Small database in the DART layout: one table per model and a _comment table.
+    """
+    connection = sqlite3.connect(os.path.join(directory, name))
+    connection.execute('CREATE TABLE _comment (name TEXT, description TEXT)')
+    for model, reflectance in models.items():
+        connection.execute('CREATE TABLE "' + model + '" (wavelength REAL, reflectance REAL, transmittance REAL)')
+        connection.executemany('INSERT INTO "' + model + '" VALUES (?, ?, ?)',
+                               [(0.7, reflectance, 0.), (0.4, reflectance / 2, 0.)])
+        connection.execute('INSERT INTO _comment VALUES (?, ?)', (model, model + ' fixture'))
+    connection.commit()
+    connection.close()
+
+
+def _databases():
+    directory = tempfile.mkdtemp()
+    _fixture(directory, 'Lambertian.db', {'litter': 0.2, 'bark_deciduous': 0.3})
+    _fixture(directory, 'Vegetation.db', {'leaf_top': 0.45})
+    return database.OpticalDatabases([directory], pool_size=2)
+
+
+def models_test():
+    databases = _databases()
+    assert databases.models('Lambertian.db') == frozenset(['litter', 'bark_deciduous'])
+    assert databases.descriptions('Vegetation.db') == {'leaf_top': 'leaf_top fixture'}
+
+    spectrum = databases.spectrum('Vegetation.db', 'leaf_top')
+    assert list(spectrum['wavelength']) == [0.4, 0.7], spectrum
+    assert spectrum['reflectance'][1] == 0.45
+
+    # more concurrent queries than pooled connections
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        spectra = list(pool.map(lambda _: databases.spectrum('Lambertian.db', 'litter'), range(32)))
+    assert all(s['reflectance'][1] == 0.2 for s in spectra)
+    databases.close()
+
+
+def check_test():
+    databases = _databases()
+    coeff_diff = {'lop2d': {'model': [{'databaseName': 'Lambertian.db', 'ModelName': 'litter'},
+                                      {'databaseName': 'Lambertian.db', 'ModelName': 'grass'}]},
+                  'lop3d': {'model': [{'databaseName': 'Vegetation.db', 'ModelName': 'leaf_top', 'useSpecular': 1,
+                                       'specularDatabaseName': 'Roughness.db', 'specularModelName': 'basic'}]}}
+    errors = databases.check(coeff_diff)
+    assert len(errors) == 2, errors
+    assert errors[0] == "coeff_diff.lop2d.model[1].ModelName = 'grass': not in Lambertian.db", errors
+    assert 'Roughness.db not found' in errors[1], errors
+
+
+if __name__ == '__main__':
+    models_test()
+    check_test()
@@ -0,0 +1,66 @@
+import os
+import tempfile
+
+import numpy as np
+import toml
+
+from simulation import dataset
+from simulation import ledger
+from simulation import postprocessing
+
+IMAGES = ['ima01_VZ=000_0_VA=000_0.mp#', 'ima02_VZ=030_0_VA=090_0.mp#']
+
+
+def _location(lais=(1., 2., 3.), bands=(0.45, 0.55, 0.65), shape=(4, 6)):
+    """
+    Finished simulations with synthetic images: value = 100 * simulation + 10 * band + direction + pixel / 100.
+    """
+    location = tempfile.mkdtemp()
+    jobs = ledger.JobLedger(location)
+    pixels = np.arange(shape[0] * shape[1]).reshape(shape) / 100.
+    for s, lai in enumerate(lais):
+        path = os.path.join(location, 'sim_{:04d}'.format(s))
+        os.makedirs(path)
+        with open(os.path.join(path, 'config.toml'), 'w') as f:
+            toml.dump({'phase': {'spectral': {'meanLambda': list(bands), 'deltaLambda': [0.01] * len(bands)}},
+                       'maket': {'sceneDim': [shape[1], shape[0], 0], 'voxelDim': [1., 1., 1.]}}, f)
+        for b in range(len(bands)):
+            directory = os.path.join(path, 'output', 'BAND' + str(b), dataset.DEFAULT_PRODUCT)
+            os.makedirs(directory)
+            for d, image in enumerate(IMAGES):
+                (100 * s + 10 * b + d + pixels).astype('<f8').tofile(os.path.join(directory, image))
+        jobs.register('sim_{:04d}'.format(s), sweep='lai', path=path, parameters={'plots.vegetation.lai': lai})
+        jobs.transition('sim_{:04d}'.format(s), ledger.DONE)
+    return location
+
+
+def select_test():
+    ds = dataset.for_location(_location(), sweep='lai')
+    assert ds.dims == dataset.DIMS
+    assert ds.shape == (3, 3, 2, 4, 6)
+    assert ds.parameters == {'plots.vegetation.lai': [1., 2., 3.]}
+
+    view = ds.sel(band=0.56, **{'plots.vegetation.lai': [2., 3.]}).sel(direction=(30., 90.))
+    assert view.dims == ('simulation', 'y', 'x')
+    values = view.isel(y=slice(1, 3), x=[0, 5]).values
+    assert values.shape == (2, 2, 2)
+    assert np.allclose(values[1, 0], [200 + 10 + 1 + 0.06, 200 + 10 + 1 + 0.11])
+    assert np.allclose(ds[0, 1, 0].values, 10 + np.arange(24).reshape(4, 6) / 100.)
+
+
+def reduce_test():
+    location = _location()
+    # compressed images are streamed
+    postprocessing.compress_file(os.path.join(location, 'sim_0001', 'output', 'BAND0', dataset.DEFAULT_PRODUCT,
+                                              IMAGES[1]))
+    ds = dataset.for_location(location)
+    assert np.allclose(ds.mean(['y', 'x']), ds.values.mean(axis=(3, 4)))
+    assert np.allclose(ds.max(['simulation', 'y']), ds.values.max(axis=(0, 3)))
+    assert np.isclose(ds.isel(band=2).sum(), ds.values[:, 2].sum())
+    assert np.allclose(ds.isel(simulation=1, band=0, direction=1, y=[0, 2]).values,
+                       100 + 1 + np.arange(24).reshape(4, 6)[[0, 2]] / 100.)
+
+
+if __name__ == '__main__':
+    select_test()
+    reduce_test()
@@ -0,0 +1,143 @@
+import multiprocessing
+import os
+import signal
+import stat
+import tempfile
+import time
+
+import toml
+
+from simulation import distributed
+from simulation import ledger as jl
+from simulation import run
+import utils.general
+
+
+FAKE_DART = """#!/bin/sh
+sleep {seconds}
+echo done > "$1/fake_output"
+"""
+
+
+def _fake_dart(directory, seconds):
+    path = utils.general.create_path(directory, 'fake_dart.sh')
+    with open(path, 'w') as f:
+        f.write(FAKE_DART.format(seconds=seconds))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+FAKE_DART_OUTPUT = """#!/bin/sh
+mkdir -p "$1/output"
+echo done > "$1/output/fake_output"
+"""
+
+
+def _ledger(location, n_jobs):
+    ledger = jl.JobLedger(location)
+    for i in range(n_jobs):
+        path = utils.general.create_path(location, 'job_' + str(i))
+        os.makedirs(path)
+        ledger.register('job_' + str(i), state=jl.EMITTED, sweep='test', path=path)
+    return ledger
+
+
+def _serve(location, port, heartbeat_timeout):
+    coordinator = distributed.Coordinator(jl.JobLedger(location), sweep='test', host='127.0.0.1', port=port,
+                                          heartbeat_timeout=heartbeat_timeout)
+    coordinator.serve()
+
+
+def _work(port, dart_path, jobs):
+    distributed.Worker('127.0.0.1', port, jobs=jobs, dart_path=dart_path, heartbeat_interval=0.2,
+                       poll_interval=0.2).work()
+
+
+def _free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def coordinator_workers_test(n_jobs=12, n_workers=3):
+    location = tempfile.mkdtemp()
+    ledger = _ledger(location, n_jobs)
+    dart_path = _fake_dart(location, 0.2)
+    port = _free_port()
+
+    coordinator = multiprocessing.Process(target=_serve, args=(location, port, 2.))
+    coordinator.start()
+    time.sleep(0.5)
+
+    workers = [multiprocessing.Process(target=_work, args=(port, dart_path, 2)) for _ in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+    coordinator.join(60)
+
+    assert ledger.counts(sweep='test')[jl.DONE] == n_jobs
+    assert all(os.path.exists(utils.general.create_path(job['path'], 'fake_output')) for job in ledger.jobs())
+    return ledger.counts(sweep='test')
+
+
+def dead_worker_requeue_test(n_jobs=4):
+    location = tempfile.mkdtemp()
+    ledger = _ledger(location, n_jobs)
+    port = _free_port()
+
+    coordinator = multiprocessing.Process(target=_serve, args=(location, port, 1.))
+    coordinator.start()
+    time.sleep(0.5)
+
+    # this worker hangs on its first job and gets killed without reporting
+    dead = multiprocessing.Process(target=_work, args=(port, _fake_dart(location, 60), 1))
+    dead.start()
+    time.sleep(1.)
+    os.kill(dead.pid, signal.SIGKILL)
+    dead.join()
+
+    alive = multiprocessing.Process(target=_work, args=(port, _fake_dart(tempfile.mkdtemp(), 0.1), 1))
+    alive.start()
+    alive.join(60)
+    coordinator.join(60)
+
+    counts = ledger.counts(sweep='test')
+    assert counts[jl.DONE] == n_jobs, counts
+    assert max(job['attempts'] for job in ledger.jobs()) == 2
+    return counts
+
+
+def postprocess_jobs_test(n_jobs=4):
+    location = tempfile.mkdtemp()
+    ledger = _ledger(location, n_jobs)
+    for job in ledger.jobs():
+        with open(utils.general.create_path(job['path'], 'config.toml'), 'w') as f:
+            toml.dump({'postprocessing': {'drop': ['output/*']}}, f)
+    dart_path = utils.general.create_path(location, 'fake_dart_output.sh')
+    with open(dart_path, 'w') as f:
+        f.write(FAKE_DART_OUTPUT)
+    os.chmod(dart_path, os.stat(dart_path).st_mode | stat.S_IEXEC)
+    port = _free_port()
+
+    coordinator = multiprocessing.Process(target=_serve, args=(location, port, 2.))
+    coordinator.start()
+    time.sleep(0.5)
+    # postprocess_jobs=0 leaves the outputs untouched although the retention policy drops them
+    runner = run.SimulationRunner(jobs=2, dart_path=dart_path, postprocess_jobs=0)
+    results = runner.work('127.0.0.1', port=port, heartbeat_interval=0.2)
+    coordinator.join(60)
+
+    assert len(results) == n_jobs
+    for job in ledger.jobs():
+        assert os.path.exists(utils.general.create_path(job['path'], 'output', 'fake_output'))
+
+    # the tuned threads reach the runner of the worker as well
+    worker_runner = distributed.Worker('127.0.0.1', port=port, threads=3, postprocess_jobs=0).runner
+    assert worker_runner.threads == 3 and worker_runner.postprocessor is None
+
+
+if __name__ == '__main__':
+    print(coordinator_workers_test())
+    print(dead_worker_requeue_test())
+    postprocess_jobs_test()
@@ -0,0 +1,62 @@
+import copy
+import os
+import tempfile
+
+import numpy as np
+from lxml import etree
+
+from simulation import components
+from simulation import simulation
+
+
+def _params(**topography):
+    params = copy.deepcopy(simulation.load_config(simulation.default_config_path('5.7.5'))['maket'])
+    params['topography'].update(topography)
+    return params
+
+
+def _write(params, **kwargs):
+    directory = tempfile.mkdtemp()
+    components.Maket(directory, params, '5.7.5', **kwargs).to_file()
+    return directory, etree.parse(os.path.join(directory, 'input', 'maket.xml')).getroot()
+
+
+def no_topography_test():
+    _, root = _write(_params(fileName=''))
+    assert root.find('.//Soil/Topography').get('presenceOfTopography') == '0'
+    assert root.find('.//Soil/DEM_properties').get('createTopography') == '0'
+
+
+def dem_test():
+    dem = np.random.rand(300, 900)
+    directory, root = _write(_params(), dem=dem)
+    assert root.find('.//Soil/Topography').get('presenceOfTopography') == '1'
+    assert root.find('.//Soil/Topography/TopographyProperties').get('fileName') == components.DEM_OUTPUT_FILE
+    generator = root.find('.//Soil/DEM_properties/DEMGenerator')
+    assert generator.get('caseDEM') == str(components.DEM_IMPORT_CASE)
+    assert generator.find('DEM_5').get('fileName') == components.DEM_FILE
+
+    written = os.path.join(directory, 'input', components.DEM_FILE)
+    assert np.array_equal(np.fromfile(written, dtype='<f8').reshape(dem.shape), dem)
+
+    # the same terrain is written once to the cache and linked into every simulation
+    other, _ = _write(_params(), dem=dem.copy())
+    cached = components.cache_dem(dem)
+    assert os.stat(os.path.join(other, 'input', components.DEM_FILE)).st_ino == os.stat(cached).st_ino
+    assert components.cache_dem(dem + 1.) != cached
+
+
+def pickled_dem_test():
+    dem = np.random.rand(300, 900)
+    sim = simulation.Simulation({}, maket=dem, no_gen='not_implemented', simulation_location=tempfile.mkdtemp())
+    sim.to_file()
+    # the DEM is referenced in the cache, not pickled
+    assert os.path.getsize(os.path.join(sim.path, simulation.DILL_FIL)) < dem.nbytes / 10
+    loaded = simulation.Simulation.load(sim.path)
+    assert np.array_equal(loaded.maket, dem)
+
+
+if __name__ == '__main__':
+    no_topography_test()
+    dem_test()
+    pickled_dem_test()
@@ -0,0 +1,107 @@
+import copy
+import os
+import tempfile
+import time
+from unittest import mock
+
+import numpy as np
+from lxml import etree
+
+from simulation import components
+from simulation import simulation
+import utils.obj_utils
+
+OBJ = """# cube
+v 0.0 0.0 0.0
+v 1.5 0.0 0.0
+v 1.5 2.0 0.0
+v 0.0 2.0 3.25
+f 1 2 3
+f 1 3 4
+"""
+
+
+def _write(content):
+    path = os.path.join(tempfile.mkdtemp(), 'mesh.obj')
+    with open(path, 'w') as f:
+        f.write(content)
+    return path
+
+
+def chunk_boundary_test():
+    path = _write(OBJ)
+    expected = utils.obj_utils.scan(path)
+    assert expected['vertices'] == 4 and expected['faces'] == 2
+    assert expected['dim'] == [1.5, 2.0, 3.25]
+    # chunks ending in the middle of vertex lines and in lines longer than a chunk
+    for chunk_size in [1, 5, 7, 16, 23]:
+        assert utils.obj_utils.scan(path, chunk_size=chunk_size) == expected, chunk_size
+
+
+def w_component_test():
+    meta = utils.obj_utils.scan(_write('v 0 0 0 1.0\nv -1 2 4 0.5\nv 1 1 1\nf 1 2 3\n'))
+    assert meta['vertices'] == 3
+    assert meta['min'] == [-1., 0., 0.] and meta['max'] == [1., 2., 4.]
+
+
+def cache_test():
+    with mock.patch.dict(os.environ, {'DARTPY_CACHE': tempfile.mkdtemp()}):
+        path = _write(OBJ)
+        first = utils.obj_utils.metadata(path)
+        assert first['dim'] == [1.5, 2.0, 3.25]
+        assert utils.obj_utils.metadata(path) == first
+
+        # a changed file is hashed and scanned again
+        time.sleep(0.01)
+        with open(path, 'a') as f:
+            f.write('v 10 0 0\n')
+        changed = utils.obj_utils.metadata(path)
+        assert changed['vertices'] == 5 and changed['dim'] == [10., 2.0, 3.25]
+        assert changed['sha1'] != first['sha1']
+
+
+def object3d_auto_test():
+    params = copy.deepcopy(simulation.load_config(simulation.default_config_path('5.7.5'))['object3d'])
+    params.update({'dim': 'auto', 'path2obj': _write(OBJ)})
+    directory = tempfile.mkdtemp()
+    components.Object3d(directory, params, '5.7.5').to_file()
+    dimension = etree.parse(os.path.join(directory, 'input', 'object_3d.xml')).find('.//Dimension3D')
+    assert [float(dimension.get(k)) for k in ['xdim', 'ydim', 'zdim']] == [1.5, 2.0, 3.25]
+
+    params['path2obj'] = os.path.join(directory, 'missing.obj')
+    try:
+        components.Object3d(directory, params, '5.7.5').to_file()
+        assert False, 'auto dimensions of a missing mesh were written'
+    except Exception as e:
+        assert 'missing.obj' in str(e), e
+
+
+def instancing_test():
+    directory = tempfile.mkdtemp()
+    positions = np.array([[1., 2., 0.5], [3.5, 4., 1.], [10., 0.25, 2.]])
+    table = os.path.join(directory, 'positions.txt')
+    np.savetxt(table, np.column_stack([positions, [1., 2., 3.]]), header='x y z scale')
+
+    params = copy.deepcopy(simulation.load_config(simulation.default_config_path('5.7.5'))['object3d'])
+    params.update({'path2obj': _write(OBJ), 'location': [100, 200, 0], 'instancing': 1, 'objPosFile': table,
+                   'objPosColumns': ['x', 'y', 'z', 'scale']})
+    components.Object3d(directory, params, '5.7.5').to_file()
+
+    objects = etree.parse(os.path.join(directory, 'input', 'object_3d.xml')).findall('.//ObjectList/Object')
+    assert len(objects) == len(positions)
+    for i, obj in enumerate(objects):
+        position = obj.find('GeometricProperties/PositionProperties')
+        assert [float(position.get(k)) for k in ['xpos', 'ypos', 'zpos']] == list(positions[i] + [100, 200, 0])
+        scale = obj.find('GeometricProperties/ScaleProperties')
+        assert [float(scale.get(k)) for k in ['xscale', 'yscale', 'zscale']] == [i + 1.] * 3
+        assert obj.get('num') == str(i)
+        # everything else is copied from the template object
+        assert obj.find('.//OpticalPropertyLink').get('ident') == params['optical_property']['modelName']
+
+
+if __name__ == '__main__':
+    chunk_boundary_test()
+    w_component_test()
+    cache_test()
+    object3d_auto_test()
+    instancing_test()
@@ -0,0 +1,45 @@
+from simulation import optical
+
+
+def _model(ident, name='litter'):
+    return {'ModelName': name, 'ident': ident, 'databaseName': 'Lambertian.db'}
+
+
+def library_test():
+    params = {'lop2d': {'model': [_model('litter'), _model('bark', 'bark'), _model('litter')]},
+              'lop3d': {'model': [_model('leaf', 'leaf_top')]}}
+    library = optical.OpticalLibrary.from_params(params)
+    assert len(library.models('lop2d')) == 2
+    assert library.resolve('bark', 'auto', 'lop2d') == 1
+    assert library.resolve('leaf', 'auto', optical.kind(3)) == 0
+    assert library.resolve('bark', 1, 'lop2d') == 1
+    assert library.resolve('unknown', 5, 'lop2d') == 5
+    # same content, same shared library
+    assert optical.OpticalLibrary.from_params(dict(params)) is library
+
+
+def conflict_test():
+    params = {'lop2d': {'model': [_model('litter'), _model('litter', 'other')]}}
+    try:
+        optical.OpticalLibrary.from_params(params)
+        assert False, 'conflicting models were accepted'
+    except Exception as e:
+        assert 'defined twice' in str(e), e
+
+
+def stale_index_test():
+    # [A, B, A, C] is written as [A, B, C], the explicit index 3 of C would point past the end
+    params = {'lop2d': {'model': [_model('A'), _model('B', 'bark'), _model('A'), _model('C', 'soil')]}}
+    library = optical.OpticalLibrary.from_params(params)
+    assert library.resolve('C', 'auto', 'lop2d') == 2
+    try:
+        library.resolve('C', 3, 'lop2d')
+        assert False, 'stale indexFctPhase was accepted'
+    except Exception as e:
+        assert "'auto'" in str(e), e
+
+
+if __name__ == '__main__':
+    library_test()
+    conflict_test()
+    stale_index_test()
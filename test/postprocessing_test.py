@@ -0,0 +1,96 @@
+import os
+import stat
+import tempfile
+
+import toml
+
+from simulation import postprocessing
+from simulation import run
+import utils.general
+
+FAKE_DART = """#!/bin/sh
+mkdir -p "$1/output/BAND0/BRF" "$1/output/BAND0/Tapes"
+echo brf > "$1/output/BAND0/BRF/brf"
+echo tapes > "$1/output/BAND0/Tapes/tape"
+"""
+
+
+def _write(path, rel, content):
+    file_path = os.path.join(path, rel)
+    if not os.path.exists(os.path.dirname(file_path)):
+        os.makedirs(os.path.dirname(file_path))
+    with open(file_path, 'wb') as f:
+        f.write(content)
+
+
+def _directory():
+    path = tempfile.mkdtemp()
+    _write(path, 'config.toml', b'simulation_name = "policy"\n')
+    _write(path, 'input/phase.xml', b'<Phase/>')
+    _write(path, 'output/BAND0/BRF/brf', b'0 0 0.1\n' * 100)
+    _write(path, 'output/BAND0/Tapes/tape', b'tape')
+    _write(path, 'output/BAND1/BRF/brf', b'0 0 0.2\n' * 100)
+    return path
+
+
+def apply_test():
+    path = _directory()
+    # a broad pattern only ever reaches the outputs
+    policy = postprocessing.RetentionPolicy(keep=['output/BAND0/BRF/*'], drop=['*Tapes*', 'input/*', '*.toml'],
+                                            compress=['*'])
+    before, after = policy.apply(path)
+    assert after < before
+
+    assert os.path.exists(os.path.join(path, 'config.toml'))
+    assert os.path.exists(os.path.join(path, 'input', 'phase.xml'))
+    assert not os.path.exists(os.path.join(path, 'output', 'BAND0', 'Tapes'))
+    assert os.path.exists(os.path.join(path, 'output', 'BAND0', 'BRF', 'brf'))
+    assert sorted(os.listdir(os.path.join(path, 'output', 'BAND1', 'BRF'))) == ['brf.zst']
+
+    # applying it again is a no-op
+    assert policy.apply(path) == (after, after)
+
+
+def open_output_test():
+    path = _directory()
+    postprocessing.RetentionPolicy(compress=['output/*']).apply(path)
+    brf = os.path.join(path, 'output', 'BAND1', 'BRF', 'brf')
+    assert not os.path.exists(brf)
+    with postprocessing.open_output(brf) as f:
+        assert f.read() == b'0 0 0.2\n' * 100
+    assert postprocessing.read_output(os.path.join(path, 'input', 'phase.xml')) == b'<Phase/>'
+
+    postprocessing.decompress_file(brf)
+    with open(brf, 'rb') as f:
+        assert f.read() == b'0 0 0.2\n' * 100
+
+
+def runner_test():
+    location = tempfile.mkdtemp()
+    dart_path = utils.general.create_path(location, 'fake_dart.sh')
+    with open(dart_path, 'w') as f:
+        f.write(FAKE_DART)
+    os.chmod(dart_path, os.stat(dart_path).st_mode | stat.S_IEXEC)
+
+    paths = []
+    for i in range(3):
+        path = os.path.join(location, 'sim_' + str(i))
+        os.makedirs(path)
+        with open(os.path.join(path, 'config.toml'), 'w') as f:
+            toml.dump({'postprocessing': {'drop': ['output/*/Tapes/*']}}, f)
+        paths.append(path)
+
+    runner = run.SimulationRunner(paths, jobs=2, dart_path=dart_path)
+    results = runner.run()
+    assert all(r['state'] == run.DONE for r in results)
+    for path in paths:
+        assert os.path.exists(os.path.join(path, 'output', 'BAND0', 'BRF', 'brf'))
+        assert not os.path.exists(os.path.join(path, 'output', 'BAND0', 'Tapes'))
+    # the postprocessing threads are stopped with the run
+    assert runner.postprocessor._pool is None
+
+
+if __name__ == '__main__':
+    apply_test()
+    open_output_test()
+    runner_test()
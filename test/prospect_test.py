@@ -0,0 +1,80 @@
+import os
+import tempfile
+
+import numpy as np
+
+from simulation import database
+from simulation import prospect
+
+
+def _coefficients(directory):
+    """
+    Synthetic coefficient table in the PROSPECT-D layout: a chlorophyll band at 670 nm and water beyond 1300 nm.
+    """
+    wavelength = np.arange(400., 2501., 5.)
+    zero = np.zeros_like(wavelength)
+    table = np.column_stack([wavelength, np.full_like(wavelength, 1.45),
+                             0.05 * np.exp(-((wavelength - 670.) / 40.) ** 2), zero, zero, zero,
+                             np.where(wavelength > 1300., 30., 0.), np.full_like(wavelength, 5.)])
+    path = os.path.join(directory, 'coefficients.txt')
+    np.savetxt(path, table, header='lambda nr kab kcar kanth kbrown kw km')
+    return path
+
+
+def simulate_test():
+    table, _ = prospect.coefficients(_coefficients(tempfile.mkdtemp()))
+    params = {'N': [1.5, 1.5, 2.], 'Cab': [0., 60., 60.], 'Cw': [0., 0.01, 0.01], 'Cm': [0., 0.005, 0.005],
+              'Car': [0.] * 3}
+    wavelength, reflectance, transmittance = prospect.simulate(params, table)
+    assert reflectance.shape == (3, len(wavelength))
+    # without absorbers nothing is absorbed
+    assert np.allclose(reflectance[0] + transmittance[0], 1.)
+    # chlorophyll absorbs at 670 nm
+    red = np.argmin(abs(wavelength - 0.67))
+    assert reflectance[1, red] + transmittance[1, red] < 0.5
+    # the batch equals single leaves
+    _, single, _ = prospect.simulate(dict((k, v[2]) for k, v in params.items()), table)
+    assert np.allclose(single[0], reflectance[2])
+
+
+def apply_test():
+    directory = tempfile.mkdtemp()
+    config = {'coeff_diff': {'lop3d': {'model': [{'ident': 'leaf', 'ModelName': 'leaf_top',
+                                                  'databaseName': 'Vegetation.db'}]}},
+              'prospect': {'coefficients': _coefficients(directory), 'database_dir': directory,
+                           'models': {'leaf': {'Cab': 30.}}}}
+    configs = [config] + [dict(config, prospect=dict(config['prospect'], models={'leaf': {'Cab': cab}}))
+                          for cab in [40., 50.]]
+    assert prospect.prepare(configs) == 3
+    assert prospect.prepare(configs) == 0
+
+    applied = prospect.apply(config)
+    model = applied['coeff_diff']['lop3d']['model'][0]
+    assert model['databaseName'] == prospect.DATABASE
+    assert model['ModelName'] in database.for_directories([directory]).models(prospect.DATABASE)
+    assert config['coeff_diff']['lop3d']['model'][0]['ModelName'] == 'leaf_top'
+
+
+def database_dir_test():
+    directory = tempfile.mkdtemp()
+    config = {'coeff_diff': {'lop3d': {'model': [{'ident': 'leaf', 'ModelName': 'leaf_top',
+                                                  'databaseName': 'Vegetation.db'}]}},
+              'prospect': {'coefficients': _coefficients(directory), 'models': {'leaf': {'Cab': 35.}}}}
+    # without database_dir prospect.db goes where DART looks for databases
+    os.environ[database.DATABASE_ENV] = directory
+    try:
+        prospect.apply(config)
+        assert os.path.exists(os.path.join(directory, prospect.DATABASE))
+    finally:
+        del os.environ[database.DATABASE_ENV]
+    try:
+        prospect.apply(config)
+        assert False, 'prospect.db was written where DART cannot find it'
+    except Exception as e:
+        assert 'database_dir' in str(e), e
+
+
+if __name__ == '__main__':
+    simulate_test()
+    apply_test()
+    database_dir_test()
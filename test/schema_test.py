@@ -0,0 +1,70 @@
+import copy
+
+from simulation import schema
+import simulation.simulation as simul
+
+toml = __import__('toml')
+
+
+def _default():
+    return toml.load(simul.default_config_path('5.7.5'), _dict=dict)
+
+
+def default_valid_test():
+    errors = schema.for_version('5.7.5').validate(_default())
+    assert errors == [], errors
+
+
+def all_errors_test():
+    config = _default()
+    config['phase']['calculatorMethod'] = 7
+    config['phase']['spectral']['meanLambda'] = [0.5, 'x']
+    config['directions']['sun']['sunViewingZenithAngle'] = 120
+    config['maket']['sceneDim'] = 'big'
+    del config['atmosphere']['general']['typeOfAtmosphere']
+
+    errors = schema.for_version('5.7.5').validate(config, components=['phase', 'directions', 'maket', 'atmosphere'])
+    assert len(errors) == 5, errors
+    assert any(e.startswith('atmosphere.general.typeOfAtmosphere: is missing') for e in errors)
+
+    # missing parameters are fine for components patched with an xml file
+    errors = schema.for_version('5.7.5').validate(config, components=['atmosphere'], partial=['atmosphere'])
+    assert errors == [], errors
+
+
+def sweep_test():
+    config = _default()
+    parameters = {'directions.sun.sunViewingZenithAngle': [0., 20., 95., 95.],
+                  'phase.spectral.meanLambda': [[0.45], [0.55, 0.65]]}
+    errors = schema.for_version('5.7.5').validate_sweep(copy.deepcopy(config), parameters)
+    # every distinct value is reported once, the band table length for the swept value only
+    assert len(errors) == 2, errors
+    assert '(swept phase.spectral.meanLambda = [0.55, 0.65])' in errors[1], errors
+
+
+def sweep_missing_test():
+    # swept parameters need not be in the shared config
+    config = _default()
+    del config['directions']['sun']['sunViewingZenithAngle']
+    parameters = {'directions.sun.sunViewingZenithAngle': [10., 50.]}
+    errors = schema.for_version('5.7.5').validate_sweep(copy.deepcopy(config), parameters)
+    assert errors == [], errors
+
+    # nor their tables, the other parameters of such a table are still required
+    sun = config['directions'].pop('sun')
+    errors = schema.for_version('5.7.5').validate_sweep(copy.deepcopy(config), parameters)
+    assert sorted(errors) == sorted('directions.sun.' + k + ': is missing' for k in sun), errors
+
+    # swept elements of arrays of tables
+    config = _default()
+    del config['coeff_diff']['lop2d']['model'][0]['ModelName']
+    errors = schema.for_version('5.7.5').validate_sweep(
+        copy.deepcopy(config), {'coeff_diff.lop2d.model.0.ModelName': ['litter', 'soil']})
+    assert errors == [], errors
+
+
+if __name__ == '__main__':
+    default_valid_test()
+    all_errors_test()
+    sweep_test()
+    sweep_missing_test()
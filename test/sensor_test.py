@@ -0,0 +1,67 @@
+import os
+import tempfile
+
+import numpy as np
+
+from simulation import postprocessing
+from simulation import sensor
+
+
+def _bands():
+    # 10 nm bands from 400 to 890 nm
+    mean_lambda = np.arange(0.405, 0.9, 0.01)
+    return mean_lambda, np.full_like(mean_lambda, 0.01)
+
+
+def weights_test():
+    mean_lambda, delta_lambda = _bands()
+    response = sensor.SpectralResponse.gaussian([0.49, 0.665, 0.842], [0.065, 0.03, 0.02], names=['B2', 'B4', 'B8'])
+    weights = response.weights(mean_lambda, delta_lambda)
+    assert weights.shape == (3, len(mean_lambda))
+    # sparse: the red band only sees a few simulated bands
+    assert weights.indptr[2] - weights.indptr[1] < len(mean_lambda) // 3
+    assert np.allclose([weights.data[weights.indptr[k]:weights.indptr[k + 1]].sum() for k in range(3)], 1.)
+
+    # a flat spectrum stays flat, a spectrum linear in the wavelength is resampled at the band centres
+    flat = weights.apply(np.ones((len(weights.bands), 4)))
+    assert np.allclose(flat, 1.)
+    linear = weights.apply(mean_lambda[weights.bands][:, None])[:, 0]
+    assert np.allclose(linear, response.centres(), atol=1e-3)
+
+
+def apply_test(chunk_size=1000):
+    path = tempfile.mkdtemp()
+    mean_lambda, delta_lambda = _bands()
+    rel = 'BRF/ITERX/IMAGES_DART/ima01_VZ=000_0_VA=000_0.mp#'
+    images = []
+    for i, wavelength in enumerate(mean_lambda):
+        image = np.random.rand(50, 70) * wavelength
+        images.append(image)
+        file_path = os.path.join(path, 'output', 'BAND' + str(i), rel)
+        os.makedirs(os.path.dirname(file_path))
+        image.astype('<f8').tofile(file_path)
+        np.savetxt(os.path.join(path, 'output', 'BAND' + str(i), 'BRF', 'ITERX', 'brf'),
+                   np.column_stack([[0., 30.], [0., 90.], [wavelength, 2 * wavelength]]))
+    # outputs compressed by a retention policy are read as well
+    postprocessing.compress_file(os.path.join(path, 'output', 'BAND3', rel))
+
+    response = sensor.SpectralResponse.gaussian([0.56, 0.665], [0.035, 0.03])
+    resampling = sensor.Resampling(response, name='test', images=['BRF/*/IMAGES_DART/*.mp#'],
+                                   tables=['BRF/*/brf'], chunk_size=chunk_size)
+    config = {'phase': {'spectral': {'meanLambda': list(mean_lambda), 'deltaLambda': list(delta_lambda)}}}
+    written = resampling.apply(path, config=config)
+    assert len(written) == 4
+
+    weights = resampling.weights(config['phase']['spectral'])
+    expected = weights.apply(np.array([images[i].ravel() for i in weights.bands]))
+    for k in range(2):
+        image = np.fromfile(os.path.join(resampling.output_dir(path), 'BAND' + str(k), rel), dtype='<f8')
+        assert np.allclose(image, expected[k])
+        table = np.loadtxt(os.path.join(resampling.output_dir(path), 'BAND' + str(k), 'BRF', 'ITERX', 'brf'))
+        assert np.allclose(table[:, :2], [[0., 0.], [30., 90.]])
+        assert np.allclose(table[1, 2], 2 * table[0, 2])
+
+
+if __name__ == '__main__':
+    weights_test()
+    apply_test()
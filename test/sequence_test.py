@@ -0,0 +1,66 @@
+import json
+import os
+import tempfile
+
+from lxml import etree
+
+from simulation import ledger
+from simulation import sequence
+from simulation import sweep
+
+
+def _sweep(parameters, mode='product'):
+    location = tempfile.mkdtemp()
+    return sweep.Sweep({'sweep': {'name': 'sun', 'simulation_location': location, 'sequence': True, 'mode': mode,
+                                  'sequence_preferences': {'numberParallelThreads': 4},
+                                  'parameters': parameters}}, root=location)
+
+
+def sequence_xml_test():
+    s = _sweep({'directions': {'sun': {'sunViewingZenithAngle': [10., 20., 30.],
+                                       'sunViewingAzimuthAngle': [0., 90.]}}})
+    assert [v.name for v in s.create()] == [s.sequence_name]
+
+    jobs = s.ledger.jobs(sweep=s.name)
+    assert len(jobs) == 1 and jobs[0]['state'] == ledger.EMITTED
+    path = jobs[0]['path']
+    root = etree.parse(os.path.join(path, sequence.SEQUENCE_FILE)).getroot()
+    groups = root.findall('.//DartSequencerDescriptorGroup')
+    entries = [[(e.get('propertyName'), e.get('args')) for e in g] for g in groups]
+    assert entries == [[('Directions.SunViewingAngles.sunViewingZenithAngle', '10.0;20.0;30.0')],
+                       [('Directions.SunViewingAngles.sunViewingAzimuthAngle', '0.0;90.0')]]
+    assert root.find('.//DartSequencerPreferences').get('numberParallelThreads') == '4'
+
+    with open(os.path.join(path, sequence.SEQUENCE_MANIFEST)) as f:
+        assert len(json.load(f)['variants']) == 6
+
+
+def zip_test():
+    s = _sweep({'directions': {'sun': {'sunViewingZenithAngle': [10., 20.], 'sunViewingAzimuthAngle': [0., 90.]}}},
+               mode='zip')
+    s.create()
+    path = s.ledger.jobs(sweep=s.name)[0]['path']
+    root = etree.parse(os.path.join(path, sequence.SEQUENCE_FILE)).getroot()
+    # zipped parameters vary together in one group
+    assert [len(g) for g in root.findall('.//DartSequencerDescriptorGroup')] == [2]
+
+
+def rejected_test():
+    for parameters in [{'atmosphere': {'general': {'typeOfAtmosphere': [0, 1]}}},
+                       {'plots': {'vegetation': {'lai': [[1., 1.], [2., 2.]]}}}]:
+        s = _sweep(parameters)
+        try:
+            s.create()
+        except Exception as e:
+            assert 'cannot be sequenced' in str(e), e
+        else:
+            raise AssertionError(str(parameters) + ' must not be sequenced')
+        # nothing is left behind
+        assert s.ledger.jobs(sweep=s.name) == []
+        assert [name for name in os.listdir(s.simulation_location) if not name.startswith(ledger.LEDGER_FILE)] == []
+
+
+if __name__ == '__main__':
+    sequence_xml_test()
+    zip_test()
+    rejected_test()
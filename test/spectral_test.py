@@ -0,0 +1,108 @@
+import os
+import stat
+import tempfile
+
+import numpy as np
+from lxml import etree
+
+from simulation import components
+from simulation import simulation
+from simulation import spectral
+import utils.general
+
+# writes two bands and a shared output into the piece directory
+FAKE_DART = """#!/bin/sh
+for band in 0 1; do
+    mkdir -p "$1/output/BAND$band/BRF"
+    echo "$1 $band" > "$1/output/BAND$band/BRF/brf"
+done
+echo "$1" > "$1/output/maket.txt"
+"""
+
+
+def _simulation(bands=4, maket=None, **postprocessing):
+    location = tempfile.mkdtemp()
+    config = {'phase': {'spectral': {'meanLambda': [0.4 + 0.1 * i for i in range(bands)],
+                                     'deltaLambda': [0.01] * bands, 'spectralDartMode': [0] * bands}},
+              'postprocessing': postprocessing}
+    sim = simulation.Simulation(config, no_gen='not_implemented', simulation_name='split', maket=maket,
+                                simulation_location=location)
+    if not os.path.exists(sim.path):
+        os.makedirs(sim.path)
+    return sim
+
+
+def _fake_dart(directory):
+    path = utils.general.create_path(directory, 'fake_dart.sh')
+    with open(path, 'w') as f:
+        f.write(FAKE_DART)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def band_slices_test():
+    assert spectral.band_slices(10, 3) == [(0, 4), (4, 7), (7, 10)]
+    assert spectral.band_slices(2, 5) == [(0, 1), (1, 2)]
+    assert spectral.band_slices(3, 0) == [(0, 3)]
+
+
+def split_merge_test():
+    sim = _simulation(bands=5)
+    pieces = spectral.split(sim, 2)
+    assert [p.config['phase']['spectral']['meanLambda'] for p in pieces] == \
+        [sim.config['phase']['spectral']['meanLambda'][:3], sim.config['phase']['spectral']['meanLambda'][3:]]
+    assert [(p['start'], p['stop']) for p in spectral.pieces(sim.path)] == [(0, 3), (3, 5)]
+
+    for piece in pieces:
+        n_bands = len(piece.config['phase']['spectral']['meanLambda'])
+        for band in range(n_bands):
+            os.makedirs(os.path.join(piece.path, 'output', 'BAND' + str(band)))
+            with open(os.path.join(piece.path, 'output', 'BAND' + str(band), 'brf'), 'w') as f:
+                f.write(piece.path + ' ' + str(band))
+        with open(os.path.join(piece.path, 'output', 'maket.txt'), 'w') as f:
+            f.write(piece.path)
+
+    output = spectral.merge(sim.path, move=False)
+    assert sorted(os.listdir(output)) == ['BAND' + str(b) for b in range(5)] + ['maket.txt']
+    with open(os.path.join(output, 'BAND4', 'brf')) as f:
+        assert f.read() == pieces[1].path + ' 1'
+    # non band outputs are taken from the first piece
+    with open(os.path.join(output, 'maket.txt')) as f:
+        assert f.read() == pieces[0].path
+
+
+def dem_test():
+    dem = np.random.rand(30, 90)
+    sim = _simulation(bands=4, maket=dem)
+    for piece in spectral.split(sim, 2):
+        piece.to_file()
+        # every piece runs the scene of the split simulation, topography included
+        assert np.array_equal(np.fromfile(os.path.join(piece.path, 'input', components.DEM_FILE), dtype='<f8'),
+                              dem.ravel())
+        root = etree.parse(os.path.join(piece.path, 'input', 'maket.xml')).getroot()
+        assert root.find('.//Soil/Topography').get('presenceOfTopography') == '1'
+        assert root.find('.//Soil/DEM_properties/DEMGenerator').get('caseDEM') == str(components.DEM_IMPORT_CASE)
+
+
+def run_pieces_test():
+    # the retention policy must not drop piece outputs before they are merged, it applies to the merged outputs
+    sim = _simulation(bands=4, drop=['output/maket.txt'])
+    pieces = spectral.split(sim, 2)
+    dart_path = _fake_dart(sim.path)
+    spectral.run_pieces(sim, pieces, merge_outputs=False, jobs=2, dart_path=dart_path)
+    assert all(os.path.exists(os.path.join(p.path, 'output', 'maket.txt')) for p in pieces)
+
+    results = spectral.run_pieces(sim, pieces, jobs=2, dart_path=dart_path)
+    assert all(r['state'] == 'done' for r in results)
+
+    output = os.path.join(sim.path, 'output')
+    assert sorted(os.listdir(output)) == ['BAND' + str(b) for b in range(4)]
+    with open(os.path.join(output, 'BAND2', 'BRF', 'brf')) as f:
+        assert f.read().split() == [pieces[1].path, '0']
+
+
+if __name__ == '__main__':
+    band_slices_test()
+    split_merge_test()
+    dem_test()
+    run_pieces_test()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+
+from simulation import staging
+
+
+def _simulation():
+    path = tempfile.mkdtemp()
+    os.makedirs(os.path.join(path, 'input'))
+    with open(os.path.join(path, 'input', 'phase.xml'), 'w') as f:
+        f.write('<Phase/>')
+    return path
+
+
+def publish_test():
+    scratch, path = tempfile.mkdtemp(), _simulation()
+    with staging.Staging(scratch, min_free_bytes=0).stage(path, copy=True) as staged:
+        assert os.path.exists(os.path.join(staged, 'input', 'phase.xml'))
+        os.makedirs(os.path.join(staged, 'output', 'BAND0'))
+        with open(os.path.join(staged, 'output', 'BAND0', 'brf'), 'w') as f:
+            f.write('brf')
+    assert sorted(os.listdir(path)) == ['input', 'output']
+    assert os.listdir(scratch) == []
+
+
+def failure_cleanup_test():
+    scratch, path = tempfile.mkdtemp(), _simulation()
+    try:
+        with staging.Staging(scratch, min_free_bytes=0).stage(path, copy=True) as staged:
+            os.makedirs(os.path.join(staged, 'output'))
+            raise RuntimeError('DART crashed')
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('the failure must be raised')
+    # nothing is published and the scratch directory is removed
+    assert sorted(os.listdir(path)) == ['input']
+    assert os.listdir(scratch) == []
+
+
+def free_space_test():
+    scratch, path = tempfile.mkdtemp(), _simulation()
+    free = shutil.disk_usage(scratch).free
+    try:
+        with staging.Staging(scratch, min_free_bytes=free + 1).stage(path, copy=True):
+            raise AssertionError('must not stage without space left')
+    except Exception as e:
+        assert 'Not enough space on scratch' in str(e)
+    assert os.listdir(scratch) == []
+
+
+if __name__ == '__main__':
+    publish_test()
+    failure_cleanup_test()
+    free_space_test()
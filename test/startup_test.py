@@ -0,0 +1,39 @@
+import os
+import re
+import subprocess
+import sys
+
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['lxml', 'toml', 'dill', 'pkg_resources']
+
+
+def _import_in_fresh_process(module, code=''):
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module + '\n' + code],
+                          cwd=PACKAGE_ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+
+
+def import_time_test(module='simulation.simulation', max_seconds=0.15):
+    """
+    Guard cold startup: importing the simulation module must neither pull in the heavy modules nor take longer
+    than max_seconds (cumulative import time as reported by python -X importtime).
+    """
+    proc = _import_in_fresh_process(module, 'import sys; print(" ".join(sys.modules))')
+
+    loaded = set(proc.stdout.split())
+    eager = [m for m in HEAVY_MODULES if m in loaded]
+    assert not eager, 'modules imported eagerly: ' + ', '.join(eager)
+
+    cumulative = None
+    for line in proc.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+\s+\|\s+(\d+)\s+\|\s*' + re.escape(module) + r'\s*$', line)
+        if match:
+            cumulative = int(match.group(1)) * 1e-6
+    assert cumulative is not None, 'no import time reported for ' + module
+    assert cumulative < max_seconds, module + ' took ' + str(cumulative) + 's to import'
+    return cumulative
+
+
+if __name__ == '__main__':
+    print(import_time_test())
@@ -0,0 +1,101 @@
+import os
+import tempfile
+
+from lxml import etree
+
+from simulation import archive
+from simulation import ledger
+from simulation import staging
+from simulation import sweep
+
+
+def _sweep(pack=False):
+    location = tempfile.mkdtemp()
+    parameters = {'atmosphere': {'general': {'typeOfAtmosphere': [1]}, 'products': {'atmosphereBRF_TOA': [0, 1]}},
+                  'directions': {'sun': {'sunViewingZenithAngle': [10., 20., 30.]}}}
+    return sweep.Sweep({'sweep': {'name': 'atmosphere', 'simulation_location': location, 'share_atmosphere': True,
+                                  'pack': pack, 'parameters': parameters}}, root=location)
+
+
+def _transfer_functions(path):
+    # packed simulations are read from their archive
+    root = etree.fromstring(archive.read(os.path.join(path, 'input', 'atmosphere.xml')))
+    return root.find('.//AtmosphereTransfertFunctions')
+
+
+def share_atmosphere_test(pack=False, scratch=None):
+    s = _sweep(pack=pack)
+    s.create(staging=staging.Staging(scratch, min_free_bytes=0) if scratch is not None else None)
+    groups = list(s.atmosphere_groups().values())
+    assert [len(group) for group in groups] == [3, 3]
+
+    jobs = dict((job['name'], job) for job in s.ledger.jobs(sweep=s.name))
+    for group in groups:
+        writer = jobs[group[0].name]
+        assert writer['depends'] is None
+        # DART is told where to write the transfer functions
+        computed = _transfer_functions(writer['path']).find('ComputedTransferFunctions')
+        assert computed.get('writeTransferFunctions') == '1'
+        written = computed.get('transferFunctionsFile')
+        assert written == os.path.join(writer['path'], 'output', 'atmosphere_transfer_functions')
+
+        for variant in group[1:]:
+            importer = jobs[variant.name]
+            assert importer['depends'] == writer['name']
+            element = _transfer_functions(importer['path'])
+            assert element.get('inputOutputTransfertFunctions') == '1'
+            assert element.find('ImportedTransferFunctions').get('transferFunctionsFile') == written
+
+
+def share_atmosphere_pack_test():
+    # the written path is the final simulation directory, not the scratch space the xml is written in
+    share_atmosphere_test(pack=True)
+    share_atmosphere_test(scratch=tempfile.mkdtemp())
+    share_atmosphere_test(pack=True, scratch=tempfile.mkdtemp())
+
+
+def depends_test():
+    s = _sweep()
+    s.create()
+    job_ledger = s.ledger
+    writers = [group[0].name for group in s.atmosphere_groups().values()]
+
+    # importers are only handed out once their writer is done
+    claimed = [job_ledger.claim(sweep=s.name)['name'] for _ in writers]
+    assert sorted(claimed) == sorted(writers)
+    assert job_ledger.claim(sweep=s.name) is None
+    assert len(job_ledger.waiting(sweep=s.name)) == 4
+
+    job_ledger.finish(writers[0], 0, 1.)
+    job = job_ledger.claim(sweep=s.name)
+    assert job['depends'] == writers[0]
+    assert len(job_ledger.waiting(sweep=s.name)) == 2
+
+    # importers of a writer that failed for good fail as well
+    job_ledger.finish(writers[1], 1, 1.)
+    job_ledger.transition(writers[1], ledger.FAILED, attempts=3)
+    assert job_ledger.waiting(sweep=s.name) == []
+    failed = [job for job in job_ledger.jobs(sweep=s.name) if job['depends'] == writers[1]]
+    assert all(job['state'] == ledger.FAILED for job in failed)
+
+
+def zip_test():
+    parameters = {'directions': {'sun': {'sunViewingZenithAngle': [10., 20., 30.],
+                                         'sunViewingAzimuthAngle': [0., 90., 180.]}}}
+    s = sweep.Sweep({'sweep': {'mode': 'zip', 'parameters': parameters}}, root=tempfile.mkdtemp())
+    assert len(s) == len(list(s.variants())) == 3
+
+    parameters['directions']['sun']['sunViewingAzimuthAngle'] = [0., 90.]
+    try:
+        sweep.Sweep({'sweep': {'mode': 'zip', 'parameters': parameters}}, root=tempfile.mkdtemp())
+    except Exception as e:
+        assert 'same length' in str(e)
+    else:
+        raise AssertionError('parameters of different lengths must be rejected in zip mode')
+
+
+if __name__ == '__main__':
+    share_atmosphere_test()
+    share_atmosphere_pack_test()
+    depends_test()
+    zip_test()
@@ -0,0 +1,83 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+import utils.timing
+
+
+def nesting_test():
+    with utils.timing.SpanCollector() as spans:
+        with utils.timing.span('outer', path='/sims/a'):
+            time.sleep(0.01)
+            with utils.timing.span('inner', category='io'):
+                time.sleep(0.01)
+    # spans are recorded when they end, the inner one first
+    inner, outer = spans.spans
+    assert (inner.name, inner.category, outer.name, outer.args) == ('inner', 'io', 'outer', {'path': '/sims/a'})
+    assert outer.start <= inner.start and inner.start + inner.duration <= outer.start + outer.duration
+    assert outer.duration >= inner.duration >= 0.01
+
+    # removed hooks do not record anymore
+    with utils.timing.span('after'):
+        pass
+    assert len(spans.spans) == 2
+
+
+def threads_test():
+    @utils.timing.timed('work')
+    def work():
+        time.sleep(0.005)
+        return threading.get_ident()
+
+    idents = []
+    with utils.timing.SpanCollector() as spans:
+        threads = [threading.Thread(target=lambda: idents.append(work())) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert sorted(s.tid for s in spans.spans) == sorted(idents)
+    assert all(s.pid == os.getpid() and s.name == 'work' for s in spans.spans)
+    assert spans.summary()['work']['count'] == 4
+
+
+def export_test():
+    with utils.timing.SpanCollector() as spans:
+        for i in range(3):
+            with utils.timing.span('component.write', component='phase', index=i):
+                time.sleep(0.002)
+        with utils.timing.span('file.copy'):
+            pass
+
+    directory = tempfile.mkdtemp()
+    trace_path, metrics_path = os.path.join(directory, 'trace.json'), os.path.join(directory, 'metrics.txt')
+    spans.to_chrome_trace(trace_path)
+    spans.to_metrics(metrics_path)
+
+    with open(trace_path) as f:
+        events = json.load(f)['traceEvents']
+    assert [e['name'] for e in events] == [s.name for s in spans.spans]
+    for event, record in zip(events, spans.spans):
+        assert event['ph'] == 'X' and event['tid'] == record.tid
+        assert abs(event['dur'] - record.duration * 1e6) < 1e-3
+        assert event['args'] == {k: str(v) for k, v in record.args.items()}
+
+    metrics = {}
+    with open(metrics_path) as f:
+        for line in f:
+            name, *fields = line.split()
+            metrics[name] = dict((k, float(v)) for k, v in (field.split('=') for field in fields))
+    summary = spans.summary()
+    assert list(metrics) == ['component.write', 'file.copy']
+    for name, entry in summary.items():
+        assert metrics[name]['count'] == entry['count']
+        assert abs(metrics[name]['total'] - entry['total']) < 1e-6
+        assert abs(metrics[name]['max'] - entry['max']) < 1e-6
+
+
+if __name__ == '__main__':
+    nesting_test()
+    threads_test()
+    export_test()
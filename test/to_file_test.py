@@ -0,0 +1,57 @@
+import os
+import tempfile
+
+from lxml import etree
+
+from simulation import components
+from simulation import simulation
+
+
+def _simulation(name):
+    return simulation.Simulation({}, no_gen='not_implemented', simulation_name=name,
+                                 simulation_location=tempfile.mkdtemp())
+
+
+def _inputs(path):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(os.path.join(path, 'input')):
+        for name in filenames:
+            file_path = os.path.join(dirpath, name)
+            with open(file_path, 'rb') as f:
+                files[os.path.relpath(file_path, path)] = f.read()
+    return files
+
+
+def parallel_test():
+    serial, threaded = _simulation('serial'), _simulation('threaded')
+    serial.to_file()
+    threaded.to_file(parallel=4)
+    bulk = [_simulation('bulk'), _simulation('bulk')]
+    paths = simulation.Simulation.bulk_to_file(bulk, jobs=2)
+
+    expected = _inputs(serial.path)
+    assert len(expected) == len([c for c in serial.components.values() if c is not None])
+    for path in [threaded.path] + paths:
+        assert _inputs(path) == expected
+
+
+def repeated_test():
+    directory = tempfile.mkdtemp()
+    params = simulation.load_config(simulation.default_config_path('5.7.5'))['phase']
+    phase = components.Phase(directory, params, '5.7.5')
+    xml_path = os.path.join(directory, 'input', 'phase.xml')
+
+    phase.to_file()
+    with open(xml_path, 'rb') as f:
+        first = f.read()
+    phase.to_file()
+    with open(xml_path, 'rb') as f:
+        assert f.read() == first
+    # the component root is not extended by the second write
+    assert len(etree.fromstring(first).findall('Phase')) == 1
+    assert len(phase.xml_root) == 0
+
+
+if __name__ == '__main__':
+    parallel_test()
+    repeated_test()
@@ -0,0 +1,91 @@
+import os
+import stat
+import sys
+import tempfile
+
+from simulation import archive
+from simulation import run
+from simulation import tuning
+import utils.general
+
+
+# Fake DART: Amdahl scaling over nbThreads plus a penalty growing with the number of concurrently running fakes
+# (shared memory bandwidth and I/O). With these constants 2 jobs x 4 threads has the best throughput on 8 cores.
+FAKE_DART = """#!{python}
+import glob, os, re, sys, time
+path = sys.argv[1]
+shared = {shared!r}
+threads = int(re.search(r'nbThreads="(\\d+)"', open(os.path.join(path, 'input', 'phase.xml')).read()).group(1))
+
+marker = os.path.join(shared, str(os.getpid()))
+open(marker, 'w').close()
+time.sleep(0.05)
+concurrent = len(glob.glob(os.path.join(shared, '*')))
+
+serial, work, contention = 0.5, 0.5, 0.3
+time.sleep(work * (serial + (1 - serial) / threads) * (1 + contention * (concurrent - 1) ** 2))
+os.remove(marker)
+"""
+
+PHASE = """<DartFile version="5.7.5">
+    <Phase calculatorMethod="0">
+        <ExpertModeZone nbThreads="12"/>
+    </Phase>
+</DartFile>
+"""
+
+
+def _fake_dart(directory):
+    shared = utils.general.create_path(directory, 'running')
+    os.makedirs(shared)
+    path = utils.general.create_path(directory, 'fake_dart.py')
+    with open(path, 'w') as f:
+        f.write(FAKE_DART.format(python=sys.executable, shared=shared))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def _simulation(directory):
+    os.makedirs(utils.general.create_path(directory, 'input'))
+    with open(utils.general.create_path(directory, 'input', tuning.PHASE_FILE), 'w') as f:
+        f.write(PHASE)
+    return directory
+
+
+def calibrate_test():
+    directory = tempfile.mkdtemp()
+    dart_path = _fake_dart(directory)
+    representative = _simulation(utils.general.create_path(directory, 'representative'))
+
+    runner = run.SimulationRunner(dart_path=dart_path)
+    result = runner.tune([representative], cores=8)
+
+    assert (result.jobs, result.threads) == (2, 4), result.throughputs
+    assert (runner.jobs, runner.threads) == (2, 4)
+    return result
+
+
+def set_threads_test():
+    sim = _simulation(tempfile.mkdtemp() + '/sim')
+    tuning.set_threads(sim, 3)
+    with open(utils.general.create_path(sim, 'input', tuning.PHASE_FILE)) as f:
+        assert 'nbThreads="3"' in f.read()
+
+
+def packed_test():
+    directory = tempfile.mkdtemp()
+    dart_path = _fake_dart(directory)
+    representative = _simulation(utils.general.create_path(directory, 'representative'))
+    archive.pack(representative)
+    assert not os.path.exists(utils.general.create_path(representative, 'input'))
+
+    result = tuning.calibrate([representative], cores=2, dart_path=dart_path)
+    assert set(result.throughputs) == {(2, 1), (1, 2)}
+    # the representative simulation stays packed
+    assert os.listdir(representative) == [archive.ARCHIVE_FILE]
+
+
+if __name__ == '__main__':
+    set_threads_test()
+    packed_test()
+    print(calibrate_test())
@@ -1,5 +1,9 @@
 import collections
+import functools
+import hashlib
+import importlib
 import os
+import re
 
 import six
 
@@ -8,6 +12,66 @@ def create_path(*args):
     return os.path.normpath(os.path.join(*args)).replace('\\', '/')
 
 
+@functools.lru_cache(maxsize=None)
+def parse_version(version):
+    """
+    Parse a dotted version string such as '5.7.5' into a comparable tuple of integers.
+
+    :param version:
+    :return:
+    """
+    return tuple(int(n) for n in re.findall(r'\d+', str(version)))
+
+
+class LazyModule(object):
+    """
+    Module proxy importing the module on first attribute access. Keeps heavy imports (lxml, toml, dill) off the
+    startup path of short-lived processes.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+def cache_dir(*args):
+    """
+    Directory for caches shared by all simulations, $DARTPY_CACHE or ~/.cache/dartpy. Created on first use.
+
+    :param args: subdirectories
+    :return:
+    """
+    root = os.environ.get('DARTPY_CACHE') or os.path.join(os.path.expanduser('~'), '.cache', 'dartpy')
+    path = create_path(root, *args)
+    if not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    return path
+
+
+def file_hash(path, chunk_size=1 << 24):
+    """
+    sha1 hex digest of a file, read in chunks.
+
+    :param path:
+    :param chunk_size:
+    :return:
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 def merge_dicts(src_dict, patch_dict, ignore=None):
     """
     Merge nested directory by overriding src_dict values with patch_dict values.
@@ -38,4 +102,53 @@ def merge_dicts(src_dict, patch_dict, ignore=None):
             src_dict[k] = merge_dicts(dv, v, ignore=ignore)
         else:
             src_dict[k] = v
-    return src_dict
\ No newline at end of file
+    return src_dict
+
+
+def builtin_dict(d):
+    """
+    Deep copy of a nested dict (and lists) with all dict subclasses, e.g. toml inline tables, cast to dict.
+
+    :param d:
+    :return:
+    """
+    if isinstance(d, dict):
+        return dict((k, builtin_dict(v)) for k, v in d.items())
+    if isinstance(d, list):
+        return [builtin_dict(v) for v in d]
+    return d
+
+
+def flatten_dict(d, prefix=''):
+    """
+    Flatten a nested dict into a dict with dotted keys, e.g. {'a': {'b': 1}} -> {'a.b': 1}.
+
+    :param d:
+    :param prefix:
+    :return:
+    """
+    flat = collections.OrderedDict()
+    for k, v in d.items():
+        key = prefix + str(k)
+        if isinstance(v, dict):
+            flat.update(flatten_dict(v, key + '.'))
+        else:
+            flat[key] = v
+    return flat
+
+
+def nest_dict(flat):
+    """
+    Inverse of flatten_dict.
+
+    :param flat: dict with dotted keys
+    :return:
+    """
+    nested = {}
+    for key, v in flat.items():
+        node = nested
+        nodes = key.split('.')
+        for n in nodes[:-1]:
+            node = node.setdefault(n, {})
+        node[nodes[-1]] = v
+    return nested
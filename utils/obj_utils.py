@@ -0,0 +1,130 @@
+"""
+Geometry metadata of Wavefront OBJ meshes: vertex and face counts, bounds and dimensions.
+
+Meshes are scanned in chunks, so multi-GB files never have to fit into memory. The metadata is cached by file content
+hash in the dartpy cache directory. A file that did not change since it was last hashed (same path, size and mtime)
+is neither hashed nor scanned again.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+
+import utils.general
+import utils.timing
+
+np = utils.general.lazy_import('numpy')
+
+CACHE_NAME = 'obj'
+CHUNK_SIZE = 1 << 26
+
+_VERTEX = re.compile(rb'^v[ \t]+([^\r\n]*)', re.M)
+_FACE = re.compile(rb'^f[ \t]', re.M)
+
+
+def metadata(path, cache=True):
+    """
+    Geometry metadata of an OBJ file.
+
+    :param path:
+    :param cache: look up and store the metadata in the dartpy cache
+    :return: dict with vertices, faces, min, max (lists of x, y, z), dim (max - min) and sha1
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    if not cache:
+        return scan(path)
+
+    stat = os.stat(path)
+    stat_key = utils.general.create_path(utils.general.cache_dir(CACHE_NAME, 'stat'), _key(
+        path + ':' + str(stat.st_size) + ':' + str(stat.st_mtime_ns)))
+    digest = _load(stat_key, {}).get('sha1')
+    if digest is None:
+        with utils.timing.span('obj.hash', path=path):
+            digest = utils.general.file_hash(path)
+
+    meta_path = utils.general.create_path(utils.general.cache_dir(CACHE_NAME), digest + '.json')
+    meta = _load(meta_path, None)
+    if meta is None:
+        meta = scan(path)
+        meta['sha1'] = digest
+        _dump(meta_path, meta)
+    _dump(stat_key, {'sha1': digest})
+    return meta
+
+
+def scan(path, chunk_size=CHUNK_SIZE):
+    """
+    Scan an OBJ file for its vertex bounds and vertex and face counts.
+
+    :param path:
+    :param chunk_size: bytes read at once
+    :return: dict with vertices, faces, min, max and dim
+    """
+    vertices = faces = 0
+    lower, upper = None, None
+    with utils.timing.span('obj.scan', path=path), open(path, 'rb') as f:
+        rest = b''
+        while True:
+            chunk = f.read(chunk_size)
+            if chunk:
+                chunk = rest + chunk
+                cut = chunk.rfind(b'\n') + 1
+                chunk, rest = chunk[:cut], chunk[cut:]
+            else:
+                chunk, rest = rest, b''
+            if not chunk:
+                if rest:
+                    continue
+                break
+
+            coordinates = _coordinates(chunk)
+            faces += len(_FACE.findall(chunk))
+            if len(coordinates):
+                vertices += len(coordinates)
+                lo, hi = coordinates.min(axis=0), coordinates.max(axis=0)
+                lower = lo if lower is None else np.minimum(lower, lo)
+                upper = hi if upper is None else np.maximum(upper, hi)
+
+    if vertices == 0:
+        logging.warning(path + ' contains no vertices')
+        lower = upper = np.zeros(3)
+    return {'vertices': vertices, 'faces': faces, 'min': lower.tolist(), 'max': upper.tolist(),
+            'dim': (upper - lower).tolist()}
+
+
+def _coordinates(chunk):
+    """
+    x, y, z of all vertex lines in chunk as (n, 3) array.
+    """
+    payloads = _VERTEX.findall(chunk)
+    if not payloads:
+        return np.zeros((0, 3))
+    values = np.fromstring(b' '.join(payloads), sep=' ')
+    if len(values) == 3 * len(payloads):
+        return values.reshape(-1, 3)
+    # vertices with w or colors
+    return np.array([p.split()[:3] for p in payloads]).astype(float)
+
+
+def _key(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest() + '.json'
+
+
+def _load(path, default):
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        return default
+
+
+def _dump(path, content):
+    # several processes and threads may write the same entry, the content is the same
+    part = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+    with open(part, 'w') as f:
+        json.dump(content, f)
+    os.replace(part, path)
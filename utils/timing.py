@@ -0,0 +1,139 @@
+import collections
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+Span = collections.namedtuple('Span', ['name', 'category', 'start', 'duration', 'pid', 'tid', 'args'])
+
+_HOOKS = []
+_HOOKS_LOCK = threading.Lock()
+
+
+def add_hook(hook):
+    """
+    Register a callable that receives every finished Span.
+
+    :param hook: callable taking a single Span
+    :return: hook
+    """
+    with _HOOKS_LOCK:
+        _HOOKS.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    with _HOOKS_LOCK:
+        if hook in _HOOKS:
+            _HOOKS.remove(hook)
+
+
+@contextmanager
+def span(name, category='dartpy', **args):
+    """
+    Time the enclosed block and hand the resulting Span to all registered hooks. Without hooks this is a no-op.
+
+    :param name: span name, e.g. 'component.write'
+    :param category: span category
+    :param args: additional information attached to the span (component name, path, ...)
+    """
+    if not _HOOKS:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        record = Span(name, category, start, duration, os.getpid(), threading.get_ident(), args)
+        for hook in list(_HOOKS):
+            hook(record)
+
+
+def timed(name, category='dartpy'):
+    """
+    Decorator version of span.
+
+    :param name:
+    :param category:
+    :return:
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SpanCollector(object):
+    """
+    Hook collecting spans in memory. Use as context manager to register and unregister it automatically:
+
+        with SpanCollector() as spans:
+            sim.to_file()
+        spans.to_chrome_trace('trace.json')
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        with self._lock:
+            self.spans.append(record)
+
+    def __enter__(self):
+        return add_hook(self)
+
+    def __exit__(self, *exc):
+        remove_hook(self)
+
+    def summary(self):
+        """
+        Aggregate spans per name.
+
+        :return: dict name -> dict with count, total, mean and max duration in seconds
+        """
+        summary = collections.OrderedDict()
+        for record in self.spans:
+            entry = summary.setdefault(record.name, {'count': 0, 'total': 0., 'max': 0.})
+            entry['count'] += 1
+            entry['total'] += record.duration
+            entry['max'] = max(entry['max'], record.duration)
+
+        for entry in summary.values():
+            entry['mean'] = entry['total'] / entry['count']
+        return summary
+
+    def to_chrome_trace(self, path):
+        """
+        Write spans as Chrome trace event JSON (chrome://tracing, Perfetto).
+
+        :param path:
+        :return:
+        """
+        events = [{'name': record.name, 'cat': record.category, 'ph': 'X',
+                   'ts': record.start * 1e6, 'dur': record.duration * 1e6,
+                   'pid': record.pid, 'tid': record.tid,
+                   'args': {k: str(v) for k, v in record.args.items()}}
+                  for record in self.spans]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def to_metrics(self, path):
+        """
+        Write a plain text metrics file with one line per span name.
+
+        :param path:
+        :return:
+        """
+        with open(path, 'w') as f:
+            for name, entry in self.summary().items():
+                f.write('{} count={} total={:.6f} mean={:.6f} max={:.6f}\n'.format(
+                    name, entry['count'], entry['total'], entry['mean'], entry['max']))
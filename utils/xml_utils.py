@@ -1,6 +1,7 @@
 import collections
-from lxml import etree as et
-from utils.general import merge_dicts
+from utils.general import merge_dicts, lazy_import
+
+et = lazy_import('lxml.etree')
 
 def merge_xmls(src_xml, patch_xml, remove_empty_paths=False, removing_level=3):
     src = etree_to_dict(src_xml)